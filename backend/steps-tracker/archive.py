@@ -0,0 +1,485 @@
+"""
+Архив холодной истории daily_steps и transactions.
+Месяцы старше ARCHIVE_AFTER_DAYS выгружаются одним COPY ... TO STDOUT: строки
+идут потоком в сжатые gzip CSV во временном каталоге, поэтому память не
+зависит от размера месяца. Строки раскладываются по ARCHIVE_BUCKETS корзинам
+по хэшу user_id, и история одного пользователя читается из одной корзины месяца.
+Корзины хранятся в базе, в archive_blobs, — облачные функции читают архив тем же
+соединением; месяцы записаны в archive_segments.
+
+Корзины и сегмент записываются одной транзакцией (статус exported). Перед
+удалением строк выгрузка сверяется с таблицей, и только после этого сегмент
+становится archived и читается функциями. Затем строки удаляются: daily_steps —
+пачками по ARCHIVE_DELETE_BATCH, каждая в своей транзакции; у transactions
+отсоединяется и удаляется месячная секция, а остатки месяца (например, в секции
+по умолчанию) удаляются пачками. Дельты удалённых записей журнала копятся в
+ledger_archive_totals, а месяц журнала архивируется, только если все его
+записи уже вошли в снимки балансов (python ledger.py snapshot).
+
+Фоновые задачи:
+    python archive.py run [--table daily_steps|transactions] [--dry-run]
+    python archive.py read ТАБЛИЦА USER_ID [--from YYYY-MM-DD] [--to YYYY-MM-DD]
+    python archive.py list
+"""
+import json
+import os
+import sys
+import uuid
+from datetime import date, timedelta
+
+# Каталог для временных файлов корзин во время выгрузки; по умолчанию системный
+ARCHIVE_SPOOL_DIR = os.environ.get('ARCHIVE_SPOOL_DIR') or None
+ARCHIVE_AFTER_DAYS = int(os.environ.get('ARCHIVE_AFTER_DAYS', '365'))
+ARCHIVE_BUCKETS = int(os.environ.get('ARCHIVE_BUCKETS', '256'))
+ARCHIVE_DELETE_BATCH = int(os.environ.get('ARCHIVE_DELETE_BATCH', '10000'))
+ARCHIVE_GZIP_LEVEL = int(os.environ.get('ARCHIVE_GZIP_LEVEL', '6'))
+
+# Колонка, по которой таблица режется на месяцы, и порядок строк в корзине
+TABLES = {
+    'daily_steps': {'column': 'date', 'order': 'user_id, date'},
+    'transactions': {'column': 'created_at', 'order': 'user_id, created_at'},
+}
+
+# Корзина по первым 32 битам md5 от user_id
+BUCKET_SQL = "mod(('x' || substr(md5({user_id}::text), 1, 8))::bit(32)::bigint, {buckets})"
+
+DELETE_STEPS_SQL = """
+    WITH batch AS (
+        SELECT id FROM daily_steps
+        WHERE date >= %(start)s AND date < %(end)s
+        LIMIT %(batch)s
+    )
+    DELETE FROM daily_steps d
+    USING batch
+    WHERE d.id = batch.id
+"""
+
+# Дельты удаляемых записей журнала переносятся в ledger_archive_totals тем же запросом
+ARCHIVE_TOTALS_SQL = """
+    INSERT INTO ledger_archive_totals (user_id, delta_spitak, delta_earned, delta_steps, archived_until)
+    SELECT user_id, SUM(delta_spitak), SUM(delta_earned), SUM(delta_steps), %(end)s
+    FROM {source}
+    GROUP BY user_id
+    ORDER BY user_id
+    ON CONFLICT (user_id) DO UPDATE SET
+        delta_spitak = ledger_archive_totals.delta_spitak + EXCLUDED.delta_spitak,
+        delta_earned = ledger_archive_totals.delta_earned + EXCLUDED.delta_earned,
+        delta_steps = ledger_archive_totals.delta_steps + EXCLUDED.delta_steps,
+        archived_until = GREATEST(ledger_archive_totals.archived_until, EXCLUDED.archived_until)
+"""
+
+DELETE_TRANSACTIONS_SQL = f"""
+    WITH batch AS (
+        SELECT id, created_at FROM transactions
+        WHERE created_at >= %(start)s AND created_at < %(end)s
+        LIMIT %(batch)s
+    ),
+    deleted AS (
+        DELETE FROM transactions t
+        USING batch
+        WHERE t.id = batch.id AND t.created_at = batch.created_at
+        RETURNING t.user_id, t.delta_spitak, t.delta_earned, t.delta_steps
+    ),
+    totals AS (
+        {ARCHIVE_TOTALS_SQL.format(source='deleted')}
+    )
+    SELECT COUNT(*) AS deleted FROM deleted
+"""
+
+# Записи месяца, которые ещё не вошли в снимок баланса: без них удалять журнал нельзя
+UNCOVERED_SQL = """
+    SELECT COUNT(*) AS uncovered
+    FROM transactions t
+    LEFT JOIN balance_snapshots bs ON bs.user_id = t.user_id
+    WHERE t.created_at >= %(start)s AND t.created_at < %(end)s
+      AND t.created_at >= COALESCE(bs.covered_until, '-infinity'::timestamp)
+"""
+
+
+def _month_start(day: date) -> date:
+    return day.replace(day=1)
+
+
+def _next_month(month: date) -> date:
+    return (month + timedelta(days=32)).replace(day=1)
+
+
+class SegmentWriter:
+    """
+    Приёмник copy_expert: раскладывает строки CSV по временным файлам корзин.
+    Сервер шлёт по сообщению CopyData на строку, psycopg2 передаёт каждое в write
+    отдельно, поэтому строки с переводами строк внутри кавычек не разрезаются.
+    Строки отсортированы по корзине, так что открыт всегда один файл.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.bucket_rows = {}
+        self.rows = 0
+        self._bucket = None
+        self._file = None
+
+    def path(self, bucket: int) -> str:
+        return os.path.join(self.directory, f'{bucket:04d}.csv.gz')
+
+    def write(self, data):
+        if isinstance(data, str):
+            data = data.encode('utf-8')
+        bucket, row = data.split(b',', 1)
+        bucket = int(bucket)
+        if bucket != self._bucket:
+            self._open(bucket)
+        self._file.write(row)
+        self.bucket_rows[bucket] += 1
+        self.rows += 1
+
+    def _open(self, bucket: int):
+        import gzip
+        self.close()
+        self._bucket = bucket
+        self.bucket_rows[bucket] = 0
+        self._file = gzip.open(self.path(bucket), 'wb', compresslevel=ARCHIVE_GZIP_LEVEL)
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+
+def store_segment(cur, table: str, month: date, columns: list, writer: SegmentWriter) -> int:
+    """
+    Записывает корзины выгрузки в archive_blobs и сегмент в archive_segments
+    со статусом exported. Файлы корзин читаются по одному. Возвращает размер
+    архива месяца в байтах; коммит за вызывающим.
+    """
+    import psycopg2
+
+    cur.execute("DELETE FROM archive_blobs WHERE table_name = %s AND period_start = %s", (table, month))
+    size = 0
+    for bucket, rows in sorted(writer.bucket_rows.items()):
+        with open(writer.path(bucket), 'rb') as f:
+            data = f.read()
+        cur.execute("""
+            INSERT INTO archive_blobs (table_name, period_start, bucket, row_count, data)
+            VALUES (%s, %s, %s, %s, %s)
+        """, (table, month, bucket, rows, psycopg2.Binary(data)))
+        size += len(data)
+    cur.execute("""
+        INSERT INTO archive_segments (table_name, period_start, period_end, buckets, row_count, bytes, columns)
+        VALUES (%s, %s, %s, %s, %s, %s, %s)
+        ON CONFLICT (table_name, period_start) DO UPDATE SET
+            period_end = EXCLUDED.period_end,
+            buckets = EXCLUDED.buckets,
+            row_count = EXCLUDED.row_count,
+            bytes = EXCLUDED.bytes,
+            columns = EXCLUDED.columns,
+            status = 'exported',
+            archived_at = CURRENT_TIMESTAMP,
+            deleted_at = NULL
+    """, (table, month, _next_month(month), ARCHIVE_BUCKETS, writer.rows, size, columns))
+    return size
+
+
+def export_month(conn, table: str, month: date) -> dict:
+    """
+    Выгружает месяц таблицы в корзины archive_blobs и записывает его в archive_segments.
+    Счёт строк и COPY выполняются в одном снимке REPEATABLE READ; корзины копятся
+    во временном каталоге и попадают в базу одной транзакцией, когда всё выгружено.
+    """
+    import shutil
+    import tempfile
+
+    spec = TABLES[table]
+    start, end = month, _next_month(month)
+    staging = tempfile.mkdtemp(prefix=f'{table}_{month:%Y_%m}_', dir=ARCHIVE_SPOOL_DIR)
+    writer = SegmentWriter(staging)
+    cur = conn.cursor()
+    try:
+        cur.execute("SET TRANSACTION ISOLATION LEVEL REPEATABLE READ")
+        cur.execute(f"SELECT * FROM {table} LIMIT 0")
+        columns = [column.name for column in cur.description]
+        cur.execute(f"SELECT COUNT(*) AS row_count FROM {table} WHERE {spec['column']} >= %s AND {spec['column']} < %s",
+                    (start, end))
+        expected = cur.fetchone()['row_count']
+        query = cur.mogrify(f"""
+            SELECT {BUCKET_SQL.format(user_id='user_id', buckets=ARCHIVE_BUCKETS)} AS bucket, *
+            FROM {table}
+            WHERE {spec['column']} >= %s AND {spec['column']} < %s
+            ORDER BY 1, {spec['order']}
+        """, (start, end)).decode()
+        try:
+            cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT csv)', writer)
+        finally:
+            writer.close()
+        conn.commit()
+
+        if writer.rows != expected:
+            raise RuntimeError(f'{table} {month:%Y-%m}: выгружено {writer.rows} строк из {expected}')
+
+        size = store_segment(cur, table, month, columns, writer)
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+        shutil.rmtree(staging, ignore_errors=True)
+    return {'rows': writer.rows, 'bytes': size}
+
+
+def _drop_transaction_partition(cur, month: date, end: date) -> int:
+    """
+    Отсоединяет и удаляет месячную секцию журнала, перенося её дельты в
+    ledger_archive_totals в той же транзакции. Возвращает число удалённых строк.
+    """
+    partition = f"transactions_{month.strftime('%Y_%m')}"
+    cur.execute("""
+        SELECT 1 FROM pg_inherits
+        WHERE inhparent = 'transactions'::regclass AND inhrelid = to_regclass(%s)
+    """, (partition,))
+    if cur.fetchone() is None:
+        return 0
+    cur.execute(f"SELECT COUNT(*) AS row_count FROM {partition}")
+    rows = cur.fetchone()['row_count']
+    cur.execute(ARCHIVE_TOTALS_SQL.format(source=partition), {'end': end})
+    cur.execute(f"ALTER TABLE transactions DETACH PARTITION {partition}")
+    cur.execute(f"DROP TABLE {partition}")
+    return rows
+
+
+def delete_month(conn, table: str, month: date, exported_rows: int, verified: bool = False,
+                 batch_size: int = ARCHIVE_DELETE_BATCH) -> int:
+    """
+    Сверяет выгрузку с таблицей, делает сегмент archived и удаляет месяц из таблицы.
+    Если с выгрузки строки месяца изменились, ничего не удаляет: месяц
+    выгрузится заново при следующем запуске. verified=True продолжает
+    прерванное удаление уже сверенного месяца.
+    """
+    spec = TABLES[table]
+    params = {'start': month, 'end': _next_month(month), 'batch': batch_size}
+    deleted = 0
+    cur = conn.cursor()
+    try:
+        if table == 'transactions':
+            cur.execute(UNCOVERED_SQL, params)
+            if cur.fetchone()['uncovered']:
+                raise RuntimeError(f'transactions {month:%Y-%m}: не все записи вошли в снимки, запустите ledger.py snapshot')
+        if not verified:
+            cur.execute(f"SELECT COUNT(*) AS row_count FROM {table} WHERE {spec['column']} >= %(start)s AND {spec['column']} < %(end)s",
+                        params)
+            if cur.fetchone()['row_count'] != exported_rows:
+                conn.rollback()
+                cur.execute("""
+                    DELETE FROM archive_segments WHERE table_name = %s AND period_start = %s AND status = 'exported'
+                """, (table, month))
+                cur.execute("DELETE FROM archive_blobs WHERE table_name = %s AND period_start = %s", (table, month))
+                conn.commit()
+                raise RuntimeError(f'{table} {month:%Y-%m}: строки изменились после выгрузки, месяц будет выгружен заново')
+            # С этого момента история месяца читается из архива; строки, которые
+            # ещё не удалены, история не задваивает (см. history.py)
+            cur.execute("""
+                UPDATE archive_segments SET status = 'archived'
+                WHERE table_name = %s AND period_start = %s
+            """, (table, month))
+            conn.commit()
+
+        if table == 'transactions':
+            deleted += _drop_transaction_partition(cur, month, params['end'])
+            conn.commit()
+            while True:
+                cur.execute(DELETE_TRANSACTIONS_SQL, params)
+                batch = cur.fetchone()['deleted']
+                conn.commit()
+                deleted += batch
+                if batch < batch_size:
+                    break
+        else:
+            while True:
+                cur.execute(DELETE_STEPS_SQL, params)
+                batch = cur.rowcount
+                conn.commit()
+                deleted += batch
+                if batch < batch_size:
+                    break
+
+        cur.execute("""
+            UPDATE archive_segments SET deleted_at = CURRENT_TIMESTAMP
+            WHERE table_name = %s AND period_start = %s
+        """, (table, month))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return deleted
+
+
+def pending_months(conn, table: str, today: date = None) -> list:
+    """
+    Месяцы старше ARCHIVE_AFTER_DAYS, которые ещё не удалены из таблицы:
+    [(месяц, сегмент из archive_segments или None, если выгрузки ещё нет)].
+    """
+    today = today or date.today()
+    cutoff = _month_start(today - timedelta(days=ARCHIVE_AFTER_DAYS))
+    column = TABLES[table]['column']
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT period_start, row_count, status, deleted_at FROM archive_segments
+            WHERE table_name = %s ORDER BY period_start
+        """, (table,))
+        segments = {row['period_start']: row for row in cur.fetchall()}
+        done = [month for month, row in segments.items() if row['deleted_at']]
+        if done:
+            # Архивируются подряд от самого старого месяца: продолжаем с последнего удалённого
+            first = _next_month(max(done))
+        else:
+            cur.execute(f"SELECT MIN({column})::date AS first FROM {table} WHERE {column} < %s", (cutoff,))
+            first = cur.fetchone()['first']
+        conn.commit()
+    finally:
+        cur.close()
+
+    # Прерванные выгрузки и удаления продолжаются, даже если позже них есть завершённые месяцы
+    months = {month for month, row in segments.items() if month < cutoff and month not in done}
+    month = _month_start(first) if first else cutoff
+    while month < cutoff:
+        months.add(month)
+        month = _next_month(month)
+    return [(month, segments.get(month)) for month in sorted(months)]
+
+
+def archive(conn, tables: list = None, today: date = None, dry_run: bool = False) -> list:
+    """Выгружает и удаляет все созревшие месяцы, от старых к новым"""
+    report = []
+    for table in tables or list(TABLES):
+        for month, segment in pending_months(conn, table, today):
+            entry = {'table': table, 'month': month.strftime('%Y-%m')}
+            if not dry_run:
+                if segment is None:
+                    if table == 'transactions':
+                        cur = conn.cursor()
+                        try:
+                            cur.execute(UNCOVERED_SQL, {'start': month, 'end': _next_month(month)})
+                            uncovered = cur.fetchone()['uncovered']
+                            conn.commit()
+                        finally:
+                            cur.close()
+                        if uncovered:
+                            entry['skipped'] = f'{uncovered} записей не вошли в снимки'
+                            report.append(entry)
+                            break
+                    entry.update(export_month(conn, table, month))
+                    segment = {'row_count': entry['rows'], 'status': 'exported'}
+                entry['deleted'] = delete_month(conn, table, month, segment['row_count'],
+                                                verified=segment['status'] == 'archived')
+            report.append(entry)
+    return report
+
+
+def iter_archived(cur, table: str, user_id: str, start: date = None, end: date = None):
+    """
+    Строки пользователя из архива таблицы за дни от start до end включительно,
+    по месяцам от новых к старым: (начало месяца, строки). Читаются только
+    сегменты archived; корзина пользователя запрашивается, когда до месяца
+    дошла очередь, поэтому вызывающий может остановиться, набрав сколько нужно.
+    Значения — строки как в CSV, пустые — None.
+    """
+    import csv
+    import gzip
+    import io
+
+    try:
+        user_id = str(uuid.UUID(str(user_id)))
+    except ValueError:
+        raise ValueError('user_id должен быть UUID')
+    column = TABLES[table]['column']
+    cur.execute("""
+        SELECT period_start, columns, buckets FROM archive_segments
+        WHERE table_name = %s
+          AND status = 'archived'
+          AND period_end > COALESCE(%s::date, '-infinity'::date)
+          AND period_start <= COALESCE(%s::date, 'infinity'::date)
+        ORDER BY period_start DESC
+    """, (table, start, end))
+    segments = cur.fetchall()
+
+    lower = start.isoformat() if start else ''
+    upper = end.isoformat() if end else '9999-12-31'
+    for segment in segments:
+        cur.execute(f"""
+            SELECT data FROM archive_blobs
+            WHERE table_name = %(table)s AND period_start = %(month)s
+              AND bucket = {BUCKET_SQL.format(user_id='%(user_id)s', buckets='%(buckets)s')}
+        """, {'table': table, 'month': segment['period_start'], 'user_id': user_id, 'buckets': segment['buckets']})
+        blob = cur.fetchone()
+        if blob is None:
+            continue
+        columns = segment['columns']
+        user_index = columns.index('user_id')
+        day_index = columns.index(column)
+        rows = []
+        with gzip.open(io.BytesIO(blob['data']), 'rt', encoding='utf-8', newline='') as f:
+            for row in csv.reader(f):
+                if row[user_index] < user_id:
+                    continue
+                # Строки корзины отсортированы по user_id: дальше чужие
+                if row[user_index] > user_id:
+                    break
+                if lower <= row[day_index][:10] <= upper:
+                    rows.append({name: value if value != '' else None for name, value in zip(columns, row)})
+        yield segment['period_start'], rows
+
+
+def read_archived(cur, table: str, user_id: str, start: date = None, end: date = None) -> list:
+    """Все строки пользователя из архива таблицы за дни от start до end включительно"""
+    return [row for _, rows in iter_archived(cur, table, user_id, start, end) for row in rows]
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    args = sys.argv[1:]
+    command = args[0] if args else ''
+    if command not in ('run', 'read', 'list') or (command == 'read' and len(args) < 3):
+        print('Использование: python archive.py run [--table ТАБЛИЦА] [--dry-run] | '
+              'read ТАБЛИЦА USER_ID [--from YYYY-MM-DD] [--to YYYY-MM-DD] | list')
+        sys.exit(1)
+
+    def option(name):
+        return args[args.index(name) + 1] if name in args else None
+
+    conn = get_db_connection()
+    try:
+        if command == 'run':
+            table = option('--table')
+            if table and table not in TABLES:
+                print(f'Таблица должна быть одной из: {", ".join(TABLES)}')
+                sys.exit(1)
+            report = archive(conn, [table] if table else None, dry_run='--dry-run' in args)
+            print(json.dumps(report, default=str, ensure_ascii=False, indent=2))
+        elif command == 'read':
+            cur = conn.cursor()
+            try:
+                date_from, date_to = option('--from'), option('--to')
+                rows = read_archived(cur, args[1], args[2],
+                                     date.fromisoformat(date_from) if date_from else None,
+                                     date.fromisoformat(date_to) if date_to else None)
+            finally:
+                cur.close()
+            for row in rows:
+                print(json.dumps(row, ensure_ascii=False))
+        else:
+            cur = conn.cursor()
+            try:
+                cur.execute("""
+                    SELECT table_name, period_start, period_end, buckets, row_count, bytes, status,
+                           archived_at, deleted_at
+                    FROM archive_segments ORDER BY table_name, period_start
+                """)
+                print(json.dumps(cur.fetchall(), default=str, ensure_ascii=False, indent=2))
+            finally:
+                cur.close()
+    finally:
+        release_db_connection(conn)
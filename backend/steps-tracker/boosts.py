@@ -0,0 +1,130 @@
+"""
+Boost-множители стейкинга для начисления за шаги.
+Эффективный множитель пользователя хранится готовым в user_boosts и
+пересчитывается триггером на staking (правила в миграции V0007). Поверх этого
+процесс держит LRU-кэш: попавшие в него пользователи получают множитель без
+обращения к таблицам. Триггер шлёт NOTIFY staking_changed, и кэш сбрасывает
+запись при следующей синхронизации на любом соединении пула.
+
+Фоновая задача:
+    python boosts.py refresh   # пересчёт множителей с наступившим unlock_at
+"""
+import json
+import os
+import sys
+import threading
+import time
+import weakref
+from collections import OrderedDict
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+BOOST_CACHE_TTL = float(os.environ.get('BOOST_CACHE_TTL', '300'))
+BOOST_CACHE_MAX_ENTRIES = int(os.environ.get('BOOST_CACHE_MAX_ENTRIES', '10000'))
+
+NOTIFY_CHANNEL = 'staking_changed'
+
+
+class BoostCache:
+    """LRU-кэш (множитель, valid_until) по user_id с ограничением по времени жизни"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._listening = weakref.WeakSet()
+
+    def get(self, user_id: str):
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry[2] <= time.monotonic():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry[0], entry[1]
+
+    def put(self, user_id: str, multiplier, valid_until):
+        with self._lock:
+            self._entries[user_id] = (multiplier, valid_until, time.monotonic() + self.ttl)
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+    def sync(self, conn) -> bool:
+        """
+        Применяет оповещения об изменении стейков, пришедшие на соединение.
+        Новое соединение подписывается на канал; пока подписка не действует,
+        кэш сбрасывается целиком. Возвращает False, если кэшу сейчас нельзя доверять.
+        """
+        if conn in self._listening:
+            conn.poll()
+            while conn.notifies:
+                self.invalidate(conn.notifies.pop(0).payload)
+            return True
+
+        if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+            return False
+        cur = conn.cursor()
+        try:
+            cur.execute(f"LISTEN {NOTIFY_CHANNEL}")
+            conn.commit()
+        finally:
+            cur.close()
+        self._listening.add(conn)
+        self.invalidate()
+        return True
+
+
+boost_cache = BoostCache(BOOST_CACHE_TTL, BOOST_CACHE_MAX_ENTRIES)
+
+
+def cached_boosts(conn, user_ids: list) -> tuple:
+    """
+    Множители из кэша процесса для списка user_id.
+    Возвращает два списка той же длины: множитель и valid_until (None — нет в кэше).
+    """
+    if not boost_cache.sync(conn):
+        return [None] * len(user_ids), [None] * len(user_ids)
+    multipliers, valid_until = [], []
+    for user_id in user_ids:
+        entry = boost_cache.get(user_id)
+        multipliers.append(entry[0] if entry else None)
+        valid_until.append(entry[1] if entry else None)
+    return multipliers, valid_until
+
+
+def refresh_expired_boosts(cur) -> int:
+    """Пересчитывает множители, у которых наступил valid_until"""
+    cur.execute("""
+        SELECT COUNT(refresh_user_boost(user_id)) AS refreshed
+        FROM user_boosts
+        WHERE valid_until <= CURRENT_TIMESTAMP
+    """)
+    return cur.fetchone()['refreshed']
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    if sys.argv[1:] != ['refresh']:
+        print('Использование: python boosts.py refresh')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        refreshed = refresh_expired_boosts(cur)
+        conn.commit()
+        print(json.dumps({'refreshed': refreshed}))
+    finally:
+        cur.close()
+        release_db_connection(conn)
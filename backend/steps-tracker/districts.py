@@ -0,0 +1,39 @@
+"""
+Битва районов: чтение рейтинга из предрасчитанных агрегатов.
+Агрегаты пополняются дельтами разборщиком outbox (события steps.synced из ingest.py)
+и отстают от синхронизаций на интервал его запуска; он же пересчитывает места в districts.rank.
+Здесь только O(число районов) чтение.
+"""
+from datetime import date, timedelta
+
+PERIODS = ('day', 'week', 'all')
+
+
+def period_start(period: str, today: date) -> date:
+    """Начало окна: сегодня для day, понедельник для week"""
+    if period == 'week':
+        return today - timedelta(days=today.weekday())
+    return today
+
+
+def district_board(cur, period: str, today: date) -> list:
+    """Рейтинг районов за окно period"""
+    if period == 'all':
+        cur.execute("""
+            SELECT name, emoji, total_steps, active_users,
+                   RANK() OVER (ORDER BY total_steps DESC) AS rank
+            FROM districts
+            ORDER BY rank, name
+        """)
+    else:
+        cur.execute("""
+            SELECT d.name, d.emoji,
+                   COALESCE(s.total_steps, 0) AS total_steps,
+                   COALESCE(s.active_users, 0) AS active_users,
+                   RANK() OVER (ORDER BY COALESCE(s.total_steps, 0) DESC) AS rank
+            FROM districts d
+            LEFT JOIN district_stats s
+                   ON s.district = d.name AND s.period = %s AND s.period_start = %s
+            ORDER BY rank, d.name
+        """, (period, period_start(period, today)))
+    return cur.fetchall()
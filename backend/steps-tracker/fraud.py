@@ -0,0 +1,35 @@
+"""
+Антифрод шагов.
+При приёме каждая синхронизация проходит дешёвую проверку правдоподобия
+(check_sync): потолок шагов за синхронизацию, длина шага по дистанции, темп
+по активным минутам и отсчётам. Дневной потолок проверяет сам INGEST_SQL:
+пользователь, который его превышает, не получает начисления, а день попадает
+в fraud_flags с source = 'ingest'.
+
+Ночная проверка истории — отдельный скрипт fraud_score.py: ему нужен NumPy,
+а приём синхронизаций импортирует только этот модуль.
+"""
+import os
+
+MAX_STEPS_PER_SYNC = int(os.environ.get('FRAUD_MAX_STEPS_PER_SYNC', '60000'))
+MAX_STEPS_PER_DAY = int(os.environ.get('FRAUD_MAX_STEPS_PER_DAY', '100000'))
+# Длина шага в метрах и темп в шагах за минуту, за пределами которых данные не похожи на ходьбу и бег
+MIN_STRIDE_M = 0.3
+MAX_STRIDE_M = 2.5
+MAX_CADENCE = 250
+STRIDE_MIN_STEPS = 500
+
+
+def check_sync(steps_count: int, distance_km: float, active_minutes: int, samples: list) -> str:
+    """Проверка правдоподобия одной синхронизации; возвращает текст ошибки или None"""
+    if steps_count > MAX_STEPS_PER_SYNC:
+        return f'Не более {MAX_STEPS_PER_SYNC} шагов за синхронизацию'
+    if distance_km > 0 and steps_count >= STRIDE_MIN_STEPS:
+        stride = distance_km * 1000 / steps_count
+        if not MIN_STRIDE_M <= stride <= MAX_STRIDE_M:
+            return 'Шаги не согласуются с дистанцией'
+    if active_minutes > 0 and steps_count / active_minutes > MAX_CADENCE:
+        return 'Шаги не согласуются с активными минутами'
+    if any(steps > MAX_CADENCE for _, _, steps in samples):
+        return f'В отсчёте samples не более {MAX_CADENCE} шагов за минуту'
+    return None
@@ -0,0 +1,239 @@
+"""
+Ночная проверка истории daily_steps на фрод.
+Векторизована в NumPy: выборка читается одним бинарным COPY прямо в массивы,
+выбросы считаются относительно собственной истории пользователя и района за
+тот же день, флаги пишутся пачками в fraud_flags с source = 'batch'.
+Правила правдоподобия и потолки общие с проверкой при приёме (fraud.py).
+    python fraud_score.py score [--days 30] [--flag-days 1]
+"""
+import io
+import json
+import os
+import sys
+import time
+import uuid
+from datetime import date, timedelta
+
+import numpy as np
+
+from fraud import (MAX_CADENCE, MAX_STEPS_PER_DAY, MAX_STRIDE_M, MIN_STRIDE_M,
+                   STRIDE_MIN_STEPS)
+
+SCORE_WINDOW_DAYS = int(os.environ.get('FRAUD_SCORE_WINDOW_DAYS', '30'))
+SCORE_FLAG_DAYS = int(os.environ.get('FRAUD_SCORE_FLAG_DAYS', '1'))
+SCORE_Z_THRESHOLD = float(os.environ.get('FRAUD_SCORE_Z_THRESHOLD', '3.5'))
+SCORE_MIN_HISTORY_DAYS = 7
+SCORE_MIN_DISTRICT_USERS = 20
+SCORE_MIN_STD = 0.1
+SAMPLES_TOLERANCE = 1.5
+SAMPLES_SLACK_STEPS = 2000
+FLAG_BATCH_SIZE = 5000
+
+# Порядок битов маски причин в score_days
+REASONS = ('daily_cap', 'stride', 'cadence', 'samples_mismatch', 'user_outlier', 'district_outlier')
+
+# Все столбцы фиксированной ширины и без NULL: бинарный COPY читается в NumPy
+# без разбора текста (см. HISTORY_FIELDS)
+HISTORY_SQL = """
+    SELECT ds.user_id,
+           COALESCE(dn.district_index, -1)::int AS district_index,
+           (ds.date - %(start)s)::int AS day_index,
+           ds.steps_count::int,
+           COALESCE(ds.distance_km, 0)::float8 AS distance_km,
+           COALESCE(ds.active_minutes, 0)::int AS active_minutes,
+           ds.sampled_steps::int,
+           ds.sample_count::int
+    FROM daily_steps ds
+    JOIN users u ON u.id = ds.user_id
+    LEFT JOIN (
+        SELECT name, (row_number() OVER (ORDER BY name) - 1)::int AS district_index FROM districts
+    ) dn ON dn.name = u.district
+    WHERE ds.date >= %(start)s AND ds.date < %(end)s
+"""
+
+# Строка бинарного COPY: число полей, затем длина и значение каждого поля (big-endian)
+HISTORY_FIELDS = [
+    ('user_id', 'V16'), ('district', '>i4'), ('day', '>i4'), ('steps', '>i4'),
+    ('distance', '>f8'), ('minutes', '>i4'), ('sampled', '>i4'), ('sample_count', '>i4'),
+]
+COPY_BINARY_HEADER = 19
+COPY_BINARY_TRAILER = 2
+
+FLAGS_SQL = """
+    INSERT INTO fraud_flags (user_id, date, source, score, reasons, details)
+    SELECT user_id, date, 'batch', score, string_to_array(reasons, ','), details
+    FROM unnest(%s::uuid[], %s::date[], %s::real[], %s::text[], %s::jsonb[])
+        AS t(user_id, date, score, reasons, details)
+    ON CONFLICT (user_id, date, source) DO UPDATE SET
+        score = EXCLUDED.score,
+        reasons = EXCLUDED.reasons,
+        details = EXCLUDED.details,
+        created_at = CURRENT_TIMESTAMP
+"""
+
+
+def _leave_one_out_z(values, groups, group_count):
+    """
+    z-оценка каждого значения относительно остальных значений своей группы.
+    Без самого значения выброс не раздувает среднее и разброс, по которым
+    его оценивают. Возвращает (z, размер группы).
+    """
+    count = np.bincount(groups, minlength=group_count)
+    total = np.bincount(groups, weights=values, minlength=group_count)
+    squares = np.bincount(groups, weights=values * values, minlength=group_count)
+    n = count[groups] - 1
+    with np.errstate(divide='ignore', invalid='ignore'):
+        mean = (total[groups] - values) / n
+        variance = (squares[groups] - values * values) / n - mean * mean
+        z = (values - mean) / np.maximum(np.sqrt(np.maximum(variance, 0)), SCORE_MIN_STD)
+    return np.where(n > 0, z, 0.0), n
+
+
+def score_days(history: dict, day_count: int):
+    """
+    Векторная оценка всех дней окна. history — столбцы load_history.
+    Возвращает (маска причин по битам REASONS, оценка, z по пользователю, z по району).
+    """
+    user, district, day = history['user'], history['district'], history['day']
+    steps, distance, minutes = history['steps'], history['distance'], history['minutes']
+    log_steps = np.log1p(steps)
+
+    z_user, days = _leave_one_out_z(log_steps, user, int(user.max()) + 1 if len(user) else 0)
+    z_user = np.where(days >= SCORE_MIN_HISTORY_DAYS, z_user, 0.0)
+
+    # Дни без района собираются в отдельную ячейку и с районами не сравниваются
+    district_count = int(district.max()) + 1 if len(district) else 0
+    has_district = district >= 0
+    cell = np.where(has_district, district * day_count + day, district_count * day_count)
+    z_district, peers = _leave_one_out_z(log_steps, cell, (district_count + 1) * day_count)
+    z_district = np.where(has_district & (peers >= SCORE_MIN_DISTRICT_USERS), z_district, 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        stride = np.where(steps > 0, distance * 1000 / steps, 0.0)
+        cadence = np.where(minutes > 0, steps / minutes, 0.0)
+    rules = (
+        steps > MAX_STEPS_PER_DAY,
+        (distance > 0) & (steps >= STRIDE_MIN_STEPS) & ((stride < MIN_STRIDE_M) | (stride > MAX_STRIDE_M)),
+        cadence > MAX_CADENCE,
+        (history['sample_count'] > 0) & (steps > history['sampled'] * SAMPLES_TOLERANCE + SAMPLES_SLACK_STEPS),
+        z_user > SCORE_Z_THRESHOLD,
+        z_district > SCORE_Z_THRESHOLD,
+    )
+    mask = np.zeros(len(steps), dtype=np.int64)
+    for bit, rule in enumerate(rules):
+        mask |= rule.astype(np.int64) << bit
+
+    # Каждое жёсткое правило весит 1, выбросы — превышение порога в долях порога
+    hard = sum(rule.astype(np.float64) for rule in rules[:4])
+    soft = np.maximum(np.maximum(z_user, z_district) / SCORE_Z_THRESHOLD, 0.0)
+    score = hard + np.where(mask >> 4 > 0, soft, 0.0)
+    return mask, score, z_user, z_district
+
+
+def load_history(conn, start: date, end: date) -> dict:
+    """
+    Окно daily_steps одним бинарным COPY. Возвращает столбцы-массивы и
+    user_ids: UUID по номеру пользователя из столбца user.
+    """
+    record = np.dtype([('field_count', '>i2')] + [
+        item for name, kind in HISTORY_FIELDS for item in ((f'{name}_length', '>i4'), (name, kind))
+    ])
+    cur = conn.cursor()
+    try:
+        buffer = io.BytesIO()
+        query = cur.mogrify(HISTORY_SQL, {'start': start, 'end': end}).decode()
+        cur.copy_expert(f'COPY ({query}) TO STDOUT WITH (FORMAT binary)', buffer)
+    finally:
+        cur.close()
+
+    raw = buffer.getbuffer()
+    count = (len(raw) - COPY_BINARY_HEADER - COPY_BINARY_TRAILER) // record.itemsize
+    rows = np.frombuffer(raw, dtype=record, count=count, offset=COPY_BINARY_HEADER)
+    user_ids, user = np.unique(rows['user_id'], return_inverse=True)
+    history = {name: rows[name].astype(np.float64) for name, _ in HISTORY_FIELDS[3:]}
+    history.update({
+        'user': user.reshape(-1).astype(np.int64),
+        'district': rows['district'].astype(np.int64),
+        'day': rows['day'].astype(np.int64),
+        'user_ids': user_ids,
+    })
+    return history
+
+
+def write_flags(conn, flags: list) -> int:
+    """Пишет флаги пачками по FLAG_BATCH_SIZE; уже разобранные флаги остаются разобранными"""
+    cur = conn.cursor()
+    try:
+        for offset in range(0, len(flags), FLAG_BATCH_SIZE):
+            batch = flags[offset:offset + FLAG_BATCH_SIZE]
+            cur.execute(FLAGS_SQL, tuple(list(column) for column in zip(*batch)))
+            conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return len(flags)
+
+
+def score_history(conn, today: date = None, window_days: int = SCORE_WINDOW_DAYS,
+                  flag_days: int = SCORE_FLAG_DAYS) -> dict:
+    """
+    Ночная проверка: оценивает окно window_days до today, флаги пишет
+    только за последние flag_days дней (остальные дни служат базой сравнения).
+    """
+    today = today or date.today()
+    start = today - timedelta(days=window_days)
+    timings = {}
+
+    started = time.perf_counter()
+    history = load_history(conn, start, today)
+    conn.commit()
+    timings['load_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    mask, score, z_user, z_district = score_days(history, window_days)
+    selected = np.flatnonzero((mask > 0) & (history['day'] >= window_days - flag_days))
+    flags = []
+    for i in selected.tolist():
+        flags.append((
+            str(uuid.UUID(bytes=history['user_ids'][history['user'][i]].tobytes())),
+            start + timedelta(days=int(history['day'][i])),
+            float(score[i]),
+            ','.join(reason for bit, reason in enumerate(REASONS) if int(mask[i]) >> bit & 1),
+            json.dumps({
+                'steps_count': int(history['steps'][i]),
+                'distance_km': float(history['distance'][i]),
+                'active_minutes': int(history['minutes'][i]),
+                'sampled_steps': int(history['sampled'][i]),
+                'z_user': round(float(z_user[i]), 2),
+                'z_district': round(float(z_district[i]), 2),
+            }),
+        ))
+    timings['score_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    started = time.perf_counter()
+    written = write_flags(conn, flags)
+    timings['write_ms'] = round((time.perf_counter() - started) * 1000, 1)
+
+    return {'rows': len(history['steps']), 'users': len(history['user_ids']), 'flagged': written, **timings}
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    args = sys.argv[1:]
+    if not args or args[0] != 'score':
+        print('Использование: python fraud_score.py score [--days 30] [--flag-days 1]')
+        sys.exit(1)
+
+    def option(name, default):
+        return int(args[args.index(name) + 1]) if name in args else default
+
+    conn = get_db_connection()
+    try:
+        report = score_history(conn, window_days=option('--days', SCORE_WINDOW_DAYS),
+                               flag_days=option('--flag-days', SCORE_FLAG_DAYS))
+        print(json.dumps(report))
+    finally:
+        release_db_connection(conn)
@@ -0,0 +1,168 @@
+"""
+История шагов: keyset-пагинация по (user_id, date) и агрегаты по неделям/месяцам.
+Все выборки идут по уникальному индексу daily_steps(user_id, date),
+агрегаты считаются в SQL, а не на клиенте.
+Месяцы старше срока хранения лежат в архиве (см. archive.py). С archive=1
+строки пользователя из архива передаются в запрос массивами и объединяются
+с daily_steps, поэтому страницы и агрегаты считаются тем же SQL.
+"""
+from datetime import date, timedelta
+from db import execute_prepared
+
+DEFAULT_LIMIT = 30
+MAX_LIMIT = 366
+GROUPS = ('week', 'month')
+
+DAYS_TEMPLATE = """
+    SELECT date::text AS date, steps_count, distance_km::float AS distance_km,
+           calories_burned, active_minutes,
+           spitak_earned::float AS spitak_earned, boost_multiplier::float AS boost_multiplier
+    FROM {source}
+    WHERE user_id = %(user_id)s::uuid
+      AND date >= COALESCE(%(date_from)s::date, '-infinity'::date)
+      AND date <= COALESCE(%(date_to)s::date, 'infinity'::date)
+      AND date < COALESCE(%(cursor)s::date, 'infinity'::date)
+    ORDER BY date DESC
+    LIMIT %(limit)s::int
+"""
+
+GROUPED_TEMPLATE = """
+    SELECT date_trunc(%(group)s::text, date)::date::text AS period_start,
+           SUM(steps_count)::bigint AS total_steps,
+           ROUND(AVG(steps_count))::int AS avg_steps,
+           SUM(distance_km)::float AS total_distance_km,
+           SUM(spitak_earned)::float AS total_spitak,
+           COUNT(*) AS active_days
+    FROM {source}
+    WHERE user_id = %(user_id)s::uuid
+      AND date >= COALESCE(%(date_from)s::date, '-infinity'::date)
+      AND date <= COALESCE(%(date_to)s::date, 'infinity'::date)
+      AND date < COALESCE(%(cursor)s::date, 'infinity'::date)
+    GROUP BY 1
+    ORDER BY 1 DESC
+    LIMIT %(limit)s::int
+"""
+
+# daily_steps пользователя вместе с архивными днями; дни, которые ещё есть в таблице, берутся из неё
+ARCHIVE_SOURCE = """(
+        SELECT user_id, date, steps_count, distance_km, calories_burned, active_minutes,
+               spitak_earned, boost_multiplier
+        FROM daily_steps
+        WHERE user_id = %(user_id)s::uuid
+        UNION ALL
+        SELECT %(user_id)s::uuid, a.*
+        FROM unnest(%(archived_date)s::date[], %(archived_steps)s::int[], %(archived_distance)s::numeric[],
+                    %(archived_calories)s::int[], %(archived_minutes)s::int[],
+                    %(archived_spitak)s::numeric[], %(archived_boost)s::numeric[])
+            AS a(date, steps_count, distance_km, calories_burned, active_minutes, spitak_earned, boost_multiplier)
+        WHERE NOT EXISTS (SELECT 1 FROM daily_steps d WHERE d.user_id = %(user_id)s::uuid AND d.date = a.date)
+    ) daily_steps"""
+
+DAYS_SQL = DAYS_TEMPLATE.format(source='daily_steps')
+GROUPED_SQL = GROUPED_TEMPLATE.format(source='daily_steps')
+ARCHIVE_DAYS_SQL = DAYS_TEMPLATE.format(source=ARCHIVE_SOURCE)
+ARCHIVE_GROUPED_SQL = GROUPED_TEMPLATE.format(source=ARCHIVE_SOURCE)
+
+# Столбцы архивной строки в порядке массивов ARCHIVE_SOURCE
+ARCHIVE_COLUMNS = (('archived_date', 'date'), ('archived_steps', 'steps_count'),
+                   ('archived_distance', 'distance_km'), ('archived_calories', 'calories_burned'),
+                   ('archived_minutes', 'active_minutes'), ('archived_spitak', 'spitak_earned'),
+                   ('archived_boost', 'boost_multiplier'))
+
+
+def _parse_date(params: dict, name: str):
+    value = params.get(name)
+    if not value:
+        return None
+    try:
+        return date.fromisoformat(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть датой в формате YYYY-MM-DD')
+
+
+def parse_history_params(params: dict) -> dict:
+    """Проверяет параметры запроса истории; ValueError с сообщением для клиента"""
+    group = params.get('group')
+    if group and group not in GROUPS:
+        raise ValueError('group должен быть week или month')
+    try:
+        limit = int(params.get('limit') or DEFAULT_LIMIT)
+    except ValueError:
+        raise ValueError('limit должен быть числом')
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f'limit должен быть от 1 до {MAX_LIMIT}')
+    return {
+        'user_id': params['user_id'],
+        'date_from': _parse_date(params, 'from'),
+        'date_to': _parse_date(params, 'to'),
+        'cursor': _parse_date(params, 'cursor'),
+        'group': group,
+        'limit': limit,
+        'archive': params.get('archive') in ('1', 'true'),
+    }
+
+
+def _period_key(day: str, group: str) -> str:
+    """Начало недели или месяца дня YYYY-MM-DD, как date_trunc в GROUPED_TEMPLATE"""
+    value = date.fromisoformat(day[:10])
+    return (value - timedelta(days=value.weekday()) if group == 'week' else value.replace(day=1)).isoformat()
+
+
+def _archived_days(cur, query: dict) -> list:
+    """
+    Архивные дни, которые могут попасть на страницу. Месяцы архива читаются от
+    новых к старым и только пока не набралось limit + 1 дней (или периодов для
+    group): более старые месяцы на страницу уже не попадут, какие бы дни ни
+    лежали в daily_steps.
+    """
+    # Архив нужен редко: модуль и его зависимости не грузятся на холодном старте
+    from archive import iter_archived
+    bounds = [day for day in (query['date_to'], query['cursor'] and query['cursor'] - timedelta(days=1)) if day]
+    archived = []
+    periods = set()
+    for _, rows in iter_archived(cur, 'daily_steps', query['user_id'], query['date_from'],
+                                 min(bounds) if bounds else None):
+        archived += rows
+        if query['group']:
+            periods.update(_period_key(row['date'], query['group']) for row in rows)
+            if len(periods) > query['limit']:
+                break
+        elif len(archived) > query['limit']:
+            break
+    return archived
+
+
+def fetch_history(cur, query: dict) -> dict:
+    """
+    Страница истории, новые записи первыми.
+    next_cursor передаётся обратно в cursor для следующей страницы.
+    """
+    limit = query['limit']
+    params = {**query, 'limit': limit + 1}
+    archived = None
+    if query['archive']:
+        archived = _archived_days(cur, query)
+        params.update({name: [row[column] for row in archived] for name, column in ARCHIVE_COLUMNS})
+
+    if query['group']:
+        if archived:
+            execute_prepared(cur, 'history_grouped_archive', ARCHIVE_GROUPED_SQL, params)
+        else:
+            execute_prepared(cur, 'history_grouped', GROUPED_SQL, params)
+        key = 'period_start'
+    else:
+        if archived:
+            execute_prepared(cur, 'history_days_archive', ARCHIVE_DAYS_SQL, params)
+        else:
+            execute_prepared(cur, 'history_days', DAYS_SQL, params)
+        key = 'date'
+    rows = cur.fetchall()
+
+    next_cursor = rows[limit - 1][key] if len(rows) > limit else None
+    result = {'next_cursor': next_cursor}
+    if query['group']:
+        result['group'] = query['group']
+        result['periods'] = rows[:limit]
+    else:
+        result['history'] = rows[:limit]
+    return result
@@ -1,33 +1,32 @@
 import json
-import os
-from datetime import datetime, date
-import psycopg2
-from psycopg2.extras import RealDictCursor
-
-def get_db_connection():
-    """Создание подключения к базе данных"""
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+from datetime import date
+from db import get_db_connection, release_db_connection
+from districts import PERIODS, district_board, period_start
+from history import fetch_history, parse_history_params
+from ingest import MAX_BATCH_SIZE, ingest_steps
+from responses import error_response, json_response, options_response
+from samples import fetch_hourly
+from sync_tokens import maybe_prune_sync_tokens
+from tracing import record_error, traced
 
+@traced('steps-tracker')
 def handler(event: dict, context) -> dict:
     """
     API для трекинга шагов и начисления токенов SPiTAK.
     Принимает количество шагов от пользователя, сохраняет в БД и начисляет токены.
     Формула: 1000 шагов = 1 $SPiTAK (с учётом boost-множителя).
+    POST с массивом items принимает пакет синхронизаций разных пользователей.
+    Необязательный sync_id делает синхронизацию идемпотентной при повторах клиента.
+    GET отдаёт историю шагов страницами (from, to, cursor, limit) или суммы по group=week|month;
+    с archive=1 в историю входят и месяцы, перенесённые в архив (см. archive.py).
+    GET с view=districts отдаёт рейтинг битвы районов за day, week или all.
+    Синхронизация может нести внутридневные отсчёты samples; GET с view=hourly
+    (user_id, date) отдаёт их почасовые суммы.
     """
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return options_response('GET, POST, OPTIONS', 'Content-Type, X-User-Id, Accept-Encoding')
     
     conn = get_db_connection()
     cur = conn.cursor()
@@ -35,143 +34,109 @@ def handler(event: dict, context) -> dict:
     try:
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
-            user_id = body.get('user_id')
-            steps_count = body.get('steps_count', 0)
-            distance_km = body.get('distance_km', 0.0)
-            calories = body.get('calories_burned', 0)
-            active_minutes = body.get('active_minutes', 0)
-            
-            if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            today = date.today()
-            
-            cur.execute("""
-                SELECT balance_spitak FROM users WHERE id = %s
-            """, (user_id,))
-            user = cur.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                SELECT boost_multiplier FROM staking 
-                WHERE user_id = %s AND is_active = true
-                ORDER BY staked_at DESC LIMIT 1
-            """, (user_id,))
-            staking = cur.fetchone()
-            boost_multiplier = staking['boost_multiplier'] if staking else 1.0
-            
-            spitak_earned = (steps_count / 1000) * boost_multiplier
-            
-            cur.execute("""
-                INSERT INTO daily_steps (user_id, date, steps_count, distance_km, calories_burned, active_minutes, spitak_earned, boost_multiplier)
-                VALUES (%s, %s, %s, %s, %s, %s, %s, %s)
-                ON CONFLICT (user_id, date) DO UPDATE SET
-                    steps_count = daily_steps.steps_count + EXCLUDED.steps_count,
-                    distance_km = daily_steps.distance_km + EXCLUDED.distance_km,
-                    calories_burned = daily_steps.calories_burned + EXCLUDED.calories_burned,
-                    active_minutes = daily_steps.active_minutes + EXCLUDED.active_minutes,
-                    spitak_earned = daily_steps.spitak_earned + EXCLUDED.spitak_earned,
-                    updated_at = CURRENT_TIMESTAMP
-                RETURNING spitak_earned
-            """, (user_id, today, steps_count, distance_km, calories, active_minutes, spitak_earned, boost_multiplier))
-            
-            result = cur.fetchone()
-            total_spitak_today = result['spitak_earned']
             
-            cur.execute("""
-                UPDATE users 
-                SET balance_spitak = balance_spitak + %s,
-                    total_earned = total_earned + %s,
-                    balance_steps = balance_steps + %s,
-                    last_activity_date = %s
-                WHERE id = %s
-                RETURNING balance_spitak, balance_steps
-            """, (spitak_earned, spitak_earned, steps_count, today, user_id))
-            
-            updated_user = cur.fetchone()
-            
-            cur.execute("""
-                INSERT INTO transactions (user_id, type, amount, currency, status, description)
-                VALUES (%s, 'mint', %s, 'SPITAK', 'completed', %s)
-            """, (user_id, spitak_earned, f'Начислено за {steps_count} шагов'))
+            if 'items' in body:
+                items = body.get('items')
+                
+                if not isinstance(items, list) or not items:
+                    return error_response(400, 'items должен быть непустым массивом')
+                
+                if len(items) > MAX_BATCH_SIZE:
+                    return error_response(400, f'Не более {MAX_BATCH_SIZE} синхронизаций за запрос')
+                
+                results = ingest_steps(cur, items)
+                conn.commit()
+                maybe_prune_sync_tokens(conn)
+                
+                processed = sum(1 for r in results if r['success'])
+                return json_response(200, {
+                    'success': processed == len(results),
+                    'processed': processed,
+                    'failed': len(results) - processed,
+                    'results': results
+                }, event)
+            
+            if not body.get('user_id'):
+                return error_response(400, 'user_id обязателен')
+            
+            result = ingest_steps(cur, [body])[0]
+            
+            if not result['success']:
+                # Отказ по дневному лимиту сохраняет флаг антифрода, остальные отказы ничего не пишут
+                if result.get('flagged'):
+                    conn.commit()
+                else:
+                    conn.rollback()
+                status = 404 if result['error'] == 'Пользователь не найден' else 400
+                return error_response(status, result['error'])
             
             conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'steps_added': steps_count,
-                    'spitak_earned': round(spitak_earned, 2),
-                    'total_spitak_today': round(total_spitak_today, 2),
-                    'balance_spitak': float(updated_user['balance_spitak']),
-                    'balance_steps': updated_user['balance_steps'],
-                    'boost_multiplier': boost_multiplier
-                }),
-                'isBase64Encoded': False
+            maybe_prune_sync_tokens(conn)
+            
+            response = {
+                'success': True,
+                'steps_added': result['steps_added'],
+                'spitak_earned': result['spitak_earned'],
+                'total_spitak_today': result['total_spitak_today'],
+                'balance_spitak': result['balance_spitak'],
+                'balance_steps': result['balance_steps'],
+                'boost_multiplier': result['boost_multiplier'],
+                'streak_days': result.get('streak_days')
             }
+            if result.get('replayed'):
+                response['replayed'] = True
+            
+            return json_response(200, response, event)
         
         elif method == 'GET':
-            user_id = event.get('queryStringParameters', {}).get('user_id')
+            params = event.get('queryStringParameters') or {}
+            
+            if params.get('view') == 'districts':
+                period = params.get('period', 'week')
+                
+                if period not in PERIODS:
+                    return error_response(400, 'period должен быть day, week или all')
+                
+                today = date.today()
+                board = district_board(cur, period, today)
+                
+                return json_response(200, {
+                    'period': period,
+                    'period_start': None if period == 'all' else period_start(period, today),
+                    'districts': board
+                }, event)
+            
+            user_id = params.get('user_id')
             
             if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                SELECT date, steps_count, spitak_earned, boost_multiplier
-                FROM daily_steps
-                WHERE user_id = %s
-                ORDER BY date DESC
-                LIMIT 30
-            """, (user_id,))
-            
-            history = cur.fetchall()
-            
-            for record in history:
-                record['date'] = record['date'].isoformat()
-                record['spitak_earned'] = float(record['spitak_earned'])
-                record['boost_multiplier'] = float(record['boost_multiplier'])
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'history': history}),
-                'isBase64Encoded': False
-            }
+                return error_response(400, 'user_id обязателен')
+            
+            if params.get('view') == 'hourly':
+                try:
+                    day = date.fromisoformat(params['date']) if params.get('date') else date.today()
+                except ValueError:
+                    return error_response(400, 'date должен быть датой в формате YYYY-MM-DD')
+                
+                return json_response(200, {'date': day, 'hours': fetch_hourly(cur, user_id, day)}, event)
+            
+            try:
+                query = parse_history_params(params)
+            except ValueError as e:
+                return error_response(400, str(e))
+            
+            try:
+                history = fetch_history(cur, query)
+            except ValueError as e:
+                return error_response(400, str(e))
+            
+            return json_response(200, history, event)
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Метод не поддерживается')
     
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        record_error(e)
+        return error_response(500, str(e))
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
@@ -0,0 +1,343 @@
+"""
+Пакетный приём шагов: одна set-based транзакция на любое число синхронизаций.
+Число запросов к БД не зависит от размера пакета. Начисления только
+дописываются в журнал transactions, строка users меняется не чаще раза в день.
+Агрегаты битвы районов и аналитика пополняются позже из события steps.synced,
+которое пишется в outbox_events тем же запросом (см. outbox.py).
+Boost-множитель берётся из кэша процесса, а при промахе — одним чтением
+user_boosts по первичному ключу. Серия дней (streak_days) продлевается тем же
+UPDATE users, когда дневная сумма шагов впервые достигает STREAK_MIN_STEPS.
+Первая за день, неделю и вообще активность для счётчиков районов определяется
+вставкой строк user_activity, а не по прочитанной строке users.
+Внутридневные отсчёты samples, если клиент их прислал, дописываются в сырое
+хранилище одним COPY в той же транзакции (см. samples.py).
+Неправдоподобные синхронизации отклоняются до запроса, а пользователи сверх
+дневного потолка шагов не получают начисления (см. fraud.py).
+"""
+import os
+import uuid
+from datetime import date, timedelta
+from boosts import boost_cache, cached_boosts
+from db import execute_prepared
+from districts import period_start
+from fraud import MAX_STEPS_PER_DAY, check_sync
+from ledger import balance_join, bump_profile_versions
+from samples import parse_samples, store_samples
+from sync_tokens import SYNC_ID_MAX_LENGTH, claim_sync_tokens, store_sync_results
+
+MAX_BATCH_SIZE = int(os.environ.get('STEPS_MAX_BATCH_SIZE', '5000'))
+STREAK_MIN_STEPS = int(os.environ.get('STREAK_MIN_STEPS', '1000'))
+
+INGEST_SQL = f"""
+    WITH input AS (
+        SELECT *
+        FROM unnest(%(user_ids)s::uuid[], %(steps)s::int[], %(distance)s::numeric[],
+                    %(calories)s::int[], %(minutes)s::int[],
+                    %(cached_boosts)s::numeric[], %(cached_valid_until)s::timestamp[])
+            AS t(user_id, steps_count, distance_km, calories_burned, active_minutes,
+                 cached_boost, cached_valid_until)
+    ),
+    totals AS (
+        SELECT user_id,
+               SUM(steps_count) AS steps_count,
+               SUM(distance_km) AS distance_km,
+               SUM(calories_burned) AS calories_burned,
+               SUM(active_minutes) AS active_minutes,
+               MAX(cached_boost) FILTER (
+                   WHERE cached_valid_until IS NULL OR cached_valid_until > CURRENT_TIMESTAMP
+               ) AS cached_boost,
+               MAX(cached_valid_until) AS cached_valid_until
+        FROM input
+        GROUP BY user_id
+    ),
+    found AS (
+        SELECT id, district, streak_days, streak_last_date FROM users
+        WHERE id IN (SELECT user_id FROM totals)
+    ),
+    boosted AS (
+        -- Из кэша без чтения таблиц; при промахе user_boosts по ключу,
+        -- а если ближайший unlock_at уже наступил — пересчёт по покрывающему индексу
+        SELECT t.user_id,
+               COALESCE(t.cached_boost, live.multiplier, ub.multiplier, 1.0) AS boost_multiplier,
+               CASE WHEN t.cached_boost IS NOT NULL THEN t.cached_valid_until
+                    WHEN live.multiplier IS NOT NULL THEN live.valid_until
+                    ELSE ub.valid_until
+               END AS boost_valid_until,
+               t.cached_boost IS NOT NULL AS boost_cached
+        FROM totals t
+        LEFT JOIN LATERAL (
+            SELECT ub.multiplier, ub.valid_until FROM user_boosts ub
+            WHERE t.cached_boost IS NULL AND ub.user_id = t.user_id
+        ) ub ON true
+        LEFT JOIN LATERAL (
+            SELECT * FROM compute_boost(t.user_id, CURRENT_TIMESTAMP::timestamp)
+            WHERE ub.valid_until <= CURRENT_TIMESTAMP
+        ) live ON true
+    ),
+    checked AS (
+        SELECT t.*, b.boost_multiplier, b.boost_valid_until, b.boost_cached,
+               ROUND(t.steps_count / 1000.0 * b.boost_multiplier, 2) AS spitak_earned,
+               COALESCE(ds.steps_count, 0) + t.steps_count > %(max_daily_steps)s::int AS over_limit,
+               COALESCE(ds.steps_count, 0) AS steps_before
+        FROM totals t
+        JOIN found f ON f.id = t.user_id
+        JOIN boosted b ON b.user_id = t.user_id
+        LEFT JOIN daily_steps ds ON ds.user_id = t.user_id AND ds.date = %(today)s::date
+    ),
+    resolved AS (
+        SELECT * FROM checked WHERE NOT over_limit
+    ),
+    limit_flags AS (
+        INSERT INTO fraud_flags (user_id, date, source, score, reasons, details)
+        SELECT user_id, %(today)s::date, 'ingest', 1, ARRAY['daily_cap'],
+               jsonb_build_object('steps_before', steps_before, 'steps_rejected', steps_count)
+        FROM checked
+        WHERE over_limit
+        ORDER BY user_id
+        ON CONFLICT (user_id, date, source) DO UPDATE SET
+            details = EXCLUDED.details,
+            created_at = CURRENT_TIMESTAMP
+    ),
+    steps AS (
+        INSERT INTO daily_steps (user_id, date, steps_count, distance_km, calories_burned, active_minutes, spitak_earned, boost_multiplier)
+        SELECT user_id, %(today)s::date, steps_count, distance_km, calories_burned, active_minutes, spitak_earned, boost_multiplier
+        FROM resolved
+        ORDER BY user_id
+        ON CONFLICT (user_id, date) DO UPDATE SET
+            steps_count = daily_steps.steps_count + EXCLUDED.steps_count,
+            distance_km = daily_steps.distance_km + EXCLUDED.distance_km,
+            calories_burned = daily_steps.calories_burned + EXCLUDED.calories_burned,
+            active_minutes = daily_steps.active_minutes + EXCLUDED.active_minutes,
+            spitak_earned = daily_steps.spitak_earned + EXCLUDED.spitak_earned,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING user_id, steps_count, spitak_earned
+    ),
+    activity AS (
+        -- Первая синхронизация за день и достижение порога серии; обе правки одним UPDATE
+        UPDATE users u
+        SET last_activity_date = %(today)s::date,
+            streak_days = CASE
+                WHEN s.steps_count < %(streak_min_steps)s::int OR u.streak_last_date = %(today)s::date THEN u.streak_days
+                WHEN u.streak_last_date = %(yesterday)s::date THEN u.streak_days + 1
+                ELSE 1
+            END,
+            streak_last_date = CASE
+                WHEN s.steps_count >= %(streak_min_steps)s::int THEN %(today)s::date
+                ELSE u.streak_last_date
+            END
+        FROM steps s
+        WHERE s.user_id = u.id
+          AND (u.last_activity_date IS DISTINCT FROM %(today)s::date
+               OR (s.steps_count >= %(streak_min_steps)s::int AND u.streak_last_date IS DISTINCT FROM %(today)s::date))
+        RETURNING u.id AS user_id, u.streak_days, u.streak_last_date
+    ),
+    first_activity AS (
+        -- Первая активность в окне day, week и вообще. Строку окна вставляет или
+        -- сдвигает на новое окно только одна из параллельных синхронизаций, поэтому
+        -- пользователь попадает в active_users района ровно один раз
+        INSERT INTO user_activity (user_id, period, period_start)
+        SELECT r.user_id, p.period, p.period_start
+        FROM resolved r
+        CROSS JOIN (VALUES ('day', %(today)s::date), ('week', %(week_start)s::date), ('all', %(today)s::date))
+            AS p(period, period_start)
+        ORDER BY 1, 2
+        ON CONFLICT (user_id, period) DO UPDATE SET period_start = EXCLUDED.period_start
+        WHERE user_activity.period <> 'all' AND user_activity.period_start < EXCLUDED.period_start
+        RETURNING user_id, period
+    ),
+    balances AS (
+        SELECT r.user_id,
+               lb.balance_spitak + r.spitak_earned AS balance_spitak,
+               lb.balance_steps + r.steps_count AS balance_steps
+        FROM resolved r
+        {balance_join('r.user_id')}
+    ),
+    minted AS (
+        INSERT INTO transactions (user_id, type, amount, currency, status, description,
+                                  delta_spitak, delta_earned, delta_steps)
+        SELECT user_id, 'mint', spitak_earned, 'SPITAK', 'completed', 'Начислено за ' || steps_count || ' шагов',
+               spitak_earned, spitak_earned, steps_count
+        FROM resolved
+    ),
+    versions AS (
+        -- Кэш профилей в функции users сверяет версию и перечитает баланс
+        {bump_profile_versions('SELECT user_id FROM resolved')}
+    ),
+    events AS (
+        -- Агрегаты районов и аналитика пополняются из outbox (см. outbox.py);
+        -- событие пишется после блокировки строки daily_steps, поэтому id событий
+        -- одного пользователя растут в порядке коммитов
+        INSERT INTO outbox_events (user_id, event_type, payload)
+        SELECT r.user_id, 'steps.synced', jsonb_build_object(
+                   'date', %(today)s::date,
+                   'week_start', %(week_start)s::date,
+                   'district', f.district,
+                   'steps', r.steps_count,
+                   'spitak', r.spitak_earned,
+                   'first_today', COALESCE(fa.first_today, false),
+                   'first_week', COALESCE(fa.first_week, false),
+                   'first_ever', COALESCE(fa.first_ever, false))
+        FROM resolved r
+        JOIN found f ON f.id = r.user_id
+        JOIN steps s ON s.user_id = r.user_id
+        LEFT JOIN (
+            SELECT user_id,
+                   bool_or(period = 'day') AS first_today,
+                   bool_or(period = 'week') AS first_week,
+                   bool_or(period = 'all') AS first_ever
+            FROM first_activity
+            GROUP BY user_id
+        ) fa ON fa.user_id = r.user_id
+        ORDER BY r.user_id
+    )
+    SELECT r.user_id::text AS user_id, r.boost_multiplier, r.boost_valid_until, r.boost_cached,
+           s.spitak_earned AS total_spitak_today,
+           b.balance_spitak, b.balance_steps,
+           CASE WHEN COALESCE(a.streak_last_date, f.streak_last_date) >= %(yesterday)s::date
+                THEN COALESCE(a.streak_days, f.streak_days)
+                ELSE 0
+           END AS streak_days,
+           false AS over_limit
+    FROM resolved r
+    JOIN found f ON f.id = r.user_id
+    JOIN steps s ON s.user_id = r.user_id
+    JOIN balances b ON b.user_id = r.user_id
+    LEFT JOIN activity a ON a.user_id = r.user_id
+    UNION ALL
+    SELECT user_id::text, boost_multiplier, boost_valid_until, boost_cached,
+           NULL, NULL, NULL, NULL, true
+    FROM checked
+    WHERE over_limit
+"""
+
+
+def _parse_item(item) -> tuple:
+    """Проверка одной синхронизации; возвращает (нормализованные поля, sync_id, ошибка)"""
+    if not isinstance(item, dict):
+        return None, None, 'Ожидается объект'
+    user_id = item.get('user_id')
+    if not user_id:
+        return None, None, 'user_id обязателен'
+    sync_id = item.get('sync_id')
+    if sync_id is not None and (not isinstance(sync_id, str) or not 0 < len(sync_id) <= SYNC_ID_MAX_LENGTH):
+        return None, None, f'sync_id должен быть строкой до {SYNC_ID_MAX_LENGTH} символов'
+    try:
+        user_id = str(uuid.UUID(str(user_id)))
+        steps_count = int(item.get('steps_count', 0))
+        distance_km = float(item.get('distance_km', 0.0))
+        calories = int(item.get('calories_burned', 0))
+        active_minutes = int(item.get('active_minutes', 0))
+    except (TypeError, ValueError):
+        return None, None, 'Некорректные данные синхронизации'
+    if min(steps_count, distance_km, calories, active_minutes) < 0:
+        return None, None, 'Значения не могут быть отрицательными'
+    try:
+        samples = parse_samples(item.get('samples'))
+    except ValueError as e:
+        return None, None, str(e)
+    error = check_sync(steps_count, distance_km, active_minutes, samples)
+    if error:
+        return None, None, error
+    return (user_id, steps_count, distance_km, calories, active_minutes, samples), sync_id, None
+
+
+def ingest_steps(cur, items: list) -> list:
+    """
+    Сохраняет пакет синхронизаций шагов и начисляет SPiTAK одним запросом.
+    Синхронизации одного пользователя в пакете суммируются.
+    Синхронизация с уже обработанным sync_id не начисляется повторно:
+    возвращается её исходный результат с пометкой replayed.
+    Возвращает результат для каждого элемента в исходном порядке.
+    """
+    results = [None] * len(items)
+    parsed = []
+    owners = {}
+    duplicates = []
+
+    for index, item in enumerate(items):
+        fields, sync_id, error = _parse_item(item)
+        if error:
+            user_id = item.get('user_id') if isinstance(item, dict) else None
+            results[index] = {'index': index, 'user_id': user_id, 'success': False, 'error': error}
+            continue
+        key = (fields[0], sync_id) if sync_id else None
+        if key in owners:
+            duplicates.append((index, owners[key]))
+            continue
+        if key:
+            owners[key] = index
+        parsed.append((index, fields, key))
+
+    # Кэш boost читается до захвата ключей: подписаться на оповещения новое
+    # соединение может только вне транзакции, а захват её открывает
+    user_ids = list({fields[0] for _, fields, _ in parsed})
+    cached = dict(zip(user_ids, zip(*cached_boosts(cur.connection, user_ids)))) if user_ids else {}
+
+    replays = claim_sync_tokens(cur, list(owners)) if owners else {}
+    fresh = []
+    for index, fields, key in parsed:
+        if key in replays:
+            results[index] = {**replays[key], 'index': index, 'replayed': True}
+        else:
+            fresh.append((index, fields, key))
+
+    if fresh:
+        today = date.today()
+        columns = list(zip(*(fields[:5] for _, fields, _ in fresh)))
+        boosts = [cached[user_id][0] for user_id in columns[0]]
+        boosts_valid_until = [cached[user_id][1] for user_id in columns[0]]
+        execute_prepared(cur, 'ingest_steps', INGEST_SQL, {
+            'user_ids': list(columns[0]),
+            'steps': list(columns[1]),
+            'distance': list(columns[2]),
+            'calories': list(columns[3]),
+            'minutes': list(columns[4]),
+            'cached_boosts': boosts,
+            'cached_valid_until': boosts_valid_until,
+            'today': today,
+            'yesterday': today - timedelta(days=1),
+            'week_start': period_start('week', today),
+            'streak_min_steps': STREAK_MIN_STEPS,
+            'max_daily_steps': MAX_STEPS_PER_DAY,
+        })
+        by_user = {row['user_id']: row for row in cur.fetchall()}
+        for row in by_user.values():
+            if not row['boost_cached'] and not row['over_limit']:
+                boost_cache.put(row['user_id'], row['boost_multiplier'], row['boost_valid_until'])
+    else:
+        by_user = {}
+
+    stored = []
+    samples = {}
+    for index, (user_id, steps_count, *_rest, item_samples), key in fresh:
+        row = by_user.get(user_id)
+        if row and item_samples and not row['over_limit']:
+            samples.setdefault(user_id, []).extend(item_samples)
+        if not row:
+            results[index] = {'index': index, 'user_id': user_id, 'success': False, 'error': 'Пользователь не найден'}
+        elif row['over_limit']:
+            results[index] = {'index': index, 'user_id': user_id, 'success': False, 'flagged': True,
+                              'error': f'Превышен дневной лимит {MAX_STEPS_PER_DAY} шагов'}
+        else:
+            boost_multiplier = float(row['boost_multiplier'])
+            results[index] = {
+                'index': index,
+                'user_id': user_id,
+                'success': True,
+                'steps_added': steps_count,
+                'spitak_earned': round(steps_count / 1000 * boost_multiplier, 2),
+                'total_spitak_today': float(row['total_spitak_today']),
+                'balance_spitak': float(row['balance_spitak']),
+                'balance_steps': row['balance_steps'],
+                'boost_multiplier': boost_multiplier,
+                'streak_days': row['streak_days'],
+            }
+        if key:
+            stored.append((key[0], key[1], results[index]))
+    store_sync_results(cur, stored)
+    store_samples(cur, samples)
+
+    for index, owner in duplicates:
+        results[index] = {**results[owner], 'index': index, 'replayed': True}
+
+    return results
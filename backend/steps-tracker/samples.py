@@ -0,0 +1,224 @@
+"""
+Сырые внутридневные отсчёты шагов (samples) и их свёртка.
+Отсчёты приходят в синхронизации массивом samples: [{"at": "2026-10-17T08:15", "steps": 120}, ...].
+Они пишутся одним COPY в дневные секции step_samples — по строке с массивами
+минут и шагов на пользователя и день. Начисление по-прежнему идёт по steps_count
+синхронизации, поэтому ответ POST не меняется.
+
+Фоновые задачи:
+    python samples.py rollup    # новые отсчёты в step_hourly и daily_steps.sampled_steps
+    python samples.py maintain  # секции наперёд, сжатие старых дней, удаление по сроку
+"""
+import io
+import json
+import os
+import sys
+from datetime import date, datetime, timedelta
+
+SAMPLES_MAX_PER_SYNC = int(os.environ.get('STEP_SAMPLES_MAX_PER_SYNC', '1440'))
+SAMPLES_MAX_AGE_DAYS = int(os.environ.get('STEP_SAMPLES_MAX_AGE_DAYS', '7'))
+SAMPLES_CLOCK_SKEW_SECONDS = 300
+ROLLUP_LAG_SECONDS = int(os.environ.get('STEP_ROLLUP_LAG_SECONDS', '60'))
+ROLLUP_WINDOW_SECONDS = int(os.environ.get('STEP_ROLLUP_WINDOW_SECONDS', '3600'))
+COMPACT_AFTER_DAYS = int(os.environ.get('STEP_SAMPLES_COMPACT_AFTER_DAYS', '2'))
+RETENTION_DAYS = int(os.environ.get('STEP_SAMPLES_RETENTION_DAYS', '90'))
+PARTITION_DAYS_AHEAD = int(os.environ.get('STEP_SAMPLES_PARTITION_DAYS_AHEAD', '3'))
+
+ROLLUP_SQL = """
+    WITH batch AS (
+        SELECT s.user_id, s.sample_date, x.minute, x.steps
+        FROM step_samples s, unnest(s.minutes, s.steps) AS x(minute, steps)
+        WHERE s.received_at > %(since)s AND s.received_at <= %(until)s
+    ),
+    hourly AS (
+        INSERT INTO step_hourly (user_id, date, hour, steps_count, sample_count)
+        SELECT user_id, sample_date, minute / 60, SUM(steps), COUNT(*)
+        FROM batch
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (user_id, date, hour) DO UPDATE SET
+            steps_count = step_hourly.steps_count + EXCLUDED.steps_count,
+            sample_count = step_hourly.sample_count + EXCLUDED.sample_count
+    ),
+    daily AS (
+        INSERT INTO daily_steps (user_id, date, sampled_steps, sample_count)
+        SELECT user_id, sample_date, SUM(steps), COUNT(*)
+        FROM batch
+        GROUP BY 1, 2
+        -- Дни из одних нулевых отсчётов не заводят пустых строк в истории
+        HAVING SUM(steps) > 0
+        ORDER BY 1, 2
+        ON CONFLICT (user_id, date) DO UPDATE SET
+            sampled_steps = daily_steps.sampled_steps + EXCLUDED.sampled_steps,
+            sample_count = daily_steps.sample_count + EXCLUDED.sample_count,
+            updated_at = CURRENT_TIMESTAMP
+        RETURNING 1
+    ),
+    mark AS (
+        UPDATE step_sample_rollup SET rolled_until = %(until)s
+    )
+    SELECT (SELECT COUNT(*) FROM batch) AS samples, (SELECT COUNT(*) FROM daily) AS days
+"""
+
+
+def parse_samples(samples, now: datetime = None) -> list:
+    """
+    Проверяет массив samples синхронизации; ValueError с сообщением для клиента.
+    Возвращает (дата, минута суток, шаги). Отсчёты старше SAMPLES_MAX_AGE_DAYS
+    и из будущего отклоняются: для них нет секций.
+    """
+    if samples is None:
+        return []
+    if not isinstance(samples, list) or len(samples) > SAMPLES_MAX_PER_SYNC:
+        raise ValueError(f'samples должен быть массивом до {SAMPLES_MAX_PER_SYNC} отсчётов')
+    now = now or datetime.now()
+    earliest = now.date() - timedelta(days=SAMPLES_MAX_AGE_DAYS)
+    latest = now + timedelta(seconds=SAMPLES_CLOCK_SKEW_SECONDS)
+    parsed = []
+    for sample in samples:
+        try:
+            at = datetime.fromisoformat(sample['at'])
+            steps = int(sample['steps'])
+        except (KeyError, TypeError, ValueError):
+            raise ValueError('Каждый отсчёт samples — объект с at (ISO 8601) и steps')
+        if at.tzinfo is not None:
+            at = at.astimezone().replace(tzinfo=None)
+        if steps < 0 or not earliest <= at.date() or at > latest:
+            raise ValueError(f'Отсчёты samples должны быть за последние {SAMPLES_MAX_AGE_DAYS} дней, шаги — неотрицательны')
+        parsed.append((at.date(), at.hour * 60 + at.minute, steps))
+    return parsed
+
+
+def store_samples(cur, samples_by_user: dict) -> int:
+    """
+    Пишет отсчёты одним COPY: строка на пользователя и день, минуты по возрастанию.
+    samples_by_user: user_id -> список (дата, минута, шаги). Возвращает число строк.
+    """
+    rows = {}
+    for user_id, samples in samples_by_user.items():
+        for sample_date, minute, steps in samples:
+            rows.setdefault((user_id, sample_date), []).append((minute, steps))
+    if not rows:
+        return 0
+
+    buffer = io.StringIO()
+    for (user_id, sample_date), points in rows.items():
+        points.sort()
+        minutes = ','.join(str(minute) for minute, _ in points)
+        steps = ','.join(str(count) for _, count in points)
+        buffer.write(f'{user_id}\t{sample_date.isoformat()}\t{{{minutes}}}\t{{{steps}}}\n')
+    buffer.seek(0)
+    cur.copy_expert('COPY step_samples (user_id, sample_date, minutes, steps) FROM STDIN', buffer)
+    return len(rows)
+
+
+def rollup_samples(conn, lag_seconds: int = ROLLUP_LAG_SECONDS,
+                   window_seconds: int = ROLLUP_WINDOW_SECONDS) -> dict:
+    """
+    Сворачивает принятые отсчёты окнами по времени приёма, каждое окно в своей
+    транзакции. Граница отстаёт на lag_seconds, чтобы не пропустить синхронизации,
+    которые начались раньше неё, но ещё не закоммичены. Параллельные запуски
+    ждут друг друга на строке step_sample_rollup.
+    """
+    report = {'windows': 0, 'samples': 0, 'days': 0}
+    cur = conn.cursor()
+    try:
+        # Граница фиксируется на весь запуск, иначе свёртка догоняла бы текущее время
+        cur.execute("SELECT (CURRENT_TIMESTAMP - make_interval(secs => %s))::timestamp AS cutoff", (lag_seconds,))
+        cutoff = cur.fetchone()['cutoff']
+        conn.commit()
+        while True:
+            cur.execute("SELECT rolled_until FROM step_sample_rollup FOR UPDATE")
+            rolled_until = cur.fetchone()['rolled_until']
+            if rolled_until >= cutoff:
+                conn.rollback()
+                report['rolled_until'] = rolled_until
+                return report
+            until = min(cutoff, rolled_until + timedelta(seconds=window_seconds))
+            cur.execute(ROLLUP_SQL, {'since': rolled_until, 'until': until})
+            result = cur.fetchone()
+            conn.commit()
+            report['windows'] += 1
+            report['samples'] += result['samples']
+            report['days'] += result['days']
+    finally:
+        cur.close()
+
+
+def maintain_partitions(conn, today: date = None) -> dict:
+    """
+    Создаёт секции наперёд, сжимает дни старше COMPACT_AFTER_DAYS и удаляет
+    дни старше RETENTION_DAYS. Сжимаются и удаляются только дни, отсчёты
+    которых уже свёрнуты.
+    """
+    today = today or date.today()
+    report = {'partitions_created': 0, 'days_compacted': 0, 'partitions_dropped': 0}
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT ensure_step_sample_partitions(%s, %s) AS created",
+                    (today - timedelta(days=SAMPLES_MAX_AGE_DAYS), PARTITION_DAYS_AHEAD))
+        report['partitions_created'] = cur.fetchone()['created']
+        conn.commit()
+
+        cur.execute("SELECT rolled_until FROM step_sample_rollup")
+        watermark = cur.fetchone()['rolled_until']
+        cur.execute("""
+            SELECT d::date AS day
+            FROM generate_series(%s::date, %s::date, INTERVAL '1 day') AS d
+            WHERE to_regclass('step_samples_' || to_char(d, 'YYYYMMDD')) IS NOT NULL
+              AND NOT EXISTS (SELECT 1 FROM step_sample_compactions c WHERE c.sample_date = d::date)
+            ORDER BY 1
+        """, (today - timedelta(days=RETENTION_DAYS), today - timedelta(days=COMPACT_AFTER_DAYS + 1)))
+        for row in cur.fetchall():
+            day = row['day']
+            partition = f"step_samples_{day.strftime('%Y%m%d')}"
+            cur.execute(f"SELECT COUNT(*) AS rows_before FROM {partition}")
+            rows_before = cur.fetchone()['rows_before']
+            rows_after = 0
+            if rows_before:
+                cur.execute("SELECT compact_step_samples(%s, %s) AS rows_after", (day, watermark))
+                rows_after = cur.fetchone()['rows_after']
+            cur.execute("""
+                INSERT INTO step_sample_compactions (sample_date, rows_before, rows_after)
+                VALUES (%s, %s, %s)
+            """, (day, rows_before, rows_after))
+            conn.commit()
+            report['days_compacted'] += 1
+
+        cur.execute("SELECT drop_step_sample_partitions(LEAST(%s::date, %s::date)) AS dropped",
+                    (today - timedelta(days=RETENTION_DAYS), watermark.date()))
+        report['partitions_dropped'] = cur.fetchone()['dropped']
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+    return report
+
+
+def fetch_hourly(cur, user_id: str, day: date) -> list:
+    """Почасовые суммы шагов за день по свёрнутым отсчётам"""
+    cur.execute("""
+        SELECT hour, steps_count, sample_count
+        FROM step_hourly
+        WHERE user_id = %s AND date = %s
+        ORDER BY hour
+    """, (user_id, day))
+    return cur.fetchall()
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command not in ('rollup', 'maintain'):
+        print('Использование: python samples.py rollup | maintain')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    try:
+        report = rollup_samples(conn) if command == 'rollup' else maintain_partitions(conn)
+        print(json.dumps(report, default=str))
+    finally:
+        release_db_connection(conn)
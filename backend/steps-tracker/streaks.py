@@ -0,0 +1,58 @@
+"""
+Ночной сброс прерванных серий дней.
+Серия продлевается при синхронизации шагов (см. ingest.py). Здесь обнуляются
+серии тех, у кого последний засчитанный день раньше вчерашнего. Поиск идёт по
+частичному индексу idx_users_streak_last_date, обновление — пачками по ключу,
+каждая пачка в своей транзакции, чтобы не держать блокировки строк users долго.
+
+    python streaks.py reset
+"""
+import json
+import os
+import sys
+from datetime import date, timedelta
+
+STREAK_RESET_BATCH = int(os.environ.get('STREAK_RESET_BATCH', '50000'))
+
+
+def reset_broken_streaks(conn, today: date = None, batch_size: int = STREAK_RESET_BATCH) -> int:
+    """Обнуляет прерванные серии; возвращает число затронутых пользователей"""
+    today = today or date.today()
+    cutoff = today - timedelta(days=1)
+    total = 0
+    cur = conn.cursor()
+    try:
+        while True:
+            cur.execute("""
+                WITH batch AS (
+                    SELECT id FROM users
+                    WHERE streak_days > 0 AND streak_last_date < %s
+                    LIMIT %s
+                    FOR UPDATE SKIP LOCKED
+                )
+                UPDATE users u
+                SET streak_days = 0
+                FROM batch
+                WHERE u.id = batch.id
+            """, (cutoff, batch_size))
+            reset = cur.rowcount
+            conn.commit()
+            total += reset
+            if reset < batch_size:
+                return total
+    finally:
+        cur.close()
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    if sys.argv[1:] != ['reset']:
+        print('Использование: python streaks.py reset')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    try:
+        print(json.dumps({'streaks_reset': reset_broken_streaks(conn)}))
+    finally:
+        release_db_connection(conn)
@@ -0,0 +1,110 @@
+"""
+Идемпотентность синхронизаций шагов по клиентскому sync_id.
+Первый запрос с ключом захватывает его и сохраняет свой результат в той же
+транзакции; повтор находит ключ по первичному индексу и получает исходный
+результат, не трогая users и transactions.
+Сохраняются только успешные результаты: ключ неудачной синхронизации
+освобождается, и повтор клиента обрабатывается заново.
+"""
+import json
+import os
+import random
+from db import execute_prepared
+
+SYNC_ID_MAX_LENGTH = 64
+SYNC_TOKEN_RETENTION_DAYS = int(os.environ.get('SYNC_TOKEN_RETENTION_DAYS', '7'))
+SYNC_TOKEN_PRUNE_BATCH = int(os.environ.get('SYNC_TOKEN_PRUNE_BATCH', '1000'))
+SYNC_TOKEN_PRUNE_PROBABILITY = float(os.environ.get('SYNC_TOKEN_PRUNE_PROBABILITY', '0.01'))
+
+
+def claim_sync_tokens(cur, keys: list) -> dict:
+    """
+    Захватывает ключи (user_id, sync_id).
+    Возвращает сохранённые результаты для ключей, которые уже были успешно обработаны.
+    """
+    user_ids = [k[0] for k in keys]
+    sync_ids = [k[1] for k in keys]
+    execute_prepared(cur, 'claim_sync_tokens', """
+        WITH claims AS (
+            SELECT * FROM unnest(%s::uuid[], %s::text[]) AS t(user_id, sync_id)
+        ),
+        claimed AS (
+            INSERT INTO step_sync_tokens (user_id, sync_id)
+            SELECT user_id, sync_id FROM claims
+            ORDER BY user_id, sync_id
+            ON CONFLICT (user_id, sync_id) DO NOTHING
+            RETURNING user_id, sync_id
+        )
+        SELECT c.user_id::text AS user_id, c.sync_id, t.result
+        FROM claims c
+        LEFT JOIN step_sync_tokens t ON t.user_id = c.user_id AND t.sync_id = c.sync_id
+        WHERE NOT EXISTS (
+            SELECT 1 FROM claimed cl WHERE cl.user_id = c.user_id AND cl.sync_id = c.sync_id
+        )
+    """, (user_ids, sync_ids))
+    replays = {(row['user_id'], row['sync_id']): row['result'] for row in cur.fetchall()}
+
+    # Ключ закоммитила параллельная транзакция уже после снимка нашего запроса
+    pending = [k for k, result in replays.items() if result is None]
+    if pending:
+        cur.execute("""
+            SELECT t.user_id::text AS user_id, t.sync_id, t.result
+            FROM step_sync_tokens t
+            JOIN unnest(%s::uuid[], %s::text[]) AS k(user_id, sync_id)
+              ON t.user_id = k.user_id AND t.sync_id = k.sync_id
+        """, ([k[0] for k in pending], [k[1] for k in pending]))
+        for row in cur.fetchall():
+            replays[(row['user_id'], row['sync_id'])] = row['result']
+
+    # Параллельная попытка не удалась и освободила ключ: синхронизация обрабатывается заново
+    return {key: result for key, result in replays.items() if result is not None}
+
+
+def store_sync_results(cur, entries: list):
+    """
+    Сохраняет результаты успешно обработанных ключей и освобождает ключи
+    неудачных синхронизаций, чтобы повтор не получил прежний отказ
+    """
+    stored = [e for e in entries if e[2]['success']]
+    released = [e for e in entries if not e[2]['success']]
+    if stored:
+        cur.execute("""
+            UPDATE step_sync_tokens t SET result = e.result
+            FROM unnest(%s::uuid[], %s::text[], %s::jsonb[]) AS e(user_id, sync_id, result)
+            WHERE t.user_id = e.user_id AND t.sync_id = e.sync_id
+        """, (
+            [e[0] for e in stored],
+            [e[1] for e in stored],
+            [json.dumps(e[2]) for e in stored],
+        ))
+    if released:
+        cur.execute("""
+            DELETE FROM step_sync_tokens t
+            USING unnest(%s::uuid[], %s::text[]) AS e(user_id, sync_id)
+            WHERE t.user_id = e.user_id AND t.sync_id = e.sync_id
+        """, ([e[0] for e in released], [e[1] for e in released]))
+
+
+def prune_sync_tokens(cur, retention_days: int = SYNC_TOKEN_RETENTION_DAYS, limit: int = SYNC_TOKEN_PRUNE_BATCH) -> int:
+    """Удаляет не больше limit ключей старше срока хранения"""
+    cur.execute("""
+        DELETE FROM step_sync_tokens
+        WHERE ctid = ANY(ARRAY(
+            SELECT ctid FROM step_sync_tokens
+            WHERE created_at < CURRENT_TIMESTAMP - make_interval(days => %s)
+            LIMIT %s
+        ))
+    """, (retention_days, limit))
+    return cur.rowcount
+
+
+def maybe_prune_sync_tokens(conn):
+    """Изредка, после основной транзакции, чистит одну порцию устаревших ключей"""
+    if random.random() >= SYNC_TOKEN_PRUNE_PROBABILITY:
+        return
+    cur = conn.cursor()
+    try:
+        prune_sync_tokens(cur)
+        conn.commit()
+    finally:
+        cur.close()
@@ -1,36 +1,63 @@
 import json
-import os
-import secrets
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from datetime import date, timedelta
+from db import execute_prepared, get_db_connection, release_db_connection
+from ledger import balance_join, bump_profile_versions, fetch_balances
+from profile_cache import profile_cache, profile_etag
+from referrals import (DOWNLINE_MAX_PAGE_SIZE, DOWNLINE_PAGE_SIZE, TOP_REFERRERS_MAX_LIMIT, fetch_downline,
+                       fetch_stats, fetch_top_referrers, parse_int)
+from registration import REFERRAL_MAX_DEPTH, register_users
+from responses import body_response, empty_response, error_response, get_header, json_response, options_response
+from tracing import record_error, traced
 
-def get_db_connection():
-    """Создание подключения к базе данных"""
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+PROFILE_SQL = f"""
+    SELECT u.id, u.phone_number, u.full_name, u.username, u.wallet_address, u.referral_code,
+           u.is_kyc_verified, u.kyc_tier, lb.balance_steps::int AS balance_steps,
+           lb.balance_spitak, lb.total_earned,
+           CASE WHEN u.streak_last_date >= CURRENT_DATE - 1 THEN u.streak_days ELSE 0 END AS streak_days,
+           u.last_activity_date, u.district, u.avatar_url, u.created_at,
+           COALESCE(pv.version, 0) AS version
+    FROM users u
+    LEFT JOIN profile_versions pv ON pv.user_id = u.id
+    {balance_join('u.id')}
+    WHERE u.id = %s::uuid
+"""
 
-def generate_referral_code():
-    """Генерация уникального реферального кода"""
-    return secrets.token_urlsafe(6).upper()[:8]
+# Поля профиля в порядке PROFILE_SQL: по ним PUT собирает запись кэша
+PROFILE_FIELDS = ('id', 'phone_number', 'full_name', 'username', 'wallet_address', 'referral_code',
+                  'is_kyc_verified', 'kyc_tier', 'balance_steps', 'balance_spitak', 'total_earned',
+                  'streak_days', 'last_activity_date', 'district', 'avatar_url', 'created_at')
 
+# Нет строки — нет пользователя: 404 отдаётся раньше сравнения с If-None-Match
+PROFILE_VERSION_SQL = """
+    SELECT COALESCE(pv.version, 0) AS version
+    FROM users u
+    LEFT JOIN profile_versions pv ON pv.user_id = u.id
+    WHERE u.id = %s::uuid
+"""
+
+def profile_response(event: dict, entry: dict) -> dict:
+    """Ответ из записи кэша профилей; 304 если у клиента актуальная версия"""
+    headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache'}
+    if get_header(event, 'If-None-Match') == entry['etag']:
+        return empty_response(304, headers)
+    return body_response(200, entry['body'], event, headers)
+
+@traced('users')
 def handler(event: dict, context) -> dict:
     """
     API для работы с пользователями: регистрация, получение профиля, обновление данных.
-    При регистрации автоматически создаётся реферальный код.
+    При регистрации автоматически создаётся реферальный код; регистрация вместе
+    с реферальным бонусом выполняется одним запросом.
+    Балансы считаются по журналу транзакций: снимок плюс записи после него.
+    Профиль отдаётся из кэша контейнера, если не изменилась его версия; ответ
+    содержит version и ETag, на If-None-Match с актуальной версией — 304.
+    GET с view=downline (depth, limit, cursor), view=referral_stats или
+    view=top_referrers (by=direct|downline|earned, limit) отдаёт аналитику рефералов.
     """
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, PUT, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return options_response('GET, POST, PUT, OPTIONS', 'Content-Type, X-User-Id, If-None-Match, Accept-Encoding', 'ETag')
     
     conn = get_db_connection()
     cur = conn.cursor()
@@ -39,122 +66,92 @@ def handler(event: dict, context) -> dict:
         if method == 'POST':
             body = json.loads(event.get('body', '{}'))
             phone_number = body.get('phone_number')
-            full_name = body.get('full_name')
-            district = body.get('district')
-            referred_by_code = body.get('referral_code')
             
             if not phone_number:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'phone_number обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT id FROM users WHERE phone_number = %s", (phone_number,))
-            existing = cur.fetchone()
-            
-            if existing:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь с таким номером уже существует'}),
-                    'isBase64Encoded': False
-                }
-            
-            referral_code = generate_referral_code()
-            referred_by_id = None
-            
-            if referred_by_code:
-                cur.execute("SELECT id FROM users WHERE referral_code = %s", (referred_by_code,))
-                referrer = cur.fetchone()
-                if referrer:
-                    referred_by_id = referrer['id']
-            
-            cur.execute("""
-                INSERT INTO users (phone_number, full_name, district, referral_code, referred_by)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id, phone_number, full_name, referral_code, balance_spitak, balance_steps, created_at
-            """, (phone_number, full_name, district, referral_code, referred_by_id))
+                return error_response(400, 'phone_number обязателен')
             
-            user = cur.fetchone()
+            created = register_users(cur, [{
+                'phone_number': phone_number,
+                'full_name': body.get('full_name'),
+                'district': body.get('district'),
+                'referral_code': body.get('referral_code'),
+            }])
             
-            if referred_by_id:
-                bonus_amount = 5.0
-                
-                cur.execute("""
-                    UPDATE users SET balance_spitak = balance_spitak + %s
-                    WHERE id = %s
-                """, (bonus_amount, referred_by_id))
-                
-                cur.execute("""
-                    INSERT INTO referrals (referrer_id, referred_user_id, bonus_spitak)
-                    VALUES (%s, %s, %s)
-                """, (referred_by_id, user['id'], bonus_amount))
+            if not created:
+                conn.rollback()
+                return error_response(400, 'Пользователь с таким номером уже существует')
             
+            user = created[0]
             conn.commit()
             
-            user['balance_spitak'] = float(user['balance_spitak'])
-            user['created_at'] = user['created_at'].isoformat()
-            
-            return {
-                'statusCode': 201,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'user': user}),
-                'isBase64Encoded': False
-            }
+            return json_response(201, {'user': user}, event)
         
         elif method == 'GET':
-            user_id = event.get('queryStringParameters', {}).get('user_id')
+            params = event.get('queryStringParameters') or {}
+            user_id = params.get('user_id')
+            view = params.get('view')
+            
+            if view == 'top_referrers':
+                try:
+                    top = fetch_top_referrers(cur, params.get('by', 'direct'),
+                                              parse_int(params, 'limit', 20, TOP_REFERRERS_MAX_LIMIT))
+                except ValueError as e:
+                    return error_response(400, str(e))
+                return json_response(200, {'top_referrers': top}, event)
             
             if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                SELECT id, phone_number, full_name, username, wallet_address, referral_code,
-                       is_kyc_verified, kyc_tier, balance_steps, balance_spitak, total_earned,
-                       streak_days, last_activity_date, district, avatar_url, created_at
-                FROM users WHERE id = %s
-            """, (user_id,))
-            
-            user = cur.fetchone()
+                return error_response(400, 'user_id обязателен')
+            
+            if view == 'downline':
+                try:
+                    downline = fetch_downline(cur, user_id,
+                                              parse_int(params, 'depth', REFERRAL_MAX_DEPTH, REFERRAL_MAX_DEPTH),
+                                              parse_int(params, 'limit', DOWNLINE_PAGE_SIZE, DOWNLINE_MAX_PAGE_SIZE),
+                                              params.get('cursor'))
+                except ValueError as e:
+                    return error_response(400, str(e))
+                return json_response(200, downline, event)
+            
+            if view == 'referral_stats':
+                stats = fetch_stats(cur, user_id)
+                if not stats:
+                    return error_response(404, 'Пользователь не найден')
+                return json_response(200, {'referral_stats': stats}, event)
+            
+            # Версию проверяем, только если есть что сверять: запись кэша или ETag клиента
+            entry = profile_cache.get(user_id)
+            if_none_match = get_header(event, 'If-None-Match')
+            if entry is not None or if_none_match:
+                execute_prepared(cur, 'profile_version', PROFILE_VERSION_SQL, (user_id,))
+                row = cur.fetchone()
+                if row is None:
+                    profile_cache.invalidate(user_id)
+                    return error_response(404, 'Пользователь не найден')
+                version = row['version']
+                etag = profile_etag(version, date.today())
+                if if_none_match == etag:
+                    return empty_response(304, {'ETag': etag, 'Cache-Control': 'no-cache'})
+                if entry is not None and entry['version'] != version:
+                    entry = None
+            
+            if entry is None:
+                execute_prepared(cur, 'user_profile', PROFILE_SQL, (user_id,))
+                
+                user = cur.fetchone()
+                
+                if not user:
+                    return error_response(404, 'Пользователь не найден')
+                
+                entry = profile_cache.put(user_id, user.pop('version'), user)
             
-            if not user:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            user['balance_spitak'] = float(user['balance_spitak'])
-            user['total_earned'] = float(user['total_earned'])
-            user['last_activity_date'] = user['last_activity_date'].isoformat() if user['last_activity_date'] else None
-            user['created_at'] = user['created_at'].isoformat()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'user': user}),
-                'isBase64Encoded': False
-            }
+            return profile_response(event, entry)
         
         elif method == 'PUT':
             body = json.loads(event.get('body', '{}'))
             user_id = body.get('user_id')
             
             if not user_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id обязателен'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'user_id обязателен')
             
             updates = []
             params = []
@@ -173,45 +170,49 @@ def handler(event: dict, context) -> dict:
                 params.append(body['avatar_url'])
             
             if not updates:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Нет данных для обновления'}),
-                    'isBase64Encoded': False
-                }
+                return error_response(400, 'Нет данных для обновления')
             
             params.append(user_id)
-            query = f"UPDATE users SET {', '.join(updates)} WHERE id = %s RETURNING *"
+            query = f"""
+                WITH updated AS (
+                    UPDATE users SET {', '.join(updates)} WHERE id = %s RETURNING *
+                ),
+                versions AS (
+                    {bump_profile_versions('SELECT id AS user_id FROM updated')}
+                    RETURNING version
+                )
+                SELECT updated.*, versions.version FROM updated, versions
+            """
             
             cur.execute(query, params)
             user = cur.fetchone()
+            
+            if not user:
+                conn.rollback()
+                return error_response(404, 'Пользователь не найден')
+            
+            balances = fetch_balances(cur, [user['id']])[user['id']]
             conn.commit()
             
-            user['balance_spitak'] = float(user['balance_spitak'])
-            user['total_earned'] = float(user['total_earned'])
+            user['balance_spitak'] = balances['balance_spitak']
+            user['total_earned'] = balances['total_earned']
+            user['balance_steps'] = balances['balance_steps']
+            streak_last_date = user.pop('streak_last_date')
+            if not streak_last_date or streak_last_date < date.today() - timedelta(days=1):
+                user['streak_days'] = 0
+            
+            version = user.pop('version')
+            profile_cache.put(user_id, version, {field: user[field] for field in PROFILE_FIELDS})
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'user': user}),
-                'isBase64Encoded': False
-            }
+            return json_response(200, {'user': user, 'version': version}, event,
+                                 {'ETag': profile_etag(version, date.today())})
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Метод не поддерживается')
     
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        record_error(e)
+        return error_response(500, str(e))
     finally:
         cur.close()
-        conn.close()
+        release_db_connection(conn)
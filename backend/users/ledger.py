@@ -0,0 +1,204 @@
+"""
+Журнал транзакций и производные балансы.
+Каждое начисление и списание — это только INSERT в transactions с дельтами
+delta_spitak / delta_earned / delta_steps. Баланс пользователя равен снимку
+из balance_snapshots плюс сумме дельт, записанных после снимка.
+Выражения, меняющие баланс, тем же запросом увеличивают версию профиля
+в profile_versions (bump_profile_versions), по ней сверяется кэш профилей.
+Записи старше срока архивируются (см. steps-tracker/archive.py); их дельты
+остаются в ledger_archive_totals и учитываются при проверке и перестроении снимков.
+
+Фоновые задачи:
+    python ledger.py snapshot          # новые снимки и секции журнала на будущие месяцы
+    python ledger.py verify [--repair] # пересчёт балансов по всему журналу
+"""
+import json
+import os
+import sys
+
+SNAPSHOT_LAG_SECONDS = int(os.environ.get('LEDGER_SNAPSHOT_LAG_SECONDS', '300'))
+PARTITION_MONTHS_AHEAD = int(os.environ.get('LEDGER_PARTITION_MONTHS_AHEAD', '3'))
+
+
+def balance_join(user_expr: str) -> str:
+    """
+    Фрагмент FROM с балансом пользователя user_expr в алиасе lb
+    (balance_spitak, total_earned, balance_steps): снимок плюс хвост журнала.
+    """
+    return f"""
+        LEFT JOIN balance_snapshots bs ON bs.user_id = {user_expr}
+        CROSS JOIN LATERAL (
+            SELECT COALESCE(bs.balance_spitak, 0) + COALESCE(SUM(t.delta_spitak), 0) AS balance_spitak,
+                   COALESCE(bs.total_earned, 0) + COALESCE(SUM(t.delta_earned), 0) AS total_earned,
+                   (COALESCE(bs.balance_steps, 0) + COALESCE(SUM(t.delta_steps), 0))::bigint AS balance_steps
+            FROM transactions t
+            WHERE t.user_id = {user_expr}
+              AND t.created_at >= COALESCE(bs.covered_until, '-infinity'::timestamp)
+        ) lb
+    """
+
+
+def bump_profile_versions(user_ids_sql: str) -> str:
+    """
+    INSERT, увеличивающий версию профиля пользователей из подзапроса user_ids_sql
+    (колонка user_id); встраивается CTE в выражение, которое меняет баланс,
+    чтобы кэши профилей в функции users не отдавали старый баланс.
+    """
+    return f"""
+        INSERT INTO profile_versions (user_id)
+        SELECT DISTINCT user_id FROM ({user_ids_sql}) changed
+        ORDER BY user_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            version = profile_versions.version + 1,
+            updated_at = CURRENT_TIMESTAMP
+    """
+
+
+def fetch_balances(cur, user_ids: list) -> dict:
+    """Текущие балансы пользователей по журналу"""
+    cur.execute(f"""
+        SELECT u.id::text AS user_id, lb.balance_spitak, lb.total_earned, lb.balance_steps
+        FROM users u
+        {balance_join('u.id')}
+        WHERE u.id = ANY(%s::uuid[])
+    """, (list(user_ids),))
+    return {row['user_id']: row for row in cur.fetchall()}
+
+
+def lock_balance(cur, user_id: str):
+    """
+    Сериализует списания одного пользователя до конца транзакции.
+    Начисления блокировку не берут: они только увеличивают баланс.
+    """
+    cur.execute("SELECT pg_advisory_xact_lock(hashtextextended('balance:' || %s, 0))", (str(user_id),))
+
+
+def ensure_partitions(cur, months_ahead: int = PARTITION_MONTHS_AHEAD) -> int:
+    """Создаёт месячные секции журнала наперёд"""
+    cur.execute("SELECT ensure_transaction_partitions(CURRENT_DATE, %s) AS created", (months_ahead,))
+    return cur.fetchone()['created']
+
+
+def take_snapshots(cur, lag_seconds: int = SNAPSHOT_LAG_SECONDS) -> int:
+    """
+    Сворачивает хвосты журнала в снимки.
+    Граница отстаёт от текущего времени на lag_seconds, чтобы не пропустить
+    транзакции, которые начались раньше границы, но ещё не закоммичены.
+    """
+    cur.execute("""
+        WITH cutoff AS (
+            SELECT (CURRENT_TIMESTAMP - make_interval(secs => %s))::timestamp AS at
+        ),
+        tails AS (
+            SELECT t.user_id,
+                   SUM(t.delta_spitak) AS delta_spitak,
+                   SUM(t.delta_earned) AS delta_earned,
+                   SUM(t.delta_steps) AS delta_steps
+            FROM transactions t
+            LEFT JOIN balance_snapshots bs ON bs.user_id = t.user_id
+            CROSS JOIN cutoff
+            WHERE t.created_at >= COALESCE(bs.covered_until, '-infinity'::timestamp)
+              AND t.created_at < cutoff.at
+            GROUP BY t.user_id
+        )
+        INSERT INTO balance_snapshots (user_id, balance_spitak, total_earned, balance_steps, covered_until, taken_at)
+        SELECT tails.user_id, tails.delta_spitak, tails.delta_earned, tails.delta_steps, cutoff.at, CURRENT_TIMESTAMP
+        FROM tails CROSS JOIN cutoff
+        ON CONFLICT (user_id) DO UPDATE SET
+            balance_spitak = balance_snapshots.balance_spitak + EXCLUDED.balance_spitak,
+            total_earned = balance_snapshots.total_earned + EXCLUDED.total_earned,
+            balance_steps = balance_snapshots.balance_steps + EXCLUDED.balance_steps,
+            covered_until = EXCLUDED.covered_until,
+            taken_at = EXCLUDED.taken_at
+    """, (lag_seconds,))
+    return cur.rowcount
+
+
+def verify_balances(cur, repair: bool = False) -> list:
+    """
+    Пересчитывает балансы по всему журналу (с архивными суммами) и сравнивает со снимком плюс хвост.
+    С repair=True снимки расходящихся пользователей перестраиваются из журнала.
+    """
+    cur.execute(f"""
+        WITH ledger AS (
+            SELECT user_id,
+                   SUM(delta_spitak) AS balance_spitak,
+                   SUM(delta_earned) AS total_earned,
+                   SUM(delta_steps) AS balance_steps
+            FROM (
+                SELECT user_id, delta_spitak, delta_earned, delta_steps FROM transactions
+                UNION ALL
+                SELECT user_id, delta_spitak, delta_earned, delta_steps FROM ledger_archive_totals
+            ) journal
+            GROUP BY user_id
+        )
+        SELECT u.id::text AS user_id,
+               COALESCE(l.balance_spitak, 0) AS ledger_balance_spitak,
+               lb.balance_spitak AS derived_balance_spitak,
+               COALESCE(l.total_earned, 0) AS ledger_total_earned,
+               lb.total_earned AS derived_total_earned,
+               COALESCE(l.balance_steps, 0) AS ledger_balance_steps,
+               lb.balance_steps AS derived_balance_steps
+        FROM users u
+        LEFT JOIN ledger l ON l.user_id = u.id
+        {balance_join('u.id')}
+        WHERE COALESCE(l.balance_spitak, 0) <> lb.balance_spitak
+           OR COALESCE(l.total_earned, 0) <> lb.total_earned
+           OR COALESCE(l.balance_steps, 0) <> lb.balance_steps
+    """)
+    mismatches = cur.fetchall()
+
+    if repair and mismatches:
+        cur.execute(f"""
+            WITH cutoff AS (
+                SELECT (CURRENT_TIMESTAMP - make_interval(secs => %s))::timestamp AS at
+            ),
+            rebuilt AS (
+                INSERT INTO balance_snapshots (user_id, balance_spitak, total_earned, balance_steps, covered_until, taken_at)
+                SELECT u.id,
+                       COALESCE(MIN(a.delta_spitak), 0) + COALESCE(SUM(t.delta_spitak), 0),
+                       COALESCE(MIN(a.delta_earned), 0) + COALESCE(SUM(t.delta_earned), 0),
+                       COALESCE(MIN(a.delta_steps), 0) + COALESCE(SUM(t.delta_steps), 0),
+                       cutoff.at, CURRENT_TIMESTAMP
+                FROM unnest(%s::uuid[]) AS u(id)
+                CROSS JOIN cutoff
+                LEFT JOIN ledger_archive_totals a ON a.user_id = u.id
+                LEFT JOIN transactions t ON t.user_id = u.id AND t.created_at < cutoff.at
+                GROUP BY u.id, cutoff.at
+                ON CONFLICT (user_id) DO UPDATE SET
+                    balance_spitak = EXCLUDED.balance_spitak,
+                    total_earned = EXCLUDED.total_earned,
+                    balance_steps = EXCLUDED.balance_steps,
+                    covered_until = EXCLUDED.covered_until,
+                    taken_at = EXCLUDED.taken_at
+                RETURNING user_id
+            )
+            {bump_profile_versions('SELECT user_id FROM rebuilt')}
+        """, (SNAPSHOT_LAG_SECONDS, [m['user_id'] for m in mismatches]))
+
+    return mismatches
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command not in ('snapshot', 'verify'):
+        print('Использование: python ledger.py snapshot | verify [--repair]')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    cur = conn.cursor()
+    try:
+        if command == 'snapshot':
+            report = {'partitions_created': ensure_partitions(cur), 'snapshots_updated': take_snapshots(cur)}
+        else:
+            mismatches = verify_balances(cur, repair='--repair' in sys.argv)
+            report = {'mismatches': len(mismatches), 'users': mismatches[:100], 'repaired': '--repair' in sys.argv}
+        conn.commit()
+        print(json.dumps(report, default=str, ensure_ascii=False, indent=2))
+    finally:
+        cur.close()
+        release_db_connection(conn)
+    if command == 'verify' and report['mismatches'] and not report['repaired']:
+        sys.exit(2)
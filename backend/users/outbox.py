@@ -0,0 +1,334 @@
+"""
+Транзакционный outbox для побочных эффектов горячих путей.
+Синхронизация шагов, покупка и погашение ваучера, регистрация пишут событие
+в outbox_events тем же SQL-выражением, что и основную запись, поэтому событие
+есть тогда и только тогда, когда закоммичена операция. Агрегаты битвы районов, учёт сожжённых
+токенов, дневная аналитика и уведомления выполняются здесь, вне транзакции запроса.
+
+Разборщик берёт группу пользователей (shard) под advisory-блокировкой и
+обрабатывает её события пачками в порядке id: подряд идущие события одного
+типа обработчик получает разом. Эффекты в БД и удаление событий коммитятся
+вместе; уведомления уходят через NOTIFY spitak_notifications при коммите,
+доставка не реже одного раза.
+Если пачка падает, она повторяется по одному событию: упавшее событие и более
+поздние события того же пользователя ждут повторной попытки, остальные проходят.
+
+Фоновые задачи:
+    python outbox.py drain [--shard N]  # разбор событий, по умолчанию всех групп
+    python outbox.py backlog            # размер и возраст очереди; код 2 при отставании
+"""
+import json
+import os
+import sys
+import time
+from collections import defaultdict
+from itertools import groupby
+from decimal import Decimal
+
+# Совпадает с выражением shard в миграции V0014
+OUTBOX_SHARDS = 16
+BATCH_SIZE = int(os.environ.get('OUTBOX_BATCH_SIZE', '500'))
+MAX_ATTEMPTS = int(os.environ.get('OUTBOX_MAX_ATTEMPTS', '8'))
+RETRY_BASE_SECONDS = int(os.environ.get('OUTBOX_RETRY_BASE_SECONDS', '5'))
+DRAIN_MAX_SECONDS = float(os.environ.get('OUTBOX_DRAIN_MAX_SECONDS', '50'))
+BACKLOG_ALERT_SECONDS = int(os.environ.get('OUTBOX_BACKLOG_ALERT_SECONDS', '300'))
+
+NOTIFY_CHANNEL = 'spitak_notifications'
+
+CLAIM_SQL = """
+    SELECT e.id, e.user_id::text AS user_id, e.event_type, e.payload, e.attempts, e.created_at
+    FROM outbox_events e
+    WHERE e.shard = %(shard)s
+      AND e.available_at <= CURRENT_TIMESTAMP
+      AND NOT EXISTS (
+          SELECT 1 FROM outbox_events p
+          WHERE p.user_id = e.user_id AND p.id < e.id
+            AND p.attempts > 0 AND p.available_at > CURRENT_TIMESTAMP
+      )
+    ORDER BY e.id
+    LIMIT %(limit)s
+"""
+
+
+def _apply_district_stats(cur, events: list):
+    """Дельты шагов и активных пользователей в district_stats и districts, места районов"""
+    windows = defaultdict(lambda: [0, 0])
+    totals = defaultdict(lambda: [0, 0])
+    for event in events:
+        p = event['payload']
+        if not p.get('district'):
+            continue
+        for period, start, new_user in (('day', p['date'], p['first_today']),
+                                        ('week', p['week_start'], p['first_week'])):
+            window = windows[(period, start, p['district'])]
+            window[0] += p['steps']
+            window[1] += new_user
+        totals[p['district']][0] += p['steps']
+        totals[p['district']][1] += p['first_ever']
+    if not totals:
+        return
+
+    keys = sorted(windows)
+    cur.execute("""
+        INSERT INTO district_stats (period, period_start, district, total_steps, active_users)
+        SELECT w.period, w.period_start, w.district, w.total_steps, w.active_users
+        FROM unnest(%s::varchar[], %s::date[], %s::varchar[], %s::bigint[], %s::int[])
+            AS w(period, period_start, district, total_steps, active_users)
+        JOIN districts d ON d.name = w.district
+        ON CONFLICT (period, period_start, district) DO UPDATE SET
+            total_steps = district_stats.total_steps + EXCLUDED.total_steps,
+            active_users = district_stats.active_users + EXCLUDED.active_users,
+            updated_at = CURRENT_TIMESTAMP
+    """, ([k[0] for k in keys], [k[1] for k in keys], [k[2] for k in keys],
+          [windows[k][0] for k in keys], [windows[k][1] for k in keys]))
+
+    names = sorted(totals)
+    # Пересчёт мест трогает строки чужих районов: разборщики групп делают его по очереди,
+    # иначе две группы могли бы взять строки districts в разном порядке
+    cur.execute("SELECT pg_advisory_xact_lock(hashtextextended('districts', 0))")
+    cur.execute("""
+        UPDATE districts d
+        SET total_steps = d.total_steps + t.total_steps,
+            active_users = d.active_users + t.new_users,
+            updated_at = CURRENT_TIMESTAMP
+        FROM unnest(%s::varchar[], %s::bigint[], %s::int[]) AS t(district, total_steps, new_users)
+        WHERE d.name = t.district
+    """, (names, [totals[n][0] for n in names], [totals[n][1] for n in names]))
+    # Места в districts.rank; меняются только районы, чьё место сдвинулось
+    cur.execute("""
+        UPDATE districts d SET rank = r.rank, updated_at = CURRENT_TIMESTAMP
+        FROM (
+            SELECT id, RANK() OVER (ORDER BY total_steps DESC) AS rank FROM districts
+        ) r
+        WHERE d.id = r.id AND d.rank IS DISTINCT FROM r.rank
+    """)
+
+
+def _apply_token_stats(cur, events: list):
+    """Дневная аналитика: выпуск, траты, сжигание и регистрации в token_daily_stats"""
+    days = defaultdict(lambda: [0, 0, 0, 0, 0, 0, 0])
+    for event in events:
+        p = event['payload']
+        if event['event_type'] == 'steps.synced':
+            day = days[p['date']]
+            day[0] += p['steps']
+            day[1] += Decimal(str(p['spitak']))
+        elif event['event_type'] == 'voucher.purchased':
+            day = days[event['created_at'].date().isoformat()]
+            day[2] += 1
+            day[3] += Decimal(str(p['price']))
+            day[4] += Decimal(str(p['burn_amount']))
+        elif event['event_type'] == 'user.registered':
+            day = days[event['created_at'].date().isoformat()]
+            day[5] += 1
+            day[6] += p.get('referred_by') is not None
+    if not days:
+        return
+
+    dates = sorted(days)
+    columns = list(zip(*(days[d] for d in dates)))
+    cur.execute("""
+        INSERT INTO token_daily_stats (date, steps, minted_spitak, purchases, spent_spitak, burned_spitak,
+                                       registrations, referred_registrations)
+        SELECT * FROM unnest(%s::date[], %s::bigint[], %s::numeric[], %s::int[], %s::numeric[], %s::numeric[],
+                             %s::int[], %s::int[])
+        ON CONFLICT (date) DO UPDATE SET
+            steps = token_daily_stats.steps + EXCLUDED.steps,
+            minted_spitak = token_daily_stats.minted_spitak + EXCLUDED.minted_spitak,
+            purchases = token_daily_stats.purchases + EXCLUDED.purchases,
+            spent_spitak = token_daily_stats.spent_spitak + EXCLUDED.spent_spitak,
+            burned_spitak = token_daily_stats.burned_spitak + EXCLUDED.burned_spitak,
+            registrations = token_daily_stats.registrations + EXCLUDED.registrations,
+            referred_registrations = token_daily_stats.referred_registrations + EXCLUDED.referred_registrations,
+            updated_at = CURRENT_TIMESTAMP
+    """, (dates, *[list(c) for c in columns]))
+
+
+def _send_notifications(cur, events: list):
+    """Уведомления покупателю и пригласившему; сервис push-рассылки слушает канал"""
+    messages = []
+    for event in events:
+        p = event['payload']
+        if event['event_type'] == 'voucher.purchased':
+            messages.append({'user_id': event['user_id'], 'kind': 'voucher_purchased',
+                             'purchase_id': p['purchase_id'], 'brand_name': p['brand_name']})
+        elif event['event_type'] == 'voucher.redeemed':
+            messages.append({'user_id': event['user_id'], 'kind': 'voucher_redeemed',
+                             'purchase_id': p['purchase_id'], 'brand_name': p['brand_name'],
+                             'redeemed_at': p['redeemed_at']})
+        elif event['event_type'] == 'user.registered' and p.get('referred_by'):
+            messages.append({'user_id': p['referred_by'], 'kind': 'referral_bonus',
+                             'referred_user_id': event['user_id'], 'bonus': p['referral_bonus']})
+    if messages:
+        cur.execute("SELECT pg_notify(%s, m) FROM unnest(%s::text[]) AS m",
+                    (NOTIFY_CHANNEL, [json.dumps(m, default=str, ensure_ascii=False) for m in messages]))
+
+
+# Обработчики по типу события; каждый получает подряд идущие события своего типа в порядке id
+HANDLERS = {
+    'steps.synced': (_apply_district_stats, _apply_token_stats),
+    'voucher.purchased': (_apply_token_stats, _send_notifications),
+    'voucher.redeemed': (_send_notifications,),
+    'user.registered': (_apply_token_stats, _send_notifications),
+}
+
+
+def _dispatch(cur, events: list):
+    """
+    Выполняет события в порядке id: подряд идущие события одного типа уходят
+    обработчикам одним вызовом, смена типа начинает новый вызов. Так события
+    одного пользователя (покупка, затем погашение) применяются в порядке записи.
+    """
+    for event_type, run in groupby(events, key=lambda event: event['event_type']):
+        if event_type not in HANDLERS:
+            raise ValueError(f"Неизвестный тип события {event_type}")
+        items = list(run)
+        for handle in HANDLERS[event_type]:
+            handle(cur, items)
+
+
+def process_batch(cur, events: list) -> dict:
+    """
+    Выполняет пачку событий одной группы в текущей транзакции и удаляет выполненные.
+    Упавшие события получают отложенную повторную попытку или уходят в outbox_dead_letters.
+    """
+    done, failed = [], []
+    cur.execute("SAVEPOINT outbox_batch")
+    try:
+        _dispatch(cur, events)
+        done = [e['id'] for e in events]
+    except Exception:
+        cur.execute("ROLLBACK TO SAVEPOINT outbox_batch")
+        blocked = set()
+        for event in events:
+            if event['user_id'] in blocked:
+                continue
+            cur.execute("SAVEPOINT outbox_event")
+            try:
+                _dispatch(cur, [event])
+                done.append(event['id'])
+            except Exception as e:
+                cur.execute("ROLLBACK TO SAVEPOINT outbox_event")
+                failed.append((event, f'{type(e).__name__}: {e}'))
+                blocked.add(event['user_id'])
+
+    if done:
+        cur.execute("DELETE FROM outbox_events WHERE id = ANY(%s)", (done,))
+    dead = [(e, error) for e, error in failed if e['attempts'] + 1 >= MAX_ATTEMPTS]
+    retry = [(e, error) for e, error in failed if e['attempts'] + 1 < MAX_ATTEMPTS]
+    if retry:
+        cur.execute("""
+            UPDATE outbox_events e
+            SET attempts = e.attempts + 1,
+                available_at = CURRENT_TIMESTAMP + make_interval(secs => %s * power(2, e.attempts)),
+                last_error = f.error
+            FROM unnest(%s::bigint[], %s::text[]) AS f(id, error)
+            WHERE e.id = f.id
+        """, (RETRY_BASE_SECONDS, [e['id'] for e, _ in retry], [error for _, error in retry]))
+    if dead:
+        cur.execute("""
+            WITH moved AS (
+                DELETE FROM outbox_events e
+                USING unnest(%s::bigint[], %s::text[]) AS f(id, error)
+                WHERE e.id = f.id
+                RETURNING e.*, f.error
+            )
+            INSERT INTO outbox_dead_letters (id, user_id, event_type, payload, attempts, last_error, created_at)
+            SELECT id, user_id, event_type, payload, attempts + 1, error, created_at FROM moved
+        """, ([e['id'] for e, _ in dead], [error for _, error in dead]))
+    return {'processed': len(done), 'retried': len(retry), 'dead': len(dead),
+            'deferred': len(events) - len(done) - len(failed)}
+
+
+def drain_shard(conn, shard: int, batch_size: int = BATCH_SIZE, deadline: float = None) -> dict:
+    """
+    Разбирает события группы shard пачками, каждая в своей транзакции.
+    Возвращает None, если группу уже разбирает другой процесс.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("SELECT pg_try_advisory_lock(hashtextextended('outbox:' || %s, 0)) AS locked", (shard,))
+        locked = cur.fetchone()['locked']
+        conn.commit()
+        if not locked:
+            return None
+        report = {'batches': 0, 'processed': 0, 'retried': 0, 'dead': 0, 'deferred': 0}
+        try:
+            while deadline is None or time.monotonic() < deadline:
+                cur.execute(CLAIM_SQL, {'shard': shard, 'limit': batch_size})
+                events = cur.fetchall()
+                if not events:
+                    break
+                result = process_batch(cur, events)
+                conn.commit()
+                report['batches'] += 1
+                for key, value in result.items():
+                    report[key] += value
+                if len(events) < batch_size:
+                    break
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.execute("SELECT pg_advisory_unlock(hashtextextended('outbox:' || %s, 0))", (shard,))
+            conn.commit()
+        return report
+    finally:
+        cur.close()
+
+
+def drain(conn, shards=None, batch_size: int = BATCH_SIZE, max_seconds: float = DRAIN_MAX_SECONDS) -> dict:
+    """Разбирает все свободные группы; занятые другими процессами пропускаются"""
+    deadline = time.monotonic() + max_seconds
+    report = {'shards': 0, 'skipped': 0, 'batches': 0, 'processed': 0, 'retried': 0, 'dead': 0, 'deferred': 0}
+    for shard in (range(OUTBOX_SHARDS) if shards is None else shards):
+        if time.monotonic() >= deadline:
+            break
+        result = drain_shard(conn, shard, batch_size, deadline)
+        if result is None:
+            report['skipped'] += 1
+            continue
+        report['shards'] += 1
+        for key, value in result.items():
+            report[key] += value
+    return report
+
+
+def backlog(cur) -> dict:
+    """Метрика очереди: число событий, возраст самого старого, ожидающие повтора и мёртвые"""
+    cur.execute("""
+        SELECT COUNT(*) AS pending,
+               COUNT(*) FILTER (WHERE attempts > 0) AS retrying,
+               COALESCE(EXTRACT(EPOCH FROM CURRENT_TIMESTAMP - MIN(created_at)), 0)::int AS oldest_seconds,
+               (SELECT COUNT(*) FROM outbox_dead_letters) AS dead
+        FROM outbox_events
+    """)
+    report = dict(cur.fetchone())
+    cur.execute("SELECT event_type, COUNT(*) AS pending FROM outbox_events GROUP BY event_type ORDER BY event_type")
+    report['by_type'] = {row['event_type']: row['pending'] for row in cur.fetchall()}
+    return report
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    command = sys.argv[1] if len(sys.argv) > 1 else ''
+    if command not in ('drain', 'backlog'):
+        print('Использование: python outbox.py drain [--shard N] | backlog')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    try:
+        if command == 'drain':
+            shards = [int(sys.argv[sys.argv.index('--shard') + 1])] if '--shard' in sys.argv else None
+            report = drain(conn, shards)
+        else:
+            cur = conn.cursor()
+            report = backlog(cur)
+            conn.rollback()
+            cur.close()
+        print(json.dumps(report, default=str, ensure_ascii=False))
+    finally:
+        release_db_connection(conn)
+    if command == 'backlog' and report['oldest_seconds'] > BACKLOG_ALERT_SECONDS:
+        sys.exit(2)
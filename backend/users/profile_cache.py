@@ -0,0 +1,72 @@
+"""
+Кэш профилей внутри контейнера: готовое JSON-тело ответа GET по user_id
+с вытеснением давно не запрошенных записей (LRU).
+Запись действительна, пока совпадает версия профиля из profile_versions. Версию
+тем же запросом увеличивают все записи, меняющие баланс или поля профиля, в том
+числе из других функций и экземпляров (см. ledger.py), поэтому проверка перед
+ответом — чтение одной строки по ключу вместо профиля с балансом по журналу.
+PUT в этом контейнере кладёт новый профиль в кэш сразу (write-through).
+streak_days зависит от текущей даты, поэтому запись живёт до конца дня.
+"""
+import os
+import threading
+from collections import OrderedDict
+from datetime import date
+from responses import encode
+
+PROFILE_CACHE_MAX_ENTRIES = int(os.environ.get('PROFILE_CACHE_MAX_ENTRIES', '10000'))
+
+
+def profile_etag(version: int, day: date) -> str:
+    """ETag профиля: версия и день, за который посчитан streak_days"""
+    return f'"{version}-{day:%Y%m%d}"'
+
+
+class ProfileCache:
+    """LRU-кэш сериализованных профилей с проверкой по версии"""
+
+    def __init__(self, max_entries: int):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, user_id: str):
+        """Запись профиля за сегодня любой версии; версию сверяет вызывающий"""
+        with self._lock:
+            entry = self._entries.get(user_id)
+            if entry is None:
+                return None
+            if entry['day'] != date.today():
+                del self._entries[user_id]
+                return None
+            self._entries.move_to_end(user_id)
+            return entry
+
+    def put(self, user_id: str, version: int, profile: dict) -> dict:
+        day = date.today()
+        entry = {
+            'version': version,
+            'day': day,
+            'body': encode({'user': profile, 'version': version}),
+            'etag': profile_etag(version, day),
+        }
+        with self._lock:
+            current = self._entries.get(user_id)
+            # Параллельный запрос мог успеть положить более новую версию
+            if current is not None and current['day'] == day and current['version'] > version:
+                return current
+            self._entries[user_id] = entry
+            self._entries.move_to_end(user_id)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def invalidate(self, user_id: str = None):
+        with self._lock:
+            if user_id is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(user_id, None)
+
+
+profile_cache = ProfileCache(PROFILE_CACHE_MAX_ENTRIES)
@@ -0,0 +1,115 @@
+"""
+Аналитика графа рефералов без рекурсивного обхода по одному пользователю.
+Потомки до REFERRAL_MAX_DEPTH уровней лежат в таблице замыкания referral_closure,
+размеры сети и заработанные бонусы — в referral_stats. Обе таблицы пополняются
+при регистрации (см. registration.py), поэтому каждый запрос здесь — одно
+чтение по индексу.
+"""
+import uuid
+from registration import REFERRAL_MAX_DEPTH
+
+DOWNLINE_PAGE_SIZE = 50
+DOWNLINE_MAX_PAGE_SIZE = 200
+TOP_REFERRERS_MAX_LIMIT = 100
+
+TOP_REFERRERS_ORDER = {
+    'direct': 's.direct_count',
+    'downline': 's.downline_count',
+    'earned': 's.bonus_earned',
+}
+
+
+def parse_int(params: dict, name: str, default: int, maximum: int) -> int:
+    """Целый параметр запроса от 1 до maximum; ValueError с сообщением для клиента"""
+    value = params.get(name)
+    if value in (None, ''):
+        return default
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'{name} должен быть числом')
+    if not 1 <= number <= maximum:
+        raise ValueError(f'{name} должен быть от 1 до {maximum}')
+    return number
+
+
+def parse_cursor(cursor: str):
+    """Курсор страницы downline вида 'уровень:uuid' последней отданной строки"""
+    if not cursor:
+        return None
+    depth, _, user_id = cursor.partition(':')
+    try:
+        return int(depth), str(uuid.UUID(user_id))
+    except ValueError:
+        raise ValueError('Некорректный cursor')
+
+
+def fetch_downline(cur, user_id: str, max_depth: int = REFERRAL_MAX_DEPTH,
+                   limit: int = DOWNLINE_PAGE_SIZE, cursor: str = None) -> dict:
+    """
+    Приглашённые пользователем на уровнях 1..max_depth, по уровню и id.
+    Страницы по курсору (keyset) идут по первичному ключу referral_closure.
+    """
+    if not 1 <= max_depth <= REFERRAL_MAX_DEPTH:
+        raise ValueError(f'depth должен быть от 1 до {REFERRAL_MAX_DEPTH}')
+    limit = max(1, min(limit, DOWNLINE_MAX_PAGE_SIZE))
+    after = parse_cursor(cursor) or (0, '00000000-0000-0000-0000-000000000000')
+
+    cur.execute("""
+        SELECT u.id, u.full_name, u.username, u.district, c.depth, u.created_at
+        FROM referral_closure c
+        JOIN users u ON u.id = c.descendant_id
+        WHERE c.ancestor_id = %s
+          AND c.depth <= %s
+          AND (c.depth, c.descendant_id) > (%s, %s::uuid)
+        ORDER BY c.depth, c.descendant_id
+        LIMIT %s
+    """, (user_id, max_depth, after[0], after[1], limit + 1))
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > limit:
+        rows = rows[:limit]
+        next_cursor = f"{rows[-1]['depth']}:{rows[-1]['id']}"
+    return {'downline': rows, 'next_cursor': next_cursor}
+
+
+def fetch_stats(cur, user_id: str) -> dict:
+    """Размер сети по уровням и заработанные на приглашениях бонусы"""
+    cur.execute("""
+        SELECT COALESCE(s.direct_count, 0) AS direct_count,
+               COALESCE(s.downline_count, 0) AS downline_count,
+               COALESCE(s.bonus_earned, 0) AS bonus_earned,
+               COALESCE((
+                   SELECT json_object_agg(l.depth, l.count ORDER BY l.depth)
+                   FROM (
+                       SELECT depth, COUNT(*) AS count
+                       FROM referral_closure
+                       WHERE ancestor_id = u.id
+                       GROUP BY depth
+                   ) l
+               ), '{}'::json) AS levels
+        FROM users u
+        LEFT JOIN referral_stats s ON s.user_id = u.id
+        WHERE u.id = %s
+    """, (user_id,))
+    return cur.fetchone()
+
+
+def fetch_top_referrers(cur, by: str = 'direct', limit: int = 20) -> list:
+    """Рейтинг пригласивших по числу прямых приглашений, размеру сети или бонусам"""
+    order = TOP_REFERRERS_ORDER.get(by)
+    if not order:
+        raise ValueError(f"by должен быть одним из: {', '.join(TOP_REFERRERS_ORDER)}")
+    limit = max(1, min(limit, TOP_REFERRERS_MAX_LIMIT))
+
+    cur.execute(f"""
+        SELECT u.id, u.full_name, u.username, u.district,
+               s.direct_count, s.downline_count, s.bonus_earned
+        FROM referral_stats s
+        JOIN users u ON u.id = s.user_id
+        WHERE {order} > 0
+        ORDER BY {order} DESC, s.user_id
+        LIMIT %s
+    """, (limit,))
+    return cur.fetchall()
@@ -0,0 +1,197 @@
+"""
+Регистрация пользователей одним запросом.
+Проверка телефона на уникальность — это ON CONFLICT по ограничению UNIQUE,
+поиск пригласившего, вставка пользователя, бонус в журнал и запись в referrals
+выполняются в одном выражении с CTE. Реферальный код выдаёт DEFAULT колонки
+(см. миграцию V0009), поэтому коллизий и повторных попыток нет. Тем же
+выражением пополняются таблица замыкания графа рефералов и счётчики
+пригласивших (см. referrals.py) и пишется событие user.registered в outbox_events.
+
+Массовый импорт списков партнёров из CSV (phone_number, full_name, district, referral_code).
+Реферальный код — код уже зарегистрированного пользователя: строки с неизвестным
+кодом не регистрируются, а попадают в отчёт (unresolved, unresolved_codes),
+иначе пользователь молча остался бы без пригласившего:
+    python registration.py import partners.csv [--referral-code КОД] [--output codes.csv]
+"""
+import json
+import os
+import sys
+from db import execute_prepared
+from ledger import bump_profile_versions
+
+REFERRAL_BONUS = 5.0
+IMPORT_BATCH_SIZE = int(os.environ.get('USERS_IMPORT_BATCH_SIZE', '1000'))
+# Глубина таблицы замыкания; совпадает с заполнением в миграции V0010
+REFERRAL_MAX_DEPTH = 10
+
+REGISTER_SQL = f"""
+    WITH input AS (
+        SELECT *
+        FROM unnest(%(phones)s::varchar[], %(names)s::varchar[], %(districts)s::varchar[], %(codes)s::varchar[])
+            AS t(phone_number, full_name, district, referral_code)
+    ),
+    deduped AS (
+        SELECT DISTINCT ON (phone_number) * FROM input ORDER BY phone_number
+    ),
+    inserted AS (
+        INSERT INTO users (phone_number, full_name, district, referred_by)
+        SELECT d.phone_number, d.full_name, d.district, r.id
+        FROM deduped d
+        LEFT JOIN users r ON r.referral_code = d.referral_code
+        ORDER BY d.phone_number
+        ON CONFLICT (phone_number) DO NOTHING
+        RETURNING id, phone_number, full_name, referral_code, referred_by, balance_spitak, balance_steps, created_at
+    ),
+    bonus AS (
+        INSERT INTO transactions (user_id, type, amount, currency, status, description, delta_spitak, delta_earned)
+        SELECT referred_by, 'referral_bonus', %(bonus)s::numeric, 'SPITAK', 'completed',
+               'Бонус за приглашение ' || phone_number, %(bonus)s::numeric, %(bonus)s::numeric
+        FROM inserted
+        WHERE referred_by IS NOT NULL
+    ),
+    versions AS (
+        -- Бонус меняет баланс пригласившего: кэш его профиля устарел
+        {bump_profile_versions('SELECT referred_by AS user_id FROM inserted WHERE referred_by IS NOT NULL')}
+    ),
+    referral AS (
+        INSERT INTO referrals (referrer_id, referred_user_id, bonus_spitak)
+        SELECT referred_by, id, %(bonus)s::numeric
+        FROM inserted
+        WHERE referred_by IS NOT NULL
+    ),
+    closure AS (
+        -- Новый пользователь становится потомком пригласившего и всех его предков
+        INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+        SELECT referred_by, id, 1
+        FROM inserted
+        WHERE referred_by IS NOT NULL
+        UNION ALL
+        SELECT c.ancestor_id, i.id, c.depth + 1
+        FROM inserted i
+        JOIN referral_closure c ON c.descendant_id = i.referred_by
+        WHERE c.depth < %(max_depth)s::int
+        RETURNING ancestor_id, depth
+    ),
+    stats AS (
+        INSERT INTO referral_stats (user_id, direct_count, downline_count, bonus_earned)
+        SELECT ancestor_id,
+               COUNT(*) FILTER (WHERE depth = 1),
+               COUNT(*),
+               %(bonus)s::numeric * COUNT(*) FILTER (WHERE depth = 1)
+        FROM closure
+        GROUP BY ancestor_id
+        ORDER BY ancestor_id
+        ON CONFLICT (user_id) DO UPDATE SET
+            direct_count = referral_stats.direct_count + EXCLUDED.direct_count,
+            downline_count = referral_stats.downline_count + EXCLUDED.downline_count,
+            bonus_earned = referral_stats.bonus_earned + EXCLUDED.bonus_earned,
+            updated_at = CURRENT_TIMESTAMP
+    ),
+    events AS (
+        -- Аналитика и уведомление пригласившего выполняются из outbox (см. outbox.py)
+        INSERT INTO outbox_events (user_id, event_type, payload)
+        SELECT id, 'user.registered', jsonb_build_object(
+                   'referred_by', referred_by,
+                   'referral_bonus', CASE WHEN referred_by IS NOT NULL THEN %(bonus)s::numeric END)
+        FROM inserted
+        ORDER BY id
+    )
+    SELECT id, phone_number, full_name, referral_code, balance_spitak, balance_steps, created_at
+    FROM inserted
+"""
+
+
+def register_users(cur, users: list) -> list:
+    """
+    Регистрирует пользователей (словари с phone_number и необязательными
+    full_name, district, referral_code пригласившего).
+    Уже существующие телефоны пропускаются; возвращает созданные строки.
+    """
+    execute_prepared(cur, 'register_users', REGISTER_SQL, {
+        'phones': [u['phone_number'] for u in users],
+        'names': [u.get('full_name') for u in users],
+        'districts': [u.get('district') for u in users],
+        'codes': [u.get('referral_code') for u in users],
+        'bonus': REFERRAL_BONUS,
+        'max_depth': REFERRAL_MAX_DEPTH,
+    })
+    return cur.fetchall()
+
+
+def import_csv(conn, path: str, default_referral_code: str = None, output: str = None) -> dict:
+    """Импорт CSV пачками по IMPORT_BATCH_SIZE, каждая пачка в своей транзакции"""
+    import csv
+    report = {'read': 0, 'created': 0, 'skipped': 0, 'invalid': 0, 'unresolved': 0}
+    unresolved_codes = set()
+    writer = None
+    out = open(output, 'w', newline='', encoding='utf-8') if output else None
+    if out:
+        writer = csv.writer(out)
+        writer.writerow(['phone_number', 'referral_code'])
+
+    def flush(batch):
+        cur = conn.cursor()
+        try:
+            codes = sorted({u['referral_code'] for u in batch if u['referral_code']})
+            cur.execute("SELECT referral_code FROM users WHERE referral_code = ANY(%s)", (codes,))
+            known = {row['referral_code'] for row in cur.fetchall()}
+            missing = [u for u in batch if u['referral_code'] and u['referral_code'] not in known]
+            if missing:
+                report['unresolved'] += len(missing)
+                unresolved_codes.update(u['referral_code'] for u in missing)
+                batch = [u for u in batch if not u['referral_code'] or u['referral_code'] in known]
+            created = register_users(cur, batch) if batch else []
+            conn.commit()
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            cur.close()
+        report['created'] += len(created)
+        report['skipped'] += len({u['phone_number'] for u in batch}) - len(created)
+        if writer:
+            writer.writerows((row['phone_number'], row['referral_code']) for row in created)
+
+    try:
+        with open(path, newline='', encoding='utf-8') as f:
+            batch = []
+            for record in csv.DictReader(f):
+                report['read'] += 1
+                phone = (record.get('phone_number') or '').strip()
+                if not phone or len(phone) > 15:
+                    report['invalid'] += 1
+                    continue
+                batch.append({
+                    'phone_number': phone,
+                    'full_name': (record.get('full_name') or '').strip() or None,
+                    'district': (record.get('district') or '').strip() or None,
+                    'referral_code': (record.get('referral_code') or '').strip() or default_referral_code,
+                })
+                if len(batch) >= IMPORT_BATCH_SIZE:
+                    flush(batch)
+                    batch = []
+            if batch:
+                flush(batch)
+    finally:
+        if out:
+            out.close()
+    report['unresolved_codes'] = sorted(unresolved_codes)
+    return report
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    args = sys.argv[1:]
+    if len(args) < 2 or args[0] != 'import':
+        print('Использование: python registration.py import <файл.csv> [--referral-code КОД] [--output коды.csv]')
+        sys.exit(1)
+
+    def option(name):
+        return args[args.index(name) + 1] if name in args else None
+
+    conn = get_db_connection()
+    try:
+        print(json.dumps(import_csv(conn, args[1], option('--referral-code'), option('--output'))))
+    finally:
+        release_db_connection(conn)
@@ -0,0 +1,191 @@
+"""
+Трассировка запросов облачной функции: время получения соединения, каждого
+SQL-запроса (нормализованный текст, число строк, длительность) и сериализации
+ответа. По завершении запроса в stdout пишется одна JSON-строка с трассой,
+медленные запросы попадают в скользящий журнал, счётчики копятся по контейнеру.
+
+Включается переменной TRACE_ENABLED=1. Выключенная трассировка не оборачивает
+handler и курсоры, поэтому не добавляет накладных расходов.
+"""
+import functools
+import json
+import os
+import threading
+import time
+import traceback
+import uuid
+from collections import deque
+from psycopg2.extras import RealDictCursor
+
+TRACE_ENABLED = os.environ.get('TRACE_ENABLED') == '1'
+TRACE_SLOW_QUERY_MS = float(os.environ.get('TRACE_SLOW_QUERY_MS', '100'))
+TRACE_SLOW_LOG_SIZE = int(os.environ.get('TRACE_SLOW_LOG_SIZE', '50'))
+TRACE_MAX_QUERIES = int(os.environ.get('TRACE_MAX_QUERIES', '50'))
+TRACE_SUMMARY_EVERY = int(os.environ.get('TRACE_SUMMARY_EVERY', '100'))
+TRACE_QUERY_TEXT_LENGTH = 300
+
+_local = threading.local()
+_lock = threading.Lock()
+_slow_queries = deque(maxlen=TRACE_SLOW_LOG_SIZE)
+_counters = {'requests': 0, 'errors': 0, 'queries': 0, 'slow_queries': 0}
+_query_stats = {}
+
+
+def normalize_query(query) -> str:
+    """Текст запроса без лишних пробелов, обрезанный до TRACE_QUERY_TEXT_LENGTH"""
+    if isinstance(query, bytes):
+        query = query.decode('utf-8', 'replace')
+    elif not isinstance(query, str):
+        query = str(query)
+    return ' '.join(query.split())[:TRACE_QUERY_TEXT_LENGTH]
+
+
+def current_trace():
+    return getattr(_local, 'trace', None)
+
+
+def add_timing(name: str, ms: float):
+    """Добавляет длительность к полю текущей трассы (connect_ms, acquire_ms, serialize_ms)"""
+    trace = current_trace()
+    if trace is not None:
+        trace[name] = round(trace.get(name, 0.0) + ms, 3)
+
+
+def record_query(query, rows: int, ms: float):
+    text = normalize_query(query)
+    trace = current_trace()
+    if trace is not None:
+        trace['db_ms'] = round(trace['db_ms'] + ms, 3)
+        trace['query_count'] += 1
+        if len(trace['queries']) < TRACE_MAX_QUERIES:
+            trace['queries'].append({'sql': text, 'rows': rows, 'ms': round(ms, 3)})
+    with _lock:
+        _counters['queries'] += 1
+        stats = _query_stats.setdefault(text, {'calls': 0, 'total_ms': 0.0, 'max_ms': 0.0})
+        stats['calls'] += 1
+        stats['total_ms'] += ms
+        stats['max_ms'] = max(stats['max_ms'], ms)
+        if ms >= TRACE_SLOW_QUERY_MS:
+            _counters['slow_queries'] += 1
+            _slow_queries.append({
+                'sql': text,
+                'rows': rows,
+                'ms': round(ms, 3),
+                'request_id': trace['request_id'] if trace else None,
+                'at': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            })
+
+
+def record_error(error: Exception):
+    """Пишет исключение обработчика в трассу или, без трассировки, отдельной строкой лога"""
+    details = {'type': type(error).__name__, 'message': str(error), 'traceback': traceback.format_exc(limit=8)}
+    trace = current_trace()
+    if trace is not None:
+        trace['error'] = details
+    else:
+        print(json.dumps({'error': details}, ensure_ascii=False))
+
+
+class TracingCursor(RealDictCursor):
+    """RealDictCursor, который замеряет каждый запрос"""
+
+    def execute(self, query, vars=None):
+        started = time.perf_counter()
+        try:
+            return super().execute(query, vars)
+        finally:
+            record_query(query, self.rowcount, (time.perf_counter() - started) * 1000)
+
+    def executemany(self, query, vars_list):
+        started = time.perf_counter()
+        try:
+            return super().executemany(query, vars_list)
+        finally:
+            record_query(query, self.rowcount, (time.perf_counter() - started) * 1000)
+
+    def copy_expert(self, sql, file, size=8192):
+        started = time.perf_counter()
+        try:
+            return super().copy_expert(sql, file, size)
+        finally:
+            record_query(sql, self.rowcount, (time.perf_counter() - started) * 1000)
+
+
+def timed(field: str):
+    """Декоратор: время вызова добавляется в поле трассы; без трассировки функция не меняется"""
+    def decorate(fn):
+        if not TRACE_ENABLED:
+            return fn
+
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            started = time.perf_counter()
+            try:
+                return fn(*args, **kwargs)
+            finally:
+                add_timing(field, (time.perf_counter() - started) * 1000)
+        return wrapper
+    return decorate
+
+
+def stats() -> dict:
+    """Счётчики контейнера, самые дорогие запросы и журнал медленных запросов"""
+    with _lock:
+        top = sorted(_query_stats.items(), key=lambda item: item[1]['total_ms'], reverse=True)[:10]
+        return {
+            **_counters,
+            'top_queries': [
+                {'sql': sql, 'calls': s['calls'], 'total_ms': round(s['total_ms'], 3), 'max_ms': round(s['max_ms'], 3)}
+                for sql, s in top
+            ],
+            'slow_queries': list(_slow_queries),
+        }
+
+
+def traced(function_name: str):
+    """Оборачивает handler облачной функции трассировкой запроса"""
+    def decorate(handler):
+        if not TRACE_ENABLED:
+            return handler
+
+        @functools.wraps(handler)
+        def wrapper(event: dict, context) -> dict:
+            trace = {
+                'request_id': getattr(context, 'request_id', None) or uuid.uuid4().hex[:16],
+                'function': function_name,
+                'method': (event or {}).get('httpMethod'),
+                'status': None,
+                'total_ms': 0.0,
+                'db_ms': 0.0,
+                'query_count': 0,
+                'queries': [],
+            }
+            _local.trace = trace
+            started = time.perf_counter()
+            try:
+                response = handler(event, context)
+                trace['status'] = response.get('statusCode')
+                elapsed = (time.perf_counter() - started) * 1000
+                # Новый словарь: заголовки ответа могут быть общими для контейнера
+                response['headers'] = {
+                    **(response.get('headers') or {}),
+                    'Server-Timing': f"db;dur={trace['db_ms']:.1f}, app;dur={elapsed - trace['db_ms']:.1f}, "
+                                     f"total;dur={elapsed:.1f}",
+                }
+                return response
+            except Exception as e:
+                record_error(e)
+                trace['status'] = 500
+                raise
+            finally:
+                _local.trace = None
+                trace['total_ms'] = round((time.perf_counter() - started) * 1000, 3)
+                with _lock:
+                    _counters['requests'] += 1
+                    _counters['errors'] += 1 if (trace['status'] or 500) >= 500 else 0
+                    summary_due = TRACE_SUMMARY_EVERY and _counters['requests'] % TRACE_SUMMARY_EVERY == 0
+                print(json.dumps({'trace': trace}, ensure_ascii=False, default=str))
+                if summary_due:
+                    print(json.dumps({'trace_stats': stats()}, ensure_ascii=False))
+        return wrapper
+    return decorate
@@ -0,0 +1,88 @@
+"""
+Кэш каталога ваучеров внутри контейнера: готовое JSON-тело ответа по категории
+с TTL и вытеснением самых старых записей. Покупка точечно патчит остатки,
+заменяя запись целиком: тело и ETag одной записи всегда согласованы.
+Сжатое gzip тело считается при первом запросе с Accept-Encoding и хранится рядом.
+"""
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from responses import compress, encode
+
+CACHE_TTL = float(os.environ.get('VOUCHER_CACHE_TTL', '30'))
+CACHE_MAX_ENTRIES = int(os.environ.get('VOUCHER_CACHE_MAX_ENTRIES', '64'))
+
+
+def _make_entry(vouchers: list, expires_at: float) -> dict:
+    """Запись кэша; после создания меняется только лениво сжатое тело gzip"""
+    body = encode({'vouchers': vouchers})
+    return {
+        'vouchers': vouchers,
+        'index': {v['id']: v for v in vouchers},
+        'body': body,
+        'etag': '"' + hashlib.sha1(body.encode('utf-8')).hexdigest()[:20] + '"',
+        'gzip': None,
+        'expires_at': expires_at,
+    }
+
+
+class CatalogCache:
+    """LRU-кэш сериализованных списков ваучеров с ограничением по времени жизни"""
+
+    def __init__(self, ttl: float, max_entries: int):
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return None
+            if entry['expires_at'] <= time.monotonic():
+                del self._entries[key]
+                return None
+            self._entries.move_to_end(key)
+            return entry
+
+    def put(self, key: str, vouchers: list) -> dict:
+        entry = _make_entry(vouchers, time.monotonic() + self.ttl)
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+        return entry
+
+    def patch_voucher(self, voucher_id: str, **fields):
+        """
+        Обновляет поля ваучера только в тех записях, где он присутствует.
+        Запись не правится на месте, а заменяется новой: запрос, уже получивший
+        старую запись из get, отдаёт её тело с её же ETag.
+        """
+        with self._lock:
+            for key, entry in list(self._entries.items()):
+                if voucher_id not in entry['index']:
+                    continue
+                vouchers = [{**v, **fields} if v['id'] == voucher_id else v for v in entry['vouchers']]
+                self._entries[key] = _make_entry(vouchers, entry['expires_at'])
+
+    def compressed(self, entry: dict) -> str:
+        """Сжатое тело записи; считается один раз до следующего патча"""
+        with self._lock:
+            if entry['gzip'] is None:
+                entry['gzip'] = compress(entry['body'])
+            return entry['gzip']
+
+    def invalidate(self, key: str = None):
+        with self._lock:
+            if key is None:
+                self._entries.clear()
+            else:
+                self._entries.pop(key, None)
+
+
+catalog_cache = CatalogCache(CACHE_TTL, CACHE_MAX_ENTRIES)
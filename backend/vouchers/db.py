@@ -0,0 +1,284 @@
+"""
+Пул подключений к PostgreSQL, живущий между вызовами функции в одном контейнере.
+Соединения переиспользуются, простаивающие проверяются перед выдачей,
+упавшие пересоздаются прозрачно для обработчика.
+При включённой трассировке соединения создаются с замеряющим курсором.
+Горячие запросы выполняются через execute_prepared: на тёплом соединении
+текст разбирается сервером один раз (PREPARE), дальше идёт только EXECUTE.
+"""
+import json
+import os
+import re
+import threading
+import time
+import psycopg2
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE, connection as pg_connection
+from psycopg2.extras import RealDictCursor
+from tracing import TRACE_ENABLED, TracingCursor, add_timing
+
+POOL_MAX_SIZE = int(os.environ.get('DB_POOL_MAX_SIZE', '4'))
+POOL_ACQUIRE_TIMEOUT = float(os.environ.get('DB_POOL_ACQUIRE_TIMEOUT', '5'))
+POOL_HEALTHCHECK_INTERVAL = float(os.environ.get('DB_POOL_HEALTHCHECK_INTERVAL', '30'))
+POOL_LOG_STATS = os.environ.get('DB_POOL_LOG_STATS') == '1'
+# За PgBouncer в режиме transaction подготовленные запросы не переживают транзакцию: выключить
+PREPARED_STATEMENTS = os.environ.get('DB_PREPARED_STATEMENTS', '1') == '1'
+
+# Строки, идентификаторы в кавычках и комментарии проходят в PREPARE как есть,
+# параметры ищутся только вне них
+_TOKEN_RE = re.compile(r"""
+    (?P<skip>
+        (?<!\w)[Ee]'(?:[^'\\]|\\.|'')*'
+      | '(?:[^']|'')*'
+      | "(?:[^"]|"")*"
+      | --[^\n]*
+      | /\*.*?\*/
+      | \$(?P<tag>(?:[A-Za-z_]\w*)?)\$.*?\$(?P=tag)\$
+    )
+    | %(?:\((?P<name>\w+)\))?s(?P<cast>::)?
+    | %%
+""", re.S | re.X)
+_PARAM_RE = re.compile(r'%(?:\(\w+\))?s')
+# Имя запроса -> (текст с $1..$n, ключи параметров в порядке номеров) или None,
+# если запрос выполняется без подготовки
+_statements = {}
+
+
+class PoolTimeout(Exception):
+    """Не удалось получить соединение из пула за отведённое время"""
+
+
+class PreparingConnection(pg_connection):
+    """Соединение, помнящее свои подготовленные запросы: имя -> типы параметров"""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.prepared = {}
+
+
+class ConnectionPool:
+    """Ограниченный пул соединений с проверкой здоровья и счётчиками"""
+
+    def __init__(self, dsn: str, max_size: int, acquire_timeout: float, healthcheck_interval: float):
+        self.dsn = dsn
+        self.max_size = max_size
+        self.acquire_timeout = acquire_timeout
+        self.healthcheck_interval = healthcheck_interval
+        self._idle = []
+        self._size = 0
+        self._in_use = 0
+        self._cond = threading.Condition()
+        self._stats = {
+            'created': 0,
+            'reused': 0,
+            'waits': 0,
+            'wait_time_ms': 0.0,
+            'max_wait_ms': 0.0,
+            'healthcheck_failures': 0,
+            'discarded': 0,
+        }
+
+    def _connect(self):
+        started = time.perf_counter()
+        conn = psycopg2.connect(self.dsn, connection_factory=PreparingConnection,
+                                cursor_factory=TracingCursor if TRACE_ENABLED else RealDictCursor)
+        if TRACE_ENABLED:
+            add_timing('connect_ms', (time.perf_counter() - started) * 1000)
+        with self._cond:
+            self._stats['created'] += 1
+        return conn
+
+    def _is_alive(self, conn, last_used: float) -> bool:
+        if conn.closed:
+            return False
+        if time.monotonic() - last_used < self.healthcheck_interval:
+            return True
+        try:
+            with conn.cursor() as cur:
+                cur.execute('SELECT 1')
+            conn.rollback()
+            return True
+        except psycopg2.Error:
+            return False
+
+    def acquire(self):
+        deadline = time.monotonic() + self.acquire_timeout
+        waited_since = None
+        with self._cond:
+            while True:
+                if self._idle:
+                    conn, last_used = self._idle.pop()
+                    self._in_use += 1
+                    break
+                if self._size < self.max_size:
+                    self._size += 1
+                    self._in_use += 1
+                    conn, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise PoolTimeout('Пул соединений исчерпан')
+                if waited_since is None:
+                    waited_since = time.monotonic()
+                    self._stats['waits'] += 1
+                self._cond.wait(remaining)
+            if waited_since is not None:
+                wait_ms = (time.monotonic() - waited_since) * 1000
+                self._stats['wait_time_ms'] += wait_ms
+                self._stats['max_wait_ms'] = max(self._stats['max_wait_ms'], wait_ms)
+
+        try:
+            if conn is not None:
+                if self._is_alive(conn, last_used):
+                    with self._cond:
+                        self._stats['reused'] += 1
+                    return conn
+                with self._cond:
+                    self._stats['healthcheck_failures'] += 1
+                self._close_quietly(conn)
+            return self._connect()
+        except Exception:
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._cond.notify()
+            raise
+
+    def release(self, conn, discard: bool = False):
+        if not discard and not conn.closed:
+            try:
+                if conn.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                    conn.rollback()
+            except psycopg2.Error:
+                discard = True
+        if discard or conn.closed:
+            self._close_quietly(conn)
+            with self._cond:
+                self._size -= 1
+                self._in_use -= 1
+                self._stats['discarded'] += 1
+                self._cond.notify()
+            return
+        with self._cond:
+            self._in_use -= 1
+            self._idle.append((conn, time.monotonic()))
+            self._cond.notify()
+
+    @staticmethod
+    def _close_quietly(conn):
+        try:
+            conn.close()
+        except psycopg2.Error:
+            pass
+
+    def stats(self) -> dict:
+        with self._cond:
+            return {
+                'max_size': self.max_size,
+                'size': self._size,
+                'in_use': self._in_use,
+                'idle': len(self._idle),
+                **self._stats,
+            }
+
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def get_pool() -> ConnectionPool:
+    """Пул текущего контейнера, создаётся при первом обращении"""
+    global _pool
+    if _pool is None:
+        with _pool_lock:
+            if _pool is None:
+                _pool = ConnectionPool(
+                    os.environ.get('DATABASE_URL'),
+                    POOL_MAX_SIZE,
+                    POOL_ACQUIRE_TIMEOUT,
+                    POOL_HEALTHCHECK_INTERVAL,
+                )
+    return _pool
+
+
+def get_db_connection():
+    """Получение тёплого подключения к базе данных из пула"""
+    if not TRACE_ENABLED:
+        return get_pool().acquire()
+    started = time.perf_counter()
+    conn = get_pool().acquire()
+    add_timing('acquire_ms', (time.perf_counter() - started) * 1000)
+    return conn
+
+
+def release_db_connection(conn, discard: bool = False):
+    """Возврат подключения в пул; незавершённая транзакция откатывается"""
+    get_pool().release(conn, discard)
+    if POOL_LOG_STATS:
+        print(json.dumps({'db_pool': pool_stats()}))
+
+
+def pool_stats() -> dict:
+    """Статистика пула: занятые соединения, ожидания, число созданных"""
+    return get_pool().stats()
+
+
+def _compile_statement(sql: str):
+    """
+    Переводит параметры psycopg2 (%(имя)s или %s) в $1..$n для PREPARE.
+    Тип каждого параметра задаётся явным приведением (%(имя)s::тип): вывод
+    типа сервером по первому использованию молча меняет значение, например
+    %(bonus)s * COUNT(*) выводится как bigint. Запрос с параметром внутри
+    строки или комментария не готовится (None): psycopg2 подставит значение
+    и туда, а PREPARE — нет.
+    """
+    numbers = {}
+    order = []
+    hidden = []
+
+    def replace(match):
+        if match.group('skip') is not None:
+            hidden.extend(_PARAM_RE.findall(match.group(0).replace('%%', '')))
+            return match.group(0).replace('%%', '%')
+        if match.group(0) == '%%':
+            return '%'
+        if not match.group('cast'):
+            raise TypeError(f'Параметр {match.group(0)} без явного типа: {sql.strip()[:80]}')
+        key = match.group('name') or len(order)
+        if key not in numbers:
+            numbers[key] = len(order) + 1
+            order.append(key)
+        return f'${numbers[key]}::'
+
+    text = _TOKEN_RE.sub(replace, sql)
+    return None if hidden else (text, order)
+
+
+def execute_prepared(cur, name: str, sql: str, params):
+    """
+    cur.execute(sql, params) через подготовленный на сервере запрос name.
+    Первый вызов на соединении готовит запрос и узнаёт типы параметров,
+    следующие отправляют только EXECUTE. Соединения не из пула (фоновые задачи)
+    и выключенный DB_PREPARED_STATEMENTS выполняют запрос как обычно.
+    """
+    prepared = getattr(cur.connection, 'prepared', None)
+    if not PREPARED_STATEMENTS or prepared is None:
+        cur.execute(sql, params)
+        return
+    if name not in _statements:
+        _statements[name] = _compile_statement(sql)
+    statement = _statements[name]
+    if statement is None:
+        cur.execute(sql, params)
+        return
+    text, order = statement
+    if name not in prepared:
+        cur.execute(f"""
+            PREPARE {name} AS {text};
+            SELECT parameter_types::text[] AS types FROM pg_prepared_statements WHERE name = '{name}'
+        """)
+        prepared[name] = cur.fetchone()['types']
+    if not order:
+        cur.execute(f'EXECUTE {name}')
+        return
+    placeholders = ', '.join(f'%s::{param_type}' for param_type in prepared[name])
+    cur.execute(f'EXECUTE {name}({placeholders})', [params[key] for key in order])
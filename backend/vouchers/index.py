@@ -1,67 +1,145 @@
 import json
-import os
-import secrets
-import psycopg2
-from psycopg2.extras import RealDictCursor
+from catalog_cache import catalog_cache
+from db import get_db_connection, release_db_connection
+from purchase import PurchaseError, purchase_voucher
+from redemption import (REDEEM_MAX_BATCH_SIZE, TERMINAL_MAX_LENGTH, merchant_stats, normalize_code,
+                        redeem_codes)
+from responses import (GZIP_MIN_BYTES, accepts_gzip, body_response, empty_response, error_response,
+                       get_header, json_response, options_response)
+from search import parse_search_params, search_vouchers
+from tracing import record_error, traced
 
-def get_db_connection():
-    """Создание подключения к базе данных"""
-    dsn = os.environ.get('DATABASE_URL')
-    return psycopg2.connect(dsn, cursor_factory=RealDictCursor)
+MERCHANT_STATS_MAX_DAYS = 90
 
+CATALOG_SQL = """
+    SELECT v.id, v.brand_name, v.title, v.description, v.discount_value, v.category,
+           v.price_spitak, v.image_url, v.emoji, v.terms, v.valid_until, v.total_quantity,
+           CASE WHEN v.stock_shards > 0
+                THEN (SELECT SUM(s.remaining_quantity)::int FROM voucher_stock_shards s WHERE s.voucher_id = v.id)
+                ELSE v.remaining_quantity
+           END AS remaining_quantity,
+           v.is_active, v.created_at, v.updated_at
+    FROM vouchers v
+    WHERE v.is_active = true {filter}
+    ORDER BY v.price_spitak ASC
+"""
+
+def catalog_cache_key(event: dict) -> str:
+    """Ключ кэша каталога: категория или пустая строка для всех ваучеров"""
+    category = (event.get('queryStringParameters') or {}).get('category')
+    return category if category and category != 'Все' else ''
+
+def catalog_response(event: dict, entry: dict) -> dict:
+    """Ответ из записи кэша каталога; 304 если у клиента актуальная версия"""
+    headers = {'ETag': entry['etag'], 'Cache-Control': 'no-cache'}
+    if get_header(event, 'If-None-Match') == entry['etag']:
+        return empty_response(304, headers)
+    
+    body = entry['body']
+    compressed = None
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        compressed = catalog_cache.compressed(entry)
+    return body_response(200, body, event, headers, compressed)
+
+@traced('vouchers')
 def handler(event: dict, context) -> dict:
     """
     API для работы с ваучерами: получение списка, покупка за токены $SPiTAK.
     При покупке 10% токенов сжигается (burn), остальное списывается с баланса.
+    Каталог кэшируется по категориям и поддерживает ETag / If-None-Match.
+    GET с view=search ищет по каталогу: q, category, min_price, max_price,
+    sort, fields, limit, cursor (см. search.py).
+    POST с action=redeem погашает код на кассе партнёра: merchant, code или пачка
+    офлайн-погашений items [{code, redeemed_at}], необязательный terminal_id.
+    GET с view=merchant_stats (merchant, days) отдаёт погашения партнёра по дням.
     """
     method = event.get('httpMethod', 'GET')
     
     if method == 'OPTIONS':
-        return {
-            'statusCode': 200,
-            'headers': {
-                'Access-Control-Allow-Origin': '*',
-                'Access-Control-Allow-Methods': 'GET, POST, OPTIONS',
-                'Access-Control-Allow-Headers': 'Content-Type, X-User-Id'
-            },
-            'body': '',
-            'isBase64Encoded': False
-        }
+        return options_response('GET, POST, OPTIONS', 'Content-Type, X-User-Id, If-None-Match, Accept-Encoding', 'ETag')
+    
+    params = event.get('queryStringParameters') or {}
+    
+    if method == 'GET' and params.get('view') == 'search':
+        try:
+            query = parse_search_params(params)
+        except ValueError as e:
+            return error_response(400, str(e))
+    elif method == 'GET' and params.get('view') == 'merchant_stats':
+        try:
+            days = int(params.get('days') or 30)
+        except ValueError:
+            return error_response(400, 'days должен быть числом')
+        if not params.get('merchant') or not 0 < days <= MERCHANT_STATS_MAX_DAYS:
+            return error_response(400, f'merchant обязателен, days от 1 до {MERCHANT_STATS_MAX_DAYS}')
+    elif method == 'GET':
+        entry = catalog_cache.get(catalog_cache_key(event))
+        if entry is not None:
+            return catalog_response(event, entry)
     
     conn = get_db_connection()
     cur = conn.cursor()
     
     try:
-        if method == 'GET':
-            category = event.get('queryStringParameters', {}).get('category')
+        if method == 'GET' and params.get('view') == 'search':
+            return json_response(200, search_vouchers(cur, query), event)
+        
+        elif method == 'GET' and params.get('view') == 'merchant_stats':
+            return json_response(200, {
+                'merchant': params['merchant'],
+                'days': merchant_stats(cur, params['merchant'], days)
+            }, event)
+        
+        elif method == 'GET':
+            cache_key = catalog_cache_key(event)
             
-            if category and category != 'Все':
-                cur.execute("""
-                    SELECT * FROM vouchers 
-                    WHERE is_active = true AND category = %s
-                    ORDER BY price_spitak ASC
-                """, (category,))
+            if cache_key:
+                cur.execute(CATALOG_SQL.format(filter='AND v.category = %s'), (cache_key,))
             else:
-                cur.execute("""
-                    SELECT * FROM vouchers 
-                    WHERE is_active = true
-                    ORDER BY price_spitak ASC
-                """)
+                cur.execute(CATALOG_SQL.format(filter=''))
             
-            vouchers = cur.fetchall()
+            entry = catalog_cache.put(cache_key, cur.fetchall())
             
-            for v in vouchers:
-                v['price_spitak'] = float(v['price_spitak'])
-                v['valid_until'] = v['valid_until'].isoformat() if v['valid_until'] else None
-                v['created_at'] = v['created_at'].isoformat() if v['created_at'] else None
-                v['updated_at'] = v['updated_at'].isoformat() if v['updated_at'] else None
+            return catalog_response(event, entry)
+        
+        elif method == 'POST' and params.get('action') == 'redeem':
+            body = json.loads(event.get('body', '{}'))
+            merchant = body.get('merchant')
+            terminal = body.get('terminal_id')
+            
+            if not merchant or not isinstance(merchant, str):
+                return error_response(400, 'merchant обязателен')
+            if terminal is not None and (not isinstance(terminal, str) or not 0 < len(terminal) <= TERMINAL_MAX_LENGTH):
+                return error_response(400, f'terminal_id должен быть строкой до {TERMINAL_MAX_LENGTH} символов')
+            
+            if 'items' in body:
+                items = body.get('items')
+                
+                if not isinstance(items, list) or not items:
+                    return error_response(400, 'items должен быть непустым массивом')
+                
+                if len(items) > REDEEM_MAX_BATCH_SIZE:
+                    return error_response(400, f'Не более {REDEEM_MAX_BATCH_SIZE} погашений за запрос')
+                
+                results = redeem_codes(cur, merchant, items, terminal)
+                conn.commit()
+                
+                redeemed = sum(1 for r in results if r['success'])
+                return json_response(200, {
+                    'success': redeemed == len(results),
+                    'redeemed': redeemed,
+                    'failed': len(results) - redeemed,
+                    'results': results
+                }, event)
+            
+            if not normalize_code(body.get('code')):
+                return error_response(400, 'code обязателен')
+            
+            result = redeem_codes(cur, merchant, [body], terminal)[0]
+            conn.commit()
             
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({'vouchers': vouchers}),
-                'isBase64Encoded': False
-            }
+            response = {key: value for key, value in result.items() if key not in ('index', 'status')}
+            return json_response(result['status'], response, event)
         
         elif method == 'POST':
             body = json.loads(event.get('body', '{}'))
@@ -69,121 +147,35 @@ def handler(event: dict, context) -> dict:
             voucher_id = body.get('voucher_id')
             
             if not user_id or not voucher_id:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'user_id и voucher_id обязательны'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("SELECT balance_spitak FROM users WHERE id = %s", (user_id,))
-            user = cur.fetchone()
-            
-            if not user:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Пользователь не найден'}),
-                    'isBase64Encoded': False
-                }
-            
-            cur.execute("""
-                SELECT * FROM vouchers 
-                WHERE id = %s AND is_active = true AND remaining_quantity > 0
-            """, (voucher_id,))
-            voucher = cur.fetchone()
-            
-            if not voucher:
-                return {
-                    'statusCode': 404,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Ваучер недоступен или закончился'}),
-                    'isBase64Encoded': False
-                }
-            
-            price = float(voucher['price_spitak'])
-            user_balance = float(user['balance_spitak'])
-            
-            if user_balance < price:
-                return {
-                    'statusCode': 400,
-                    'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                    'body': json.dumps({'error': 'Недостаточно токенов на балансе'}),
-                    'isBase64Encoded': False
+                return error_response(400, 'user_id и voucher_id обязательны')
+            
+            try:
+                purchase = purchase_voucher(conn, user_id, voucher_id)
+            except PurchaseError as e:
+                return error_response(e.status, e.message)
+            
+            catalog_cache.patch_voucher(voucher_id, remaining_quantity=purchase['remaining_quantity'])
+            price = float(purchase['price_spitak'])
+            
+            return json_response(200, {
+                'success': True,
+                'purchase_id': purchase['purchase_id'],
+                'qr_code': purchase['qr_code'],
+                'redemption_code': purchase['redemption_code'],
+                'burned_spitak': round(price * 0.1, 2),
+                'new_balance': purchase['new_balance'],
+                'voucher': {
+                    'brand': purchase['brand_name'],
+                    'discount': purchase['discount_value']
                 }
-            
-            burn_amount = price * 0.1
-            deduct_amount = price
-            
-            redemption_code = secrets.token_hex(6).upper()
-            qr_code = f"SPITAK-{redemption_code}"
-            
-            cur.execute("""
-                INSERT INTO transactions (user_id, type, amount, currency, status, description, metadata)
-                VALUES (%s, 'purchase', %s, 'SPITAK', 'completed', %s, %s)
-                RETURNING id
-            """, (user_id, price, f'Покупка ваучера {voucher["brand_name"]}', json.dumps({'burn_amount': burn_amount})))
-            
-            transaction = cur.fetchone()
-            
-            cur.execute("""
-                UPDATE users 
-                SET balance_spitak = balance_spitak - %s
-                WHERE id = %s
-                RETURNING balance_spitak
-            """, (deduct_amount, user_id))
-            
-            updated_user = cur.fetchone()
-            
-            cur.execute("""
-                UPDATE vouchers 
-                SET remaining_quantity = remaining_quantity - 1
-                WHERE id = %s
-            """, (voucher_id,))
-            
-            cur.execute("""
-                INSERT INTO voucher_purchases (user_id, voucher_id, transaction_id, qr_code, redemption_code)
-                VALUES (%s, %s, %s, %s, %s)
-                RETURNING id, purchased_at
-            """, (user_id, voucher_id, transaction['id'], qr_code, redemption_code))
-            
-            purchase = cur.fetchone()
-            
-            conn.commit()
-            
-            return {
-                'statusCode': 200,
-                'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-                'body': json.dumps({
-                    'success': True,
-                    'purchase_id': purchase['id'],
-                    'qr_code': qr_code,
-                    'redemption_code': redemption_code,
-                    'burned_spitak': round(burn_amount, 2),
-                    'new_balance': float(updated_user['balance_spitak']),
-                    'voucher': {
-                        'brand': voucher['brand_name'],
-                        'discount': voucher['discount_value']
-                    }
-                }),
-                'isBase64Encoded': False
-            }
+            }, event)
         
-        return {
-            'statusCode': 405,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': 'Метод не поддерживается'}),
-            'isBase64Encoded': False
-        }
+        return error_response(405, 'Метод не поддерживается')
     
     except Exception as e:
         conn.rollback()
-        return {
-            'statusCode': 500,
-            'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
-            'body': json.dumps({'error': str(e)}),
-            'isBase64Encoded': False
-        }
+        record_error(e)
+        return error_response(500, str(e))
     finally:
         cur.close()
-        conn.close()
\ No newline at end of file
+        release_db_connection(conn)
\ No newline at end of file
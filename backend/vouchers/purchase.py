@@ -0,0 +1,238 @@
+"""
+Покупка ваучера одним условным атомарным запросом.
+Проверка баланса, списание, уменьшение остатка и запись покупки выполняются
+в одном UPDATE/INSERT-выражении, поэтому параллельные покупатели не могут
+продать больше остатка. Баланс берётся из журнала под advisory-блокировкой
+пользователя, поэтому параллельные списания не уводят его в минус.
+Тем же выражением пишется событие voucher.purchased в outbox_events.
+"""
+import json
+import os
+import secrets
+import sys
+from db import execute_prepared
+from ledger import balance_join, bump_profile_versions, lock_balance
+
+SHARD_RETRIES = int(os.environ.get('VOUCHER_SHARD_RETRIES', '3'))
+
+PURCHASE_SQL = f"""
+    WITH voucher AS (
+        SELECT id, brand_name, discount_value, price_spitak, stock_shards
+        FROM vouchers
+        WHERE id = %(voucher_id)s::uuid AND is_active = true
+    ),
+    balance AS (
+        SELECT lb.balance_spitak
+        FROM users u
+        {balance_join('u.id')}
+        WHERE u.id = %(user_id)s::uuid
+    ),
+    debit AS (
+        SELECT b.balance_spitak - v.price_spitak AS balance_spitak
+        FROM balance b, voucher v
+        WHERE b.balance_spitak >= v.price_spitak
+    ),
+    stock_single AS (
+        UPDATE vouchers
+        SET remaining_quantity = remaining_quantity - 1
+        WHERE id = %(voucher_id)s::uuid AND stock_shards = 0 AND remaining_quantity > 0
+          AND EXISTS (SELECT 1 FROM debit)
+        RETURNING remaining_quantity
+    ),
+    stock_sharded AS (
+        UPDATE voucher_stock_shards s
+        SET remaining_quantity = s.remaining_quantity - 1
+        WHERE (s.voucher_id, s.shard) = (
+            SELECT voucher_id, shard FROM voucher_stock_shards
+            WHERE voucher_id = %(voucher_id)s::uuid AND remaining_quantity > 0
+              AND EXISTS (SELECT 1 FROM voucher WHERE stock_shards > 0)
+              AND EXISTS (SELECT 1 FROM debit)
+            ORDER BY md5(shard::text || %(shard_salt)s::text)
+            LIMIT 1
+            {{shard_lock}}
+        )
+          AND s.remaining_quantity > 0
+        RETURNING (
+            SELECT SUM(remaining_quantity) FROM voucher_stock_shards WHERE voucher_id = %(voucher_id)s::uuid
+        ) - 1 AS remaining_quantity
+    ),
+    stock AS (
+        SELECT remaining_quantity FROM stock_single
+        UNION ALL
+        SELECT remaining_quantity FROM stock_sharded
+    ),
+    tx AS (
+        INSERT INTO transactions (user_id, type, amount, currency, status, description, metadata, delta_spitak)
+        SELECT %(user_id)s::uuid, 'purchase', v.price_spitak, 'SPITAK', 'completed',
+               'Покупка ваучера ' || v.brand_name,
+               jsonb_build_object('burn_amount', v.price_spitak * 0.1),
+               -v.price_spitak
+        FROM voucher v, stock
+        RETURNING id
+    ),
+    purchase AS (
+        INSERT INTO voucher_purchases (user_id, voucher_id, transaction_id, qr_code, redemption_code)
+        SELECT %(user_id)s::uuid, %(voucher_id)s::uuid, tx.id, %(qr_code)s::text, %(redemption_code)s::varchar
+        FROM tx
+        RETURNING id
+    ),
+    versions AS (
+        {bump_profile_versions('SELECT %(user_id)s::uuid AS user_id FROM purchase')}
+    ),
+    event AS (
+        -- Учёт сожжённых токенов, аналитика и уведомление выполняются из outbox (см. outbox.py)
+        INSERT INTO outbox_events (user_id, event_type, payload)
+        SELECT %(user_id)s::uuid, 'voucher.purchased', jsonb_build_object(
+                   'purchase_id', p.id,
+                   'voucher_id', v.id,
+                   'brand_name', v.brand_name,
+                   'price', v.price_spitak,
+                   'burn_amount', v.price_spitak * 0.1)
+        FROM purchase p, voucher v
+    )
+    SELECT v.brand_name, v.discount_value, v.price_spitak, v.stock_shards,
+           (SELECT balance_spitak FROM debit) AS new_balance,
+           (SELECT remaining_quantity FROM stock) AS remaining_quantity,
+           (SELECT id FROM purchase) AS purchase_id
+    FROM voucher v
+"""
+
+# Имя подготовленного запроса и текст: с SKIP LOCKED и с ожиданием занятого шарда
+PURCHASE_STATEMENTS = {
+    True: ('purchase_voucher_skip_locked', PURCHASE_SQL.format(shard_lock='FOR UPDATE SKIP LOCKED')),
+    False: ('purchase_voucher', PURCHASE_SQL.format(shard_lock='')),
+}
+
+DIAGNOSE_SQL = """
+    SELECT
+        EXISTS (SELECT 1 FROM users WHERE id = %(user_id)s) AS user_exists,
+        EXISTS (
+            SELECT 1 FROM vouchers v
+            WHERE v.id = %(voucher_id)s AND v.is_active = true
+              AND CASE WHEN v.stock_shards > 0
+                       THEN EXISTS (SELECT 1 FROM voucher_stock_shards s
+                                    WHERE s.voucher_id = v.id AND s.remaining_quantity > 0)
+                       ELSE v.remaining_quantity > 0
+                  END
+        ) AS in_stock
+"""
+
+
+class PurchaseError(Exception):
+    """Покупка отклонена: статус и сообщение для клиента"""
+
+    def __init__(self, status: int, message: str):
+        super().__init__(message)
+        self.status = status
+        self.message = message
+
+
+def _attempt(cur, user_id: str, voucher_id: str, skip_locked: bool):
+    lock_balance(cur, user_id)
+    redemption_code = secrets.token_hex(6).upper()
+    execute_prepared(cur, *PURCHASE_STATEMENTS[skip_locked], {
+        'user_id': user_id,
+        'voucher_id': voucher_id,
+        'qr_code': f"SPITAK-{redemption_code}",
+        'redemption_code': redemption_code,
+        'shard_salt': redemption_code,
+    })
+    row = cur.fetchone()
+    if row and row['purchase_id']:
+        row['redemption_code'] = redemption_code
+        row['qr_code'] = f"SPITAK-{redemption_code}"
+    return row
+
+
+def purchase_voucher(conn, user_id: str, voucher_id: str) -> dict:
+    """
+    Покупает ваучер и фиксирует транзакцию.
+    При неудаче откатывает частичные изменения и выбрасывает PurchaseError.
+    """
+    cur = conn.cursor()
+    try:
+        row = _attempt(cur, user_id, voucher_id, skip_locked=True)
+
+        # Все непустые шарды заняты параллельными покупками: ждём любой из них
+        retries = SHARD_RETRIES
+        while row and not row['purchase_id'] and row['new_balance'] is not None and row['stock_shards'] > 0 and retries:
+            conn.rollback()
+            row = _attempt(cur, user_id, voucher_id, skip_locked=False)
+            retries -= 1
+
+        if row and row['purchase_id']:
+            conn.commit()
+            return row
+
+        conn.rollback()
+        cur.execute(DIAGNOSE_SQL, {'user_id': user_id, 'voucher_id': voucher_id})
+        diagnosis = cur.fetchone()
+        conn.rollback()
+    finally:
+        cur.close()
+
+    if not diagnosis['user_exists']:
+        raise PurchaseError(404, 'Пользователь не найден')
+    if not row or row['new_balance'] is not None or not diagnosis['in_stock']:
+        raise PurchaseError(404, 'Ваучер недоступен или закончился')
+    raise PurchaseError(400, 'Недостаточно токенов на балансе')
+
+
+def reshard_stock(conn, voucher_id: str, shards: int) -> int:
+    """
+    Перераспределяет текущий остаток ваучера по shards счётчикам.
+    shards = 0 возвращает остаток в vouchers.remaining_quantity.
+    """
+    cur = conn.cursor()
+    try:
+        cur.execute("""
+            SELECT stock_shards, remaining_quantity FROM vouchers WHERE id = %s FOR UPDATE
+        """, (voucher_id,))
+        voucher = cur.fetchone()
+        if not voucher:
+            raise PurchaseError(404, 'Ваучер не найден')
+
+        cur.execute("""
+            DELETE FROM voucher_stock_shards WHERE voucher_id = %s
+            RETURNING remaining_quantity
+        """, (voucher_id,))
+        shard_rows = cur.fetchall()
+        if voucher['stock_shards'] > 0:
+            total = sum(r['remaining_quantity'] for r in shard_rows)
+        else:
+            total = voucher['remaining_quantity'] or 0
+
+        if shards > 0:
+            base, extra = divmod(total, shards)
+            cur.execute("""
+                INSERT INTO voucher_stock_shards (voucher_id, shard, remaining_quantity)
+                SELECT %s, shard, %s + CASE WHEN shard < %s THEN 1 ELSE 0 END
+                FROM generate_series(0, %s - 1) AS shard
+            """, (voucher_id, base, extra, shards))
+
+        cur.execute("""
+            UPDATE vouchers SET stock_shards = %s, remaining_quantity = %s, updated_at = CURRENT_TIMESTAMP
+            WHERE id = %s
+        """, (shards, total, voucher_id))
+        conn.commit()
+        return total
+    except Exception:
+        conn.rollback()
+        raise
+    finally:
+        cur.close()
+
+
+if __name__ == '__main__':
+    from db import get_db_connection, release_db_connection
+
+    if len(sys.argv) != 4 or sys.argv[1] != 'shard':
+        print('Использование: python purchase.py shard <voucher_id> <число шардов>')
+        sys.exit(1)
+
+    conn = get_db_connection()
+    try:
+        total = reshard_stock(conn, sys.argv[2], int(sys.argv[3]))
+        print(json.dumps({'voucher_id': sys.argv[2], 'shards': int(sys.argv[3]), 'remaining_quantity': total}))
+    finally:
+        release_db_connection(conn)
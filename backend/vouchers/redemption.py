@@ -0,0 +1,161 @@
+"""
+Погашение ваучеров на кассах партнёров.
+Код ищется по уникальному индексу redemption_code, погашение — условный UPDATE
+с is_redeemed IS NOT TRUE: из параллельных погашений одного кода проходит одно.
+Пачка офлайн-погашений терминала обрабатывается тем же одним запросом; в нём же
+пополняются счётчики партнёра и пишется событие voucher.redeemed в outbox_events.
+Повторная отправка пачки тем же терминалом не считается двойным погашением.
+"""
+import os
+from datetime import datetime, timedelta
+from db import execute_prepared
+
+REDEEM_MAX_BATCH_SIZE = int(os.environ.get('REDEEM_MAX_BATCH_SIZE', '500'))
+REDEEM_OFFLINE_MAX_DAYS = int(os.environ.get('REDEEM_OFFLINE_MAX_DAYS', '7'))
+REDEEM_CLOCK_SKEW_SECONDS = 300
+# Число строк-счётчиков на партнёра и день (см. миграцию V0015)
+MERCHANT_COUNTER_SHARDS = int(os.environ.get('MERCHANT_COUNTER_SHARDS', '8'))
+CODE_MAX_LENGTH = 50
+TERMINAL_MAX_LENGTH = 64
+QR_PREFIX = 'SPITAK-'
+
+REDEEM_SQL = """
+    WITH input AS (
+        SELECT *
+        FROM unnest(%(codes)s::varchar[], %(redeemed_at)s::timestamp[]) AS t(code, redeemed_at)
+    ),
+    redeemed AS (
+        UPDATE voucher_purchases p
+        SET is_redeemed = true, redeemed_at = i.redeemed_at, redeemed_terminal = %(terminal)s::varchar
+        FROM input i, vouchers v
+        WHERE p.redemption_code = i.code
+          AND v.id = p.voucher_id
+          AND v.brand_name = %(merchant)s::varchar
+          AND (v.valid_until IS NULL OR v.valid_until >= i.redeemed_at::date)
+          AND p.is_redeemed IS NOT TRUE
+        RETURNING p.id, p.user_id, p.redemption_code, p.redeemed_at, v.brand_name
+    ),
+    counters AS (
+        INSERT INTO merchant_redemption_counters (brand_name, date, shard, redemptions)
+        SELECT brand_name, redeemed_at::date, (hashtext(redemption_code) & 2147483647) %% %(shards)s::int, COUNT(*)
+        FROM redeemed
+        GROUP BY 1, 2, 3
+        ORDER BY 1, 2, 3
+        ON CONFLICT (brand_name, date, shard) DO UPDATE SET
+            redemptions = merchant_redemption_counters.redemptions + EXCLUDED.redemptions,
+            updated_at = CURRENT_TIMESTAMP
+    ),
+    events AS (
+        INSERT INTO outbox_events (user_id, event_type, payload)
+        SELECT user_id, 'voucher.redeemed', jsonb_build_object(
+                   'purchase_id', id, 'brand_name', brand_name, 'redeemed_at', redeemed_at)
+        FROM redeemed
+        ORDER BY id
+    )
+    SELECT i.code, r.id IS NOT NULL AS redeemed_now,
+           p.id IS NOT NULL AS found, p.redeemed_at, p.redeemed_terminal,
+           i.redeemed_at AS requested_at,
+           v.brand_name, v.title, v.discount_value, v.valid_until
+    FROM input i
+    LEFT JOIN redeemed r ON r.redemption_code = i.code
+    LEFT JOIN voucher_purchases p ON p.redemption_code = i.code
+    LEFT JOIN vouchers v ON v.id = p.voucher_id
+"""
+
+
+def normalize_code(code) -> str:
+    """Код из поля code или содержимого QR (SPITAK-XXXX); None, если код некорректен"""
+    if not isinstance(code, str):
+        return None
+    code = code.strip().upper()
+    if code.startswith(QR_PREFIX):
+        code = code[len(QR_PREFIX):]
+    return code if 0 < len(code) <= CODE_MAX_LENGTH else None
+
+
+def _parse_item(item, now: datetime) -> tuple:
+    """Проверка одного погашения; возвращает (код, время погашения, ошибка)"""
+    if not isinstance(item, dict):
+        return None, None, 'Ожидается объект'
+    code = normalize_code(item.get('code'))
+    if not code:
+        return None, None, 'code обязателен'
+    if item.get('redeemed_at') is None:
+        return code, now, None
+    try:
+        redeemed_at = datetime.fromisoformat(item['redeemed_at'])
+    except (TypeError, ValueError):
+        return code, None, 'redeemed_at должен быть в формате ISO 8601'
+    if redeemed_at.tzinfo is not None:
+        redeemed_at = redeemed_at.astimezone().replace(tzinfo=None)
+    if not now - timedelta(days=REDEEM_OFFLINE_MAX_DAYS) <= redeemed_at <= now + timedelta(seconds=REDEEM_CLOCK_SKEW_SECONDS):
+        return code, None, f'redeemed_at должен быть не старше {REDEEM_OFFLINE_MAX_DAYS} дней и не в будущем'
+    return code, redeemed_at, None
+
+
+def _result(row: dict, merchant: str, terminal: str) -> dict:
+    if not row['found']:
+        return {'success': False, 'status': 404, 'error': 'Код не найден'}
+    if row['brand_name'] != merchant:
+        return {'success': False, 'status': 403, 'error': 'Ваучер другого партнёра'}
+    voucher = {'brand': row['brand_name'], 'title': row['title'], 'discount': row['discount_value']}
+    if row['redeemed_now']:
+        return {'success': True, 'status': 200, 'redeemed_at': row['requested_at'], 'voucher': voucher}
+    if terminal and row['redeemed_terminal'] == terminal and row['redeemed_at'] == row['requested_at']:
+        # Терминал повторно отправил ту же пачку
+        return {'success': True, 'status': 200, 'redeemed_at': row['redeemed_at'], 'voucher': voucher,
+                'replayed': True}
+    if row['valid_until'] and row['valid_until'] < row['requested_at'].date():
+        return {'success': False, 'status': 410, 'error': 'Срок действия ваучера истёк', 'voucher': voucher}
+    # Без отметки в снимке запроса — код погасил параллельный запрос
+    return {'success': False, 'status': 409, 'error': 'Ваучер уже погашен',
+            'redeemed_at': row['redeemed_at'], 'voucher': voucher}
+
+
+def redeem_codes(cur, merchant: str, items: list, terminal: str = None) -> list:
+    """
+    Погашает коды партнёра merchant (brand_name ваучера) одним запросом.
+    Элементы — словари с code и необязательным redeemed_at (время офлайн-сканирования).
+    Повтор кода в пачке получает результат первого вхождения с пометкой duplicate.
+    Возвращает результат для каждого элемента в исходном порядке.
+    """
+    now = datetime.now()
+    results = [None] * len(items)
+    owners = {}
+    duplicates = []
+    for index, item in enumerate(items):
+        code, redeemed_at, error = _parse_item(item, now)
+        if error:
+            results[index] = {'index': index, 'code': code, 'success': False, 'status': 400, 'error': error}
+        elif code in owners:
+            duplicates.append((index, owners[code]))
+        else:
+            owners[code] = (index, redeemed_at)
+
+    if owners:
+        execute_prepared(cur, 'redeem_codes', REDEEM_SQL, {
+            'codes': list(owners),
+            'redeemed_at': [redeemed_at for _, redeemed_at in owners.values()],
+            'merchant': merchant,
+            'terminal': terminal,
+            'shards': MERCHANT_COUNTER_SHARDS,
+        })
+        for row in cur.fetchall():
+            index = owners[row['code']][0]
+            results[index] = {'index': index, 'code': row['code'], **_result(row, merchant, terminal)}
+
+    for index, owner in duplicates:
+        results[index] = {**results[owner[0]], 'index': index, 'duplicate': True}
+    return results
+
+
+def merchant_stats(cur, merchant: str, days: int) -> list:
+    """Погашения партнёра по дням за последние days дней: сумма по шардам счётчика"""
+    cur.execute("""
+        SELECT date, SUM(redemptions)::int AS redemptions
+        FROM merchant_redemption_counters
+        WHERE brand_name = %s AND date > CURRENT_DATE - %s
+        GROUP BY date
+        ORDER BY date DESC
+    """, (merchant, days))
+    return cur.fetchall()
@@ -0,0 +1,134 @@
+"""
+Сборка HTTP-ответов облачной функции.
+Строки из psycopg2 (Decimal, date, datetime, UUID) сериализуются за один проход
+без ручного преобразования полей. Если установлен orjson, используется он,
+иначе стандартный json. Большие тела сжимаются gzip, если клиент это принимает.
+Время сериализации и сжатия попадает в трассу запроса (tracing.py).
+Заголовки preflight собираются один раз на контейнер; каждый ответ получает
+свою копию, поэтому словарь headers готового ответа можно дополнять.
+"""
+import functools
+import json
+import os
+import uuid
+from datetime import date, datetime, time
+from decimal import Decimal
+from tracing import timed
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+GZIP_MIN_BYTES = int(os.environ.get('RESPONSE_GZIP_MIN_BYTES', '1024'))
+# Уровень 1 сжимает JSON почти как 6, но в несколько раз быстрее
+GZIP_LEVEL = int(os.environ.get('RESPONSE_GZIP_LEVEL', '1'))
+
+CORS_HEADERS = {'Access-Control-Allow-Origin': '*'}
+JSON_HEADERS = {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'}
+GZIP_HEADERS = {'Content-Encoding': 'gzip', 'Vary': 'Accept-Encoding'}
+
+
+def _default(value):
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (datetime, date, time)):
+        return value.isoformat()
+    if isinstance(value, uuid.UUID):
+        return str(value)
+    raise TypeError(f'Object of type {type(value).__name__} is not JSON serializable')
+
+
+if orjson is not None:
+    @timed('serialize_ms')
+    def encode(payload) -> str:
+        """JSON-строка ответа; orjson сам сериализует даты и UUID, Decimal — через _default"""
+        return orjson.dumps(payload, default=_default).decode('utf-8')
+else:
+    @timed('serialize_ms')
+    def encode(payload) -> str:
+        """JSON-строка ответа через стандартный json (с ensure_ascii C-кодировщик быстрее)"""
+        return json.dumps(payload, default=_default, separators=(',', ':'))
+
+
+def get_header(event: dict, name: str):
+    """Значение заголовка запроса без учёта регистра"""
+    name = name.lower()
+    for key, value in (event.get('headers') or {}).items():
+        if key.lower() == name:
+            return value
+    return None
+
+
+def accepts_gzip(event: dict) -> bool:
+    """Клиент указал gzip в Accept-Encoding"""
+    accept = get_header(event, 'Accept-Encoding') if event else None
+    return bool(accept) and 'gzip' in accept.lower()
+
+
+@timed('compress_ms')
+def compress(body: str) -> str:
+    """Тело в gzip, закодированное base64 для isBase64Encoded"""
+    # Нужны только большим ответам, поэтому не замедляют холодный старт
+    import base64
+    import gzip
+    return base64.b64encode(gzip.compress(body.encode('utf-8'), GZIP_LEVEL)).decode('ascii')
+
+
+def body_response(status: int, body: str, event: dict = None, headers: dict = None, compressed: str = None) -> dict:
+    """
+    Ответ с уже сериализованным JSON-телом.
+    compressed — заранее сжатое тело (compress(body)), чтобы не сжимать его повторно.
+    """
+    if len(body) >= GZIP_MIN_BYTES and accepts_gzip(event):
+        response_headers = {**JSON_HEADERS, **(headers or {}), **GZIP_HEADERS}
+        return {
+            'statusCode': status,
+            'headers': response_headers,
+            'body': compressed or compress(body),
+            'isBase64Encoded': True
+        }
+    return {
+        'statusCode': status,
+        'headers': {**JSON_HEADERS, **(headers or {})},
+        'body': body,
+        'isBase64Encoded': False
+    }
+
+
+def json_response(status: int, payload, event: dict = None, headers: dict = None) -> dict:
+    """JSON-ответ со стандартными CORS-заголовками"""
+    return body_response(status, encode(payload), event, headers)
+
+
+def error_response(status: int, message: str) -> dict:
+    """Ответ с ошибкой в формате {"error": ...}"""
+    return json_response(status, {'error': message})
+
+
+def empty_response(status: int, headers: dict = None) -> dict:
+    """Ответ без тела: preflight, 304"""
+    return {
+        'statusCode': status,
+        'headers': {**CORS_HEADERS, **(headers or {})},
+        'body': '',
+        'isBase64Encoded': False
+    }
+
+
+@functools.lru_cache(maxsize=None)
+def _preflight_headers(methods: str, allow_headers: str, expose_headers: str) -> dict:
+    headers = {**CORS_HEADERS, 'Access-Control-Allow-Methods': methods, 'Access-Control-Allow-Headers': allow_headers}
+    if expose_headers:
+        headers['Access-Control-Expose-Headers'] = expose_headers
+    return headers
+
+
+def options_response(methods: str, allow_headers: str = 'Content-Type, X-User-Id', expose_headers: str = None) -> dict:
+    """Ответ на CORS preflight"""
+    return {
+        'statusCode': 200,
+        'headers': dict(_preflight_headers(methods, allow_headers, expose_headers)),
+        'body': '',
+        'isBase64Encoded': False
+    }
@@ -0,0 +1,183 @@
+"""
+Поиск по каталогу ваучеров: полнотекстовый запрос по бренду, названию и описанию,
+категория, диапазон цены, несколько сортировок и keyset-пагинация.
+Истёкшие (valid_until) и распроданные ваучеры не показываются. Отдаются только
+запрошенные поля. Каждая сортировка идёт по своему индексу из миграции V0013.
+"""
+import base64
+import json
+import uuid
+from datetime import datetime
+from decimal import Decimal, InvalidOperation
+
+DEFAULT_LIMIT = 20
+MAX_LIMIT = 100
+QUERY_MAX_LENGTH = 100
+
+REMAINING_SQL = """CASE WHEN v.stock_shards > 0
+        THEN (SELECT SUM(s.remaining_quantity)::int FROM voucher_stock_shards s WHERE s.voucher_id = v.id)
+        ELSE v.remaining_quantity
+    END"""
+
+# Поля, которые можно запросить параметром fields
+FIELDS = {
+    'id': 'v.id',
+    'brand_name': 'v.brand_name',
+    'title': 'v.title',
+    'description': 'v.description',
+    'discount_value': 'v.discount_value',
+    'category': 'v.category',
+    'price_spitak': 'v.price_spitak',
+    'image_url': 'v.image_url',
+    'emoji': 'v.emoji',
+    'terms': 'v.terms',
+    'valid_until': 'v.valid_until',
+    'total_quantity': 'v.total_quantity',
+    'remaining_quantity': REMAINING_SQL,
+    'created_at': 'v.created_at',
+}
+DEFAULT_FIELDS = ('id', 'brand_name', 'title', 'discount_value', 'category', 'price_spitak',
+                  'image_url', 'emoji', 'valid_until', 'remaining_quantity')
+
+# Сортировка: (ключ, тип ключа в курсоре, направление). Ключи совпадают
+# с выражениями индексов, NULL заменён на бесконечность
+SORTS = {
+    'price_asc': ('v.price_spitak', 'numeric', 'ASC'),
+    'price_desc': ('v.price_spitak', 'numeric', 'DESC'),
+    'newest': ("COALESCE(v.created_at, '-infinity'::timestamp)", 'timestamp', 'DESC'),
+    'expiring': ("COALESCE(v.valid_until, 'infinity'::date)", 'date', 'ASC'),
+    'relevance': ("ts_rank(v.search_vector, websearch_to_tsquery('simple', %(q)s))", 'real', 'DESC'),
+}
+
+
+def _parse_price(params: dict, name: str):
+    value = params.get(name)
+    if value in (None, ''):
+        return None
+    try:
+        price = Decimal(value)
+    except InvalidOperation:
+        raise ValueError(f'{name} должен быть числом')
+    if not price.is_finite() or price < 0:
+        raise ValueError(f'{name} должен быть неотрицательным числом')
+    return price
+
+
+def encode_cursor(sort: str, key: str, voucher_id) -> str:
+    """Ключ сортировки хранится в текстовом виде PostgreSQL: так без потерь переживают 'infinity' и real"""
+    raw = json.dumps([sort, key, str(voucher_id)], separators=(',', ':'))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor: str, sort: str) -> tuple:
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        cursor_sort, key, voucher_id = json.loads(raw)
+        voucher_id = str(uuid.UUID(voucher_id))
+        if cursor_sort == sort and key not in ('infinity', '-infinity'):
+            if SORTS[sort][1] in ('date', 'timestamp'):
+                datetime.fromisoformat(key)
+            elif not Decimal(key).is_finite():
+                raise ValueError
+    except (ValueError, TypeError, AttributeError, InvalidOperation):
+        raise ValueError('Некорректный cursor')
+    if cursor_sort != sort:
+        raise ValueError('cursor получен для другой сортировки')
+    return key, voucher_id
+
+
+def parse_search_params(params: dict) -> dict:
+    """Проверяет параметры поиска; ValueError с сообщением для клиента"""
+    q = (params.get('q') or '').strip()
+    if len(q) > QUERY_MAX_LENGTH:
+        raise ValueError(f'q не длиннее {QUERY_MAX_LENGTH} символов')
+
+    sort = params.get('sort') or ('relevance' if q else 'price_asc')
+    if sort not in SORTS:
+        raise ValueError(f"sort должен быть одним из: {', '.join(SORTS)}")
+    if sort == 'relevance' and not q:
+        raise ValueError('Сортировка relevance требует q')
+
+    fields = [f.strip() for f in params['fields'].split(',')] if params.get('fields') else list(DEFAULT_FIELDS)
+    unknown = [f for f in fields if f not in FIELDS]
+    if unknown:
+        raise ValueError(f"Неизвестные поля: {', '.join(unknown)}")
+    if 'id' not in fields:
+        fields.insert(0, 'id')
+
+    try:
+        limit = int(params.get('limit') or DEFAULT_LIMIT)
+    except ValueError:
+        raise ValueError('limit должен быть числом')
+    if not 0 < limit <= MAX_LIMIT:
+        raise ValueError(f'limit должен быть от 1 до {MAX_LIMIT}')
+
+    min_price = _parse_price(params, 'min_price')
+    max_price = _parse_price(params, 'max_price')
+    if min_price is not None and max_price is not None and min_price > max_price:
+        raise ValueError('min_price больше max_price')
+
+    category = params.get('category')
+    return {
+        'q': q or None,
+        'category': category if category and category != 'Все' else None,
+        'min_price': min_price,
+        'max_price': max_price,
+        'sort': sort,
+        'fields': fields,
+        'limit': limit,
+        'cursor': decode_cursor(params['cursor'], sort) if params.get('cursor') else None,
+    }
+
+
+def search_vouchers(cur, query: dict) -> dict:
+    """Страница результатов; next_cursor передаётся обратно в cursor"""
+    key, key_type, direction = SORTS[query['sort']]
+    conditions = [
+        "v.is_active = true",
+        "(v.valid_until IS NULL OR v.valid_until >= CURRENT_DATE)",
+        """CASE WHEN v.stock_shards > 0
+                THEN EXISTS (SELECT 1 FROM voucher_stock_shards s
+                             WHERE s.voucher_id = v.id AND s.remaining_quantity > 0)
+                ELSE v.remaining_quantity > 0
+           END""",
+    ]
+    args = {'limit': query['limit'] + 1}
+
+    if query['q']:
+        # Слова целиком ищет полнотекстовый индекс, части слов — ILIKE по бренду и названию
+        conditions.append("""(v.search_vector @@ websearch_to_tsquery('simple', %(q)s)
+                              OR (v.brand_name || ' ' || v.title) ILIKE %(pattern)s)""")
+        escaped = query['q'].replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+        args.update(q=query['q'], pattern=f'%{escaped}%')
+    if query['category']:
+        conditions.append("v.category = %(category)s")
+        args['category'] = query['category']
+    if query['min_price'] is not None:
+        conditions.append("v.price_spitak >= %(min_price)s")
+        args['min_price'] = query['min_price']
+    if query['max_price'] is not None:
+        conditions.append("v.price_spitak <= %(max_price)s")
+        args['max_price'] = query['max_price']
+    if query['cursor']:
+        operator = '>' if direction == 'ASC' else '<'
+        conditions.append(f"({key}, v.id) {operator} (%(cursor_key)s::{key_type}, %(cursor_id)s::uuid)")
+        args['cursor_key'], args['cursor_id'] = query['cursor']
+
+    columns = ', '.join(f'{FIELDS[name]} AS {name}' for name in query['fields'])
+    cur.execute(f"""
+        SELECT {columns}, ({key})::text AS sort_key
+        FROM vouchers v
+        WHERE {' AND '.join(conditions)}
+        ORDER BY {key} {direction}, v.id {direction}
+        LIMIT %(limit)s
+    """, args)
+    rows = cur.fetchall()
+
+    next_cursor = None
+    if len(rows) > query['limit']:
+        rows = rows[:query['limit']]
+        next_cursor = encode_cursor(query['sort'], rows[-1]['sort_key'], rows[-1]['id'])
+    for row in rows:
+        del row['sort_key']
+    return {'vouchers': rows, 'next_cursor': next_cursor}
@@ -0,0 +1,16 @@
+-- Шардирование остатков ваучеров для флеш-продаж
+
+-- Число шардов остатка; 0 означает, что остаток хранится в vouchers.remaining_quantity
+ALTER TABLE vouchers ADD COLUMN IF NOT EXISTS stock_shards INT NOT NULL DEFAULT 0;
+
+-- Остаток ваучера, разбитый на независимые счётчики
+CREATE TABLE IF NOT EXISTS voucher_stock_shards (
+    voucher_id UUID NOT NULL,
+    shard INT NOT NULL,
+    remaining_quantity INT NOT NULL,
+    PRIMARY KEY (voucher_id, shard)
+);
+
+-- Страховка от перепродажи
+ALTER TABLE vouchers ADD CONSTRAINT vouchers_remaining_non_negative CHECK (remaining_quantity >= 0);
+ALTER TABLE voucher_stock_shards ADD CONSTRAINT voucher_stock_shards_remaining_non_negative CHECK (remaining_quantity >= 0);
@@ -0,0 +1,11 @@
+-- Агрегаты битвы районов по дням и неделям, обновляются дельтами при приёме шагов
+
+CREATE TABLE IF NOT EXISTS district_stats (
+    period VARCHAR(10) NOT NULL,
+    period_start DATE NOT NULL,
+    district VARCHAR(50) NOT NULL,
+    total_steps BIGINT NOT NULL DEFAULT 0,
+    active_users INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (period, period_start, district)
+);
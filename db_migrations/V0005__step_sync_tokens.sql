@@ -0,0 +1,12 @@
+-- Ключи идемпотентности синхронизаций шагов: повтор запроса возвращает исходный результат
+
+CREATE TABLE IF NOT EXISTS step_sync_tokens (
+    user_id UUID NOT NULL,
+    sync_id VARCHAR(64) NOT NULL,
+    result JSONB,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, sync_id)
+);
+
+-- Для удаления ключей старше срока хранения
+CREATE INDEX IF NOT EXISTS idx_step_sync_tokens_created ON step_sync_tokens(created_at);
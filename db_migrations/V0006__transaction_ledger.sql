@@ -0,0 +1,99 @@
+-- Журнал транзакций только на добавление, разбитый по месяцам.
+-- Балансы считаются как снимок из balance_snapshots плюс хвост журнала после снимка;
+-- столбцы balance_spitak, total_earned и balance_steps в users больше не обновляются.
+
+ALTER TABLE transactions RENAME TO transactions_legacy;
+
+CREATE TABLE transactions (
+    id UUID NOT NULL DEFAULT gen_random_uuid(),
+    user_id UUID NOT NULL,
+    type VARCHAR(20) NOT NULL,
+    amount DECIMAL(18, 2) NOT NULL,
+    currency VARCHAR(10) DEFAULT 'SPITAK',
+    status VARCHAR(15) DEFAULT 'pending',
+    description TEXT,
+    bank_tx_id TEXT,
+    metadata JSONB,
+    -- Влияние записи на баланс, накопленный заработок и шаги пользователя
+    delta_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    delta_earned DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    delta_steps BIGINT NOT NULL DEFAULT 0,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (id, created_at)
+) PARTITION BY RANGE (created_at);
+
+CREATE TABLE IF NOT EXISTS transactions_default PARTITION OF transactions DEFAULT;
+
+CREATE INDEX IF NOT EXISTS idx_transactions_ledger_user_created ON transactions(user_id, created_at);
+CREATE INDEX IF NOT EXISTS idx_transactions_ledger_status ON transactions(status);
+
+-- Создаёт месячные секции от месяца from_date до текущего месяца + months_ahead
+CREATE OR REPLACE FUNCTION ensure_transaction_partitions(from_date DATE, months_ahead INT)
+RETURNS INT AS $$
+DECLARE
+    month_start DATE := date_trunc('month', from_date)::date;
+    last_month DATE := (date_trunc('month', CURRENT_DATE) + make_interval(months => months_ahead))::date;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    WHILE month_start <= last_month LOOP
+        partition_name := 'transactions_' || to_char(month_start, 'YYYY_MM');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF transactions FOR VALUES FROM (%L) TO (%L)',
+                partition_name, month_start, (month_start + INTERVAL '1 month')::date
+            );
+            created := created + 1;
+        END IF;
+        month_start := (month_start + INTERVAL '1 month')::date;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_transaction_partitions(
+    COALESCE((SELECT MIN(created_at)::date FROM transactions_legacy), CURRENT_DATE), 3
+);
+
+INSERT INTO transactions (id, user_id, type, amount, currency, status, description, bank_tx_id, metadata,
+                          delta_spitak, delta_earned, created_at, updated_at)
+SELECT id, user_id, type, amount, currency, status, description, bank_tx_id, metadata,
+       CASE type WHEN 'mint' THEN amount WHEN 'purchase' THEN -amount ELSE 0 END,
+       CASE type WHEN 'mint' THEN amount ELSE 0 END,
+       COALESCE(created_at, CURRENT_TIMESTAMP - INTERVAL '1 microsecond'), updated_at
+FROM transactions_legacy;
+
+DROP TABLE transactions_legacy;
+
+-- Снимок баланса: всё, что записано в журнал раньше covered_until
+CREATE TABLE IF NOT EXISTS balance_snapshots (
+    user_id UUID PRIMARY KEY,
+    balance_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    total_earned DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    balance_steps BIGINT NOT NULL DEFAULT 0,
+    covered_until TIMESTAMP NOT NULL,
+    taken_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Входящие остатки: журнал до миграции не содержал всех начислений (например, реферальных),
+-- поэтому разница с текущими столбцами users фиксируется одной записью на пользователя
+INSERT INTO transactions (user_id, type, amount, currency, status, description,
+                          delta_spitak, delta_earned, delta_steps, created_at)
+SELECT u.id, 'opening_balance', 0, 'SPITAK', 'completed', 'Входящий остаток при переходе на журнал',
+       COALESCE(u.balance_spitak, 0) - COALESCE(l.delta_spitak, 0),
+       COALESCE(u.total_earned, 0) - COALESCE(l.delta_earned, 0),
+       COALESCE(u.balance_steps, 0) - COALESCE(l.delta_steps, 0),
+       CURRENT_TIMESTAMP - INTERVAL '1 microsecond'
+FROM users u
+LEFT JOIN (
+    SELECT user_id, SUM(delta_spitak) AS delta_spitak, SUM(delta_earned) AS delta_earned, SUM(delta_steps) AS delta_steps
+    FROM transactions GROUP BY user_id
+) l ON l.user_id = u.id
+WHERE COALESCE(u.balance_spitak, 0) <> COALESCE(l.delta_spitak, 0)
+   OR COALESCE(u.total_earned, 0) <> COALESCE(l.delta_earned, 0)
+   OR COALESCE(u.balance_steps, 0) <> COALESCE(l.delta_steps, 0);
+
+INSERT INTO balance_snapshots (user_id, balance_spitak, total_earned, balance_steps, covered_until)
+SELECT id, COALESCE(balance_spitak, 0), COALESCE(total_earned, 0), COALESCE(balance_steps, 0), CURRENT_TIMESTAMP
+FROM users;
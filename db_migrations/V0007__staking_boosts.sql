@@ -0,0 +1,68 @@
+-- Готовые boost-множители пользователей для начисления за шаги.
+-- Правила: учитываются активные стейки, у которых не наступил unlock_at;
+-- надбавки стейков (multiplier - 1) складываются, итог ограничен 3.0.
+
+-- Покрывающий индекс: расчёт множителя читает только индекс
+CREATE INDEX IF NOT EXISTS idx_staking_active_boost ON staking(user_id, unlock_at)
+    INCLUDE (multiplier) WHERE is_active = true;
+
+-- Строка есть только у пользователей с действующим boost;
+-- valid_until — ближайший unlock_at, после которого множитель нужно пересчитать
+CREATE TABLE IF NOT EXISTS user_boosts (
+    user_id UUID PRIMARY KEY,
+    multiplier DECIMAL(6, 2) NOT NULL,
+    valid_until TIMESTAMP,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE OR REPLACE FUNCTION compute_boost(p_user_id UUID, p_at TIMESTAMP)
+RETURNS TABLE (multiplier DECIMAL(6, 2), valid_until TIMESTAMP) AS $$
+    SELECT LEAST(3.0, 1 + COALESCE(SUM(GREATEST(COALESCE(s.multiplier, 1) - 1, 0)), 0))::DECIMAL(6, 2),
+           MIN(s.unlock_at)
+    FROM staking s
+    WHERE s.user_id = p_user_id
+      AND s.is_active = true
+      AND (s.unlock_at IS NULL OR s.unlock_at > p_at)
+$$ LANGUAGE sql STABLE;
+
+CREATE OR REPLACE FUNCTION refresh_user_boost(p_user_id UUID)
+RETURNS VOID AS $$
+DECLARE
+    boost RECORD;
+BEGIN
+    SELECT * INTO boost FROM compute_boost(p_user_id, CURRENT_TIMESTAMP::timestamp);
+    IF boost.multiplier = 1 AND boost.valid_until IS NULL THEN
+        DELETE FROM user_boosts WHERE user_id = p_user_id;
+    ELSE
+        INSERT INTO user_boosts (user_id, multiplier, valid_until, updated_at)
+        VALUES (p_user_id, boost.multiplier, boost.valid_until, CURRENT_TIMESTAMP)
+        ON CONFLICT (user_id) DO UPDATE SET
+            multiplier = EXCLUDED.multiplier,
+            valid_until = EXCLUDED.valid_until,
+            updated_at = EXCLUDED.updated_at;
+    END IF;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Любое изменение стейка пересчитывает множитель и оповещает кэши процессов
+CREATE OR REPLACE FUNCTION staking_boost_changed()
+RETURNS TRIGGER AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        PERFORM refresh_user_boost(OLD.user_id);
+        PERFORM pg_notify('staking_changed', OLD.user_id::text);
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') AND (TG_OP = 'INSERT' OR NEW.user_id IS DISTINCT FROM OLD.user_id) THEN
+        PERFORM refresh_user_boost(NEW.user_id);
+        PERFORM pg_notify('staking_changed', NEW.user_id::text);
+    END IF;
+    RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_staking_boost ON staking;
+CREATE TRIGGER trg_staking_boost
+    AFTER INSERT OR UPDATE OR DELETE ON staking
+    FOR EACH ROW EXECUTE FUNCTION staking_boost_changed();
+
+SELECT refresh_user_boost(user_id) FROM (SELECT DISTINCT user_id FROM staking) s;
@@ -0,0 +1,7 @@
+-- Серия дней подряд с шагами не ниже порога.
+-- streak_last_date — последний день, засчитанный в серию; серия считается
+-- прерванной, если этот день раньше вчерашнего.
+ALTER TABLE users ADD COLUMN IF NOT EXISTS streak_last_date DATE;
+
+-- Ночной сброс ищет только пользователей с ненулевой серией
+CREATE INDEX IF NOT EXISTS idx_users_streak_last_date ON users(streak_last_date) WHERE streak_days > 0;
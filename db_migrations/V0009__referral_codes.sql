@@ -0,0 +1,31 @@
+-- Реферальные коды без повторных попыток: номер из последовательности
+-- проходит биективную перестановку 45-битного пространства и кодируется
+-- 9 символами base32 без похожих символов (0/O, 1/I). Разные номера всегда
+-- дают разные коды (до 2^45 выдач); старые случайные коды имеют длину 8
+-- и с новыми не пересекаются.
+CREATE SEQUENCE IF NOT EXISTS referral_code_seq;
+
+CREATE OR REPLACE FUNCTION referral_code(n BIGINT)
+RETURNS VARCHAR(10) AS $$
+DECLARE
+    mask CONSTANT BIGINT := 35184372088831;  -- 2^45 - 1
+    alphabet CONSTANT TEXT := '23456789ABCDEFGHJKLMNPQRSTUVWXYZ';
+    x BIGINT := n & mask;
+    code TEXT := '';
+BEGIN
+    -- Умножение на нечётное число и xorshift обратимы по модулю 2^45;
+    -- три раунда разносят влияние младших битов номера на все символы кода
+    x := (x * 92821) & mask;
+    x := x # (x >> 23);
+    x := (x * 126611) & mask;
+    x := x # (x >> 19);
+    x := (x * 104729) & mask;
+    x := x # (x >> 24);
+    FOR i IN 0..8 LOOP
+        code := code || substr(alphabet, ((x >> (5 * i)) & 31)::int + 1, 1);
+    END LOOP;
+    RETURN code;
+END;
+$$ LANGUAGE plpgsql IMMUTABLE;
+
+ALTER TABLE users ALTER COLUMN referral_code SET DEFAULT referral_code(nextval('referral_code_seq'));
@@ -0,0 +1,51 @@
+-- Граф рефералов: таблица замыкания (предок, потомок, уровень) до 10 уровней
+-- и материализованные счётчики по пригласившим. Обе таблицы пополняются
+-- тем же запросом, что регистрирует пользователя.
+
+CREATE INDEX IF NOT EXISTS idx_referrals_referrer ON referrals(referrer_id);
+CREATE INDEX IF NOT EXISTS idx_referrals_referred_user ON referrals(referred_user_id);
+CREATE INDEX IF NOT EXISTS idx_users_referred_by ON users(referred_by) WHERE referred_by IS NOT NULL;
+
+CREATE TABLE IF NOT EXISTS referral_closure (
+    ancestor_id UUID NOT NULL,
+    descendant_id UUID NOT NULL,
+    depth SMALLINT NOT NULL,
+    PRIMARY KEY (ancestor_id, depth, descendant_id)
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_closure_descendant ON referral_closure(descendant_id, depth);
+
+CREATE TABLE IF NOT EXISTS referral_stats (
+    user_id UUID PRIMARY KEY,
+    direct_count INT NOT NULL DEFAULT 0,
+    downline_count INT NOT NULL DEFAULT 0,
+    bonus_earned DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_referral_stats_direct ON referral_stats(direct_count DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_referral_stats_downline ON referral_stats(downline_count DESC, user_id);
+CREATE INDEX IF NOT EXISTS idx_referral_stats_earned ON referral_stats(bonus_earned DESC, user_id);
+
+-- Заполнение по существующим users.referred_by (однократно, рекурсивно по уровням)
+INSERT INTO referral_closure (ancestor_id, descendant_id, depth)
+WITH RECURSIVE chain AS (
+    SELECT referred_by AS ancestor_id, id AS descendant_id, 1 AS depth
+    FROM users
+    WHERE referred_by IS NOT NULL
+    UNION ALL
+    SELECT u.referred_by, c.descendant_id, c.depth + 1
+    FROM chain c
+    JOIN users u ON u.id = c.ancestor_id
+    WHERE u.referred_by IS NOT NULL AND c.depth < 10
+)
+SELECT ancestor_id, descendant_id, depth FROM chain
+ON CONFLICT DO NOTHING;
+
+INSERT INTO referral_stats (user_id, direct_count, downline_count, bonus_earned)
+SELECT c.ancestor_id,
+       COUNT(*) FILTER (WHERE c.depth = 1),
+       COUNT(*),
+       COALESCE((SELECT SUM(r.bonus_spitak) FROM referrals r WHERE r.referrer_id = c.ancestor_id), 0)
+FROM referral_closure c
+GROUP BY c.ancestor_id;
@@ -0,0 +1,146 @@
+-- Сырые внутридневные отсчёты шагов. Одна строка — отсчёты одного пользователя
+-- за день из одной синхронизации: минуты суток и шаги в параллельных массивах.
+-- Таблица разбита по дням; старые секции сжимаются до строки на пользователя
+-- и день, а по истечении срока хранения удаляются (см. samples.py).
+
+CREATE TABLE IF NOT EXISTS step_samples (
+    user_id UUID NOT NULL,
+    sample_date DATE NOT NULL,
+    received_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    minutes SMALLINT[] NOT NULL,
+    steps INT[] NOT NULL
+) PARTITION BY RANGE (sample_date);
+
+CREATE TABLE IF NOT EXISTS step_samples_default PARTITION OF step_samples DEFAULT;
+
+-- Свёртка читает новые строки по времени приёма: BRIN почти ничего не весит
+-- на таблице, куда только дописывают
+CREATE INDEX IF NOT EXISTS idx_step_samples_received ON step_samples USING BRIN (received_at);
+CREATE INDEX IF NOT EXISTS idx_step_samples_user_date ON step_samples(user_id, sample_date);
+
+-- Почасовые суммы для графиков и антифрода
+CREATE TABLE IF NOT EXISTS step_hourly (
+    user_id UUID NOT NULL,
+    date DATE NOT NULL,
+    hour SMALLINT NOT NULL,
+    steps_count INT NOT NULL DEFAULT 0,
+    sample_count INT NOT NULL DEFAULT 0,
+    PRIMARY KEY (user_id, date, hour)
+);
+
+-- Сумма шагов по отсчётам рядом с начисленными steps_count
+ALTER TABLE daily_steps
+    ADD COLUMN IF NOT EXISTS sampled_steps INT NOT NULL DEFAULT 0,
+    ADD COLUMN IF NOT EXISTS sample_count INT NOT NULL DEFAULT 0;
+
+-- Граница свёртки: всё, что принято не позже rolled_until, уже в агрегатах
+CREATE TABLE IF NOT EXISTS step_sample_rollup (
+    id BOOLEAN PRIMARY KEY DEFAULT true CHECK (id),
+    rolled_until TIMESTAMP NOT NULL
+);
+
+INSERT INTO step_sample_rollup (id, rolled_until) VALUES (true, CURRENT_TIMESTAMP)
+ON CONFLICT (id) DO NOTHING;
+
+CREATE TABLE IF NOT EXISTS step_sample_compactions (
+    sample_date DATE PRIMARY KEY,
+    rows_before INT NOT NULL,
+    rows_after INT NOT NULL,
+    compacted_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Создаёт дневные секции от from_date до текущей даты + days_ahead.
+-- toast_tuple_target = 128 отправляет в сжатый TOAST уже массивы от ~20 отсчётов
+CREATE OR REPLACE FUNCTION ensure_step_sample_partitions(from_date DATE, days_ahead INT)
+RETURNS INT AS $$
+DECLARE
+    day DATE := from_date;
+    partition_name TEXT;
+    created INT := 0;
+BEGIN
+    WHILE day <= CURRENT_DATE + days_ahead LOOP
+        partition_name := 'step_samples_' || to_char(day, 'YYYYMMDD');
+        IF to_regclass(partition_name) IS NULL THEN
+            EXECUTE format(
+                'CREATE TABLE %I PARTITION OF step_samples FOR VALUES FROM (%L) TO (%L) WITH (toast_tuple_target = 128)',
+                partition_name, day, day + 1
+            );
+            created := created + 1;
+        END IF;
+        day := day + 1;
+    END LOOP;
+    RETURN created;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Переписывает секцию дня: строки, принятые не позже watermark (уже свёрнутые),
+-- склеиваются в одну на пользователя, более поздние копируются как есть.
+-- Новая таблица подменяет секцию, поэтому место старой освобождается сразу.
+CREATE OR REPLACE FUNCTION compact_step_samples(day DATE, watermark TIMESTAMP)
+RETURNS INT AS $$
+DECLARE
+    partition_name TEXT := 'step_samples_' || to_char(day, 'YYYYMMDD');
+    compacted_name TEXT := partition_name || '_compact';
+    rows_after INT;
+BEGIN
+    IF to_regclass(partition_name) IS NULL THEN
+        RETURN 0;
+    END IF;
+    EXECUTE format('LOCK TABLE %I IN EXCLUSIVE MODE', partition_name);
+    EXECUTE format(
+        'CREATE TABLE %I (LIKE step_samples INCLUDING DEFAULTS) WITH (toast_tuple_target = 128)',
+        compacted_name
+    );
+    EXECUTE format($sql$
+        INSERT INTO %1$I (user_id, sample_date, received_at, minutes, steps)
+        SELECT s.user_id, s.sample_date, MAX(s.received_at),
+               array_agg(x.minute ORDER BY x.minute, x.steps),
+               array_agg(x.steps ORDER BY x.minute, x.steps)
+        FROM %2$I s, unnest(s.minutes, s.steps) AS x(minute, steps)
+        WHERE s.received_at <= %3$L
+        GROUP BY s.user_id, s.sample_date
+        UNION ALL
+        SELECT user_id, sample_date, received_at, minutes, steps
+        FROM %2$I
+        WHERE received_at > %3$L
+    $sql$, compacted_name, partition_name, watermark);
+    GET DIAGNOSTICS rows_after = ROW_COUNT;
+    EXECUTE format(
+        'ALTER TABLE %I ADD CONSTRAINT %I CHECK (sample_date >= %L AND sample_date < %L)',
+        compacted_name, partition_name || '_range', day, day + 1
+    );
+    EXECUTE format('ALTER TABLE step_samples DETACH PARTITION %I', partition_name);
+    EXECUTE format('DROP TABLE %I', partition_name);
+    EXECUTE format('ALTER TABLE %I RENAME TO %I', compacted_name, partition_name);
+    EXECUTE format(
+        'ALTER TABLE step_samples ATTACH PARTITION %I FOR VALUES FROM (%L) TO (%L)',
+        partition_name, day, day + 1
+    );
+    RETURN rows_after;
+END;
+$$ LANGUAGE plpgsql;
+
+-- Удаляет дневные секции раньше before_date
+CREATE OR REPLACE FUNCTION drop_step_sample_partitions(before_date DATE)
+RETURNS INT AS $$
+DECLARE
+    partition_name TEXT;
+    dropped INT := 0;
+BEGIN
+    FOR partition_name IN
+        SELECT c.relname
+        FROM pg_inherits i
+        JOIN pg_class c ON c.oid = i.inhrelid
+        WHERE i.inhparent = 'step_samples'::regclass
+          AND c.relname ~ '^step_samples_[0-9]{8}$'
+          AND to_date(substr(c.relname, 14), 'YYYYMMDD') < before_date
+    LOOP
+        EXECUTE format('DROP TABLE %I', partition_name);
+        dropped := dropped + 1;
+    END LOOP;
+    DELETE FROM step_sample_compactions WHERE sample_date < before_date;
+    RETURN dropped;
+END;
+$$ LANGUAGE plpgsql;
+
+SELECT ensure_step_sample_partitions(CURRENT_DATE - 7, 3);
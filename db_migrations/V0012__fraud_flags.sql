@@ -0,0 +1,18 @@
+-- Подозрительные дни пользователей. source = 'ingest' — синхронизация отклонена
+-- при приёме, 'batch' — ночная проверка истории (см. fraud.py).
+CREATE TABLE IF NOT EXISTS fraud_flags (
+    user_id UUID NOT NULL,
+    date DATE NOT NULL,
+    source VARCHAR(10) NOT NULL,
+    score REAL NOT NULL,
+    reasons TEXT[] NOT NULL,
+    details JSONB,
+    reviewed BOOLEAN NOT NULL DEFAULT false,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (user_id, date, source)
+);
+
+CREATE INDEX IF NOT EXISTS idx_fraud_flags_review ON fraud_flags(date DESC, score DESC) WHERE NOT reviewed;
+
+-- Окно истории для ночной проверки читается по дате
+CREATE INDEX IF NOT EXISTS idx_daily_steps_date ON daily_steps(date);
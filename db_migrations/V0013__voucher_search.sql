@@ -0,0 +1,34 @@
+-- Поиск по каталогу ваучеров: полнотекстовый вектор по бренду, названию и
+-- описанию, составные индексы под сортировки с keyset-пагинацией (см. search.py).
+-- Конфигурация 'simple' не стеммит: в каталоге смешаны русский, армянский и латиница.
+
+ALTER TABLE vouchers ADD COLUMN IF NOT EXISTS search_vector tsvector
+    GENERATED ALWAYS AS (
+        setweight(to_tsvector('simple', coalesce(brand_name, '')), 'A') ||
+        setweight(to_tsvector('simple', coalesce(title, '')), 'B') ||
+        setweight(to_tsvector('simple', coalesce(description, '')), 'C')
+    ) STORED;
+
+CREATE INDEX IF NOT EXISTS idx_vouchers_search ON vouchers USING GIN (search_vector);
+
+-- Сортировки каталога; неактивные ваучеры в индексы не попадают
+CREATE INDEX IF NOT EXISTS idx_vouchers_active_category_price
+    ON vouchers(category, price_spitak, id) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_vouchers_active_price
+    ON vouchers(price_spitak, id) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_vouchers_active_created
+    ON vouchers((COALESCE(created_at, '-infinity'::timestamp)), id) WHERE is_active;
+CREATE INDEX IF NOT EXISTS idx_vouchers_active_valid_until
+    ON vouchers((COALESCE(valid_until, 'infinity'::date)), id) WHERE is_active;
+
+-- Подстрочный поиск (ILIKE '%...%') по бренду и названию ускоряет триграммный
+-- индекс; без расширения pg_trgm запрос работает, но без индекса
+DO $$
+BEGIN
+    IF EXISTS (SELECT 1 FROM pg_available_extensions WHERE name = 'pg_trgm') THEN
+        CREATE EXTENSION IF NOT EXISTS pg_trgm;
+        EXECUTE 'CREATE INDEX IF NOT EXISTS idx_vouchers_name_trgm ON vouchers '
+                'USING GIN ((brand_name || '' '' || title) gin_trgm_ops)';
+    END IF;
+END;
+$$;
@@ -0,0 +1,48 @@
+-- Транзакционный outbox: побочные эффекты синхронизаций, покупок и регистраций
+-- (агрегаты битвы районов, учёт сожжённых токенов, аналитика, уведомления)
+-- пишутся событиями в том же выражении, что и основная запись, и выполняются
+-- фоновым разборщиком пачками (см. outbox.py).
+
+-- shard — группа пользователей; разборщик держит advisory-блокировку на группу,
+-- поэтому события одного пользователя обрабатываются по порядку id.
+-- Число групп совпадает с OUTBOX_SHARDS в outbox.py
+CREATE TABLE IF NOT EXISTS outbox_events (
+    id BIGSERIAL PRIMARY KEY,
+    user_id UUID NOT NULL,
+    event_type VARCHAR(40) NOT NULL,
+    payload JSONB NOT NULL,
+    shard SMALLINT GENERATED ALWAYS AS ((hashtextextended(user_id::text, 0) & 15)::smallint) STORED,
+    attempts INT NOT NULL DEFAULT 0,
+    available_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP
+);
+
+CREATE INDEX IF NOT EXISTS idx_outbox_events_shard ON outbox_events(shard, id);
+-- Проверка, не ждёт ли более раннее событие пользователя повторной попытки
+CREATE INDEX IF NOT EXISTS idx_outbox_events_user ON outbox_events(user_id, id) WHERE attempts > 0;
+
+-- События, исчерпавшие попытки; больше не задерживают события пользователя
+CREATE TABLE IF NOT EXISTS outbox_dead_letters (
+    id BIGINT PRIMARY KEY,
+    user_id UUID NOT NULL,
+    event_type VARCHAR(40) NOT NULL,
+    payload JSONB NOT NULL,
+    attempts INT NOT NULL,
+    last_error TEXT,
+    created_at TIMESTAMP NOT NULL,
+    failed_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
+
+-- Дневная аналитика токена: выпуск за шаги, траты и сжигание при покупках, регистрации
+CREATE TABLE IF NOT EXISTS token_daily_stats (
+    date DATE PRIMARY KEY,
+    steps BIGINT NOT NULL DEFAULT 0,
+    minted_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    purchases INT NOT NULL DEFAULT 0,
+    spent_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    burned_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    registrations INT NOT NULL DEFAULT 0,
+    referred_registrations INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
@@ -0,0 +1,24 @@
+-- Погашение ваучеров на кассах партнёров (см. redemption.py).
+-- Поиск идёт по уникальному индексу redemption_code, погашение — условный UPDATE.
+
+-- Терминал, который погасил ваучер; для офлайн-пачек redeemed_at — время сканирования
+ALTER TABLE voucher_purchases ADD COLUMN IF NOT EXISTS redeemed_terminal VARCHAR(64);
+
+-- Счётчики погашений партнёра по дням, разбитые на шарды, чтобы кассы одного
+-- партнёра в час пик не ждали друг друга на одной строке
+CREATE TABLE IF NOT EXISTS merchant_redemption_counters (
+    brand_name VARCHAR(100) NOT NULL,
+    date DATE NOT NULL,
+    shard SMALLINT NOT NULL,
+    redemptions INT NOT NULL DEFAULT 0,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    PRIMARY KEY (brand_name, date, shard)
+);
+
+INSERT INTO merchant_redemption_counters (brand_name, date, shard, redemptions)
+SELECT v.brand_name, p.redeemed_at::date, 0, COUNT(*)
+FROM voucher_purchases p
+JOIN vouchers v ON v.id = p.voucher_id
+WHERE p.is_redeemed AND p.redeemed_at IS NOT NULL
+GROUP BY v.brand_name, p.redeemed_at::date
+ON CONFLICT DO NOTHING;
@@ -0,0 +1,11 @@
+-- Версии профилей для кэша профилей в функции users (см. profile_cache.py).
+-- Версию увеличивает тем же выражением каждая запись, меняющая баланс или поля
+-- профиля: синхронизация шагов, покупка ваучера, реферальный бонус, PUT профиля
+-- и перестроение снимков баланса. Отдельная узкая таблица, а не колонка users,
+-- чтобы начисления по-прежнему не обновляли строку users при каждой синхронизации.
+-- Нет строки — версия 0.
+CREATE TABLE IF NOT EXISTS profile_versions (
+    user_id UUID PRIMARY KEY,
+    version BIGINT NOT NULL DEFAULT 1,
+    updated_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+);
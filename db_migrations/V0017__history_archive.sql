@@ -0,0 +1,49 @@
+-- Архив холодной истории daily_steps и transactions (см. archive.py).
+-- Месяцы старше срока выгружаются COPY в сжатые CSV, разложенные по корзинам
+-- пользователей, хранятся здесь же, в базе, и удаляются из основных таблиц:
+-- облачные функции читают архив тем же соединением, что и таблицы.
+
+-- Выгруженные месяцы; columns — порядок столбцов в CSV.
+-- exported — корзины записаны, строки ещё в таблице, архив не читается;
+-- archived — выгрузка сверена с таблицей, история читается из архива;
+--            строки удалены из таблицы, когда заполнен deleted_at
+CREATE TABLE IF NOT EXISTS archive_segments (
+    table_name VARCHAR(40) NOT NULL,
+    period_start DATE NOT NULL,
+    period_end DATE NOT NULL,
+    buckets SMALLINT NOT NULL,
+    row_count BIGINT NOT NULL,
+    bytes BIGINT NOT NULL,
+    columns TEXT[] NOT NULL,
+    status VARCHAR(10) NOT NULL DEFAULT 'exported',
+    archived_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    deleted_at TIMESTAMP,
+    PRIMARY KEY (table_name, period_start)
+);
+
+-- Корзина месяца: строки её пользователей одним gzip CSV, отсортированные по user_id
+CREATE TABLE IF NOT EXISTS archive_blobs (
+    table_name VARCHAR(40) NOT NULL,
+    period_start DATE NOT NULL,
+    bucket SMALLINT NOT NULL,
+    row_count INT NOT NULL,
+    data BYTEA NOT NULL,
+    PRIMARY KEY (table_name, period_start, bucket)
+);
+
+-- Данные уже сжаты: TOAST не пытается сжать их повторно
+ALTER TABLE archive_blobs ALTER COLUMN data SET STORAGE EXTERNAL;
+
+-- Суммы дельт удалённых из журнала записей: ledger.py verify сверяет балансы
+-- по журналу вместе с ними, а repair перестраивает снимки с их учётом
+CREATE TABLE IF NOT EXISTS ledger_archive_totals (
+    user_id UUID PRIMARY KEY,
+    delta_spitak DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    delta_earned DECIMAL(18, 2) NOT NULL DEFAULT 0,
+    delta_steps BIGINT NOT NULL DEFAULT 0,
+    archived_until TIMESTAMP NOT NULL
+);
+
+-- Удаление месяца пачками ищет строки по дате. Строки daily_steps пишутся
+-- по порядку дней, поэтому BRIN почти ничего не весит и не замедляет приём шагов
+CREATE INDEX IF NOT EXISTS idx_daily_steps_date_brin ON daily_steps USING BRIN (date);
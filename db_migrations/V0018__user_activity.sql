@@ -0,0 +1,22 @@
+-- Окна активности пользователя для счётчиков активных в битве районов (см. ingest.py).
+-- По строке на пользователя и окно: day и week хранят начало текущего окна,
+-- all — день, с которого пользователь учтён. Синхронизация вставляет или сдвигает
+-- строку одним INSERT ... ON CONFLICT; строку, которая вставлена или сдвинулась,
+-- получает только одна транзакция, и только она увеличивает active_users.
+CREATE TABLE IF NOT EXISTS user_activity (
+    user_id UUID NOT NULL,
+    period VARCHAR(10) NOT NULL,
+    period_start DATE NOT NULL,
+    PRIMARY KEY (user_id, period)
+);
+
+INSERT INTO user_activity (user_id, period, period_start)
+SELECT u.id, p.period, p.period_start
+FROM users u
+CROSS JOIN LATERAL (VALUES
+    ('day', u.last_activity_date),
+    ('week', date_trunc('week', u.last_activity_date)::date),
+    ('all', u.last_activity_date)
+) AS p(period, period_start)
+WHERE u.last_activity_date IS NOT NULL
+ON CONFLICT DO NOTHING;
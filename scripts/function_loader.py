@@ -0,0 +1,31 @@
+"""
+Загрузка обработчиков облачных функций из backend/<имя>/index.py для локального запуска.
+Модули каждой функции (index, db и т.д.) изолируются, чтобы одноимённые файлы
+разных функций не перетирали друг друга в sys.modules.
+"""
+import importlib
+import os
+import sys
+
+BACKEND_DIR = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), 'backend')
+
+
+def load_function(name: str):
+    """Импортирует index.py функции и возвращает модуль с handler"""
+    function_dir = os.path.join(BACKEND_DIR, name)
+    before = set(sys.modules)
+    sys.path.insert(0, function_dir)
+    try:
+        module = importlib.import_module('index')
+    finally:
+        sys.path.remove(function_dir)
+    for module_name in set(sys.modules) - before:
+        module_file = getattr(sys.modules[module_name], '__file__', None) or ''
+        if module_file.startswith(function_dir + os.sep):
+            module.__dict__.setdefault('_local_modules', {})[module_name] = sys.modules.pop(module_name)
+    return module
+
+
+def local_module(function_module, name: str):
+    """Вспомогательный модуль функции (например, db) после изоляции"""
+    return function_module._local_modules[name]
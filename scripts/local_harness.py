@@ -0,0 +1,628 @@
+"""
+Локальный запуск облачных функций по их tests.json.
+Создаёт временную базу в локальном PostgreSQL, накатывает db_migrations,
+импортирует index.handler каждой функции и вызывает его с event, собранным из
+описания теста. Запросы к БД считаются через подменённую фабрику курсоров пула.
+После тестов test выполняет проверки поведения, которое не видно по ответам (CHECKS).
+
+    LOCAL_PG_DSN="host=localhost user=postgres" python scripts/local_harness.py test
+    python scripts/local_harness.py bench --requests 500 --concurrency 16
+    python scripts/local_harness.py compare [старый.json новый.json]
+
+Результаты bench сохраняются в bench_results/<commit>.json; compare сравнивает
+два последних прогона (или указанные файлы) и завершается с кодом 3 при регрессии.
+"""
+import argparse
+import base64
+import glob
+import gzip
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+import uuid
+from datetime import date, timedelta
+from urllib.parse import parse_qsl, urlsplit
+
+import psycopg2
+from psycopg2.extras import RealDictCursor
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+REPO_DIR = os.path.dirname(SCRIPTS_DIR)
+BACKEND_DIR = os.path.join(REPO_DIR, 'backend')
+MIGRATIONS_DIR = os.path.join(REPO_DIR, 'db_migrations')
+RESULTS_DIR = os.path.join(REPO_DIR, 'bench_results')
+
+UUID_RE = re.compile(r'^[0-9a-f]{8}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{4}-[0-9a-f]{12}$', re.I)
+
+sys.path.insert(0, SCRIPTS_DIR)
+from function_loader import load_function, local_module  # noqa: E402
+
+_query_counter = threading.local()
+
+
+class CountingMixin:
+    """Примесь к классу курсора: считает запросы текущего потока"""
+
+    def execute(self, query, vars=None):
+        _query_counter.value = getattr(_query_counter, 'value', 0) + 1
+        return super().execute(query, vars)
+
+    def executemany(self, query, vars_list):
+        _query_counter.value = getattr(_query_counter, 'value', 0) + 1
+        return super().executemany(query, vars_list)
+
+    def copy_expert(self, sql, file, size=8192):
+        _query_counter.value = getattr(_query_counter, 'value', 0) + 1
+        return super().copy_expert(sql, file, size)
+
+
+class CountingCursor(CountingMixin, RealDictCursor):
+    """RealDictCursor со счётчиком запросов"""
+
+
+def migration_files() -> list:
+    """Миграции Flyway в порядке версий"""
+    def version(path):
+        return int(re.match(r'V(\d+)__', os.path.basename(path)).group(1))
+    return sorted(glob.glob(os.path.join(MIGRATIONS_DIR, 'V*__*.sql')), key=version)
+
+
+class LocalDatabase:
+    """Временная база с применёнными миграциями; удаляется при выходе"""
+
+    def __init__(self, admin_dsn: str, keep: bool = False):
+        self.admin_dsn = admin_dsn
+        self.keep = keep
+        self.name = 'spitak_local_' + uuid.uuid4().hex[:8]
+        self.dsn = f'{admin_dsn} dbname={self.name}'
+
+    def _admin(self, statement: str):
+        conn = psycopg2.connect(f'{self.admin_dsn} dbname=postgres')
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                cur.execute(statement)
+        finally:
+            conn.close()
+
+    def __enter__(self):
+        self._admin(f'CREATE DATABASE {self.name}')
+        conn = psycopg2.connect(self.dsn)
+        conn.autocommit = True
+        try:
+            with conn.cursor() as cur:
+                for path in migration_files():
+                    with open(path, encoding='utf-8') as f:
+                        cur.execute(f.read())
+        finally:
+            conn.close()
+        return self
+
+    def __exit__(self, *exc):
+        if self.keep:
+            print(f'База сохранена: {self.dsn}', file=sys.stderr)
+            return
+        self._admin(f'DROP DATABASE IF EXISTS {self.name} WITH (FORCE)')
+
+
+def load_cases(function: str) -> list:
+    path = os.path.join(BACKEND_DIR, function, 'tests.json')
+    if not os.path.exists(path):
+        return []
+    with open(path, encoding='utf-8') as f:
+        return json.load(f).get('tests', [])
+
+
+def functions() -> list:
+    return sorted(
+        name for name in os.listdir(BACKEND_DIR)
+        if os.path.exists(os.path.join(BACKEND_DIR, name, 'index.py'))
+    )
+
+
+def build_event(case: dict, body: dict = None) -> dict:
+    """event в формате шлюза облачных функций из описания теста"""
+    url = urlsplit(case.get('path', '/'))
+    body = case.get('body') if body is None else body
+    return {
+        'httpMethod': case.get('method', 'GET'),
+        'path': url.path or '/',
+        'queryStringParameters': dict(parse_qsl(url.query)),
+        'headers': {'Content-Type': 'application/json', **case.get('headers', {})},
+        'body': json.dumps(body, ensure_ascii=False) if body is not None else None,
+        'isBase64Encoded': False,
+    }
+
+
+def decode_body(response: dict):
+    body = response.get('body') or ''
+    if response.get('isBase64Encoded'):
+        body = base64.b64decode(body)
+        if (response.get('headers') or {}).get('Content-Encoding') == 'gzip':
+            body = gzip.decompress(body)
+        body = body.decode('utf-8')
+    try:
+        return json.loads(body) if body else None
+    except ValueError:
+        return body
+
+
+TYPE_MATCHERS = {
+    'string': lambda v: isinstance(v, str),
+    'number': lambda v: isinstance(v, (int, float)) and not isinstance(v, bool),
+    'boolean': lambda v: isinstance(v, bool),
+    'array': lambda v: isinstance(v, list),
+    'object': lambda v: isinstance(v, dict),
+}
+
+
+def match_body(expected, actual, partial: bool, path: str = '$') -> list:
+    """Расхождения тела ответа с ожидаемым; строки-типы (number, array, ...) проверяют только тип"""
+    if isinstance(expected, str) and expected in TYPE_MATCHERS:
+        return [] if TYPE_MATCHERS[expected](actual) else [f'{path}: ожидался {expected}, получено {actual!r}']
+    if isinstance(expected, dict):
+        if not isinstance(actual, dict):
+            return [f'{path}: ожидался объект, получено {actual!r}']
+        errors = []
+        for key, value in expected.items():
+            if key not in actual:
+                errors.append(f'{path}.{key}: отсутствует')
+            else:
+                errors += match_body(value, actual[key], partial, f'{path}.{key}')
+        if not partial:
+            errors += [f'{path}.{key}: лишнее поле' for key in actual if key not in expected]
+        return errors
+    if isinstance(expected, list):
+        if not isinstance(actual, list) or len(expected) != len(actual):
+            return [f'{path}: ожидался массив из {len(expected)} элементов']
+        errors = []
+        for i, (e, a) in enumerate(zip(expected, actual)):
+            errors += match_body(e, a, partial, f'{path}[{i}]')
+        return errors
+    return [] if expected == actual else [f'{path}: ожидалось {expected!r}, получено {actual!r}']
+
+
+def seed_fixtures(dsn: str, cases_by_function: dict):
+    """Создаёт пользователей с user_id из тестов, которые предполагают их существование"""
+    user_ids = set()
+    for cases in cases_by_function.values():
+        for case in cases:
+            event = build_event(case)
+            body = case.get('body') if isinstance(case.get('body'), dict) else {}
+            # Пакетные синхронизации несут user_id в каждом элементе items
+            items = body.get('items') if isinstance(body.get('items'), list) else []
+            values = [event['queryStringParameters'].get('user_id'), body.get('user_id')]
+            values += [item.get('user_id') for item in items if isinstance(item, dict)]
+            for value in values:
+                if isinstance(value, str) and UUID_RE.match(value):
+                    user_ids.add(value)
+    if not user_ids:
+        return
+    conn = psycopg2.connect(dsn)
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (id, phone_number, referral_code)
+                SELECT id, '+000' || substr(md5(id::text), 1, 10), upper(substr(md5(id::text), 1, 8))
+                FROM unnest(%s::uuid[]) AS id
+                ON CONFLICT DO NOTHING
+            """, (sorted(user_ids),))
+        conn.commit()
+    finally:
+        conn.close()
+
+
+def load_handlers(names: list) -> dict:
+    """Загружает функции и подменяет фабрики курсоров их пулов на счётчик запросов"""
+    handlers = {}
+    for name in names:
+        module = load_function(name)
+        db = local_module(module, 'db')
+        db.RealDictCursor = CountingCursor
+        db.TracingCursor = type('CountingTracingCursor', (CountingMixin, db.TracingCursor), {})
+        handlers[name] = module
+    return handlers
+
+
+def invoke(module, event: dict) -> tuple:
+    """Вызов обработчика: (ответ, секунды, число запросов к БД)"""
+    _query_counter.value = 0
+    started = time.perf_counter()
+    response = module.handler(event, None)
+    return response, time.perf_counter() - started, _query_counter.value
+
+
+def unique_body(body, n: int, run_id: str):
+    """Тело для n-го повтора запроса: уникальные значения там, где повтор запрещён схемой"""
+    if not isinstance(body, dict) or 'phone_number' not in body:
+        return body
+    return {**body, 'phone_number': f'+999{run_id}{n:07d}'}
+
+
+def run_tests(handlers: dict, cases_by_function: dict) -> int:
+    failures = 0
+    for name, cases in cases_by_function.items():
+        for case in cases:
+            response, elapsed, queries = invoke(handlers[name], build_event(case))
+            errors = []
+            if response['statusCode'] != case.get('expectedStatus', 200):
+                errors.append(f"статус {response['statusCode']}, ожидался {case.get('expectedStatus', 200)}")
+            if 'expectedBody' in case:
+                errors += match_body(case['expectedBody'], decode_body(response),
+                                     case.get('bodyMatcher', 'partial') == 'partial')
+            mark = 'OK  ' if not errors else 'FAIL'
+            print(f"{mark} {name}: {case.get('name')} ({elapsed * 1000:.1f} мс, запросов к БД: {queries})")
+            for error in errors:
+                print(f'       {error}')
+            if errors:
+                print(f'       тело: {decode_body(response)!r}'[:500])
+            failures += bool(errors)
+    return failures
+
+
+def check_boost_cache(handlers: dict, cases_by_function: dict) -> list:
+    """
+    Синхронизации с sync_id берут boost-множитель из кэша процесса: по ответам
+    это не видно, поэтому подменяем cached_boosts в ingest и смотрим, что он вернул.
+    """
+    module = handlers.get('steps-tracker')
+    user_id = next((case['body']['user_id'] for case in cases_by_function.get('steps-tracker', [])
+                    if isinstance(case.get('body'), dict) and UUID_RE.match(case['body'].get('user_id') or '')), None)
+    if module is None or user_id is None:
+        return []
+
+    # Закрываем тёплые соединения: проверяется подписка нового соединения
+    pool = local_module(module, 'db').get_pool()
+    for conn in [pool.acquire() for _ in range(pool.stats()['idle'])]:
+        pool.release(conn, discard=True)
+
+    ingest = local_module(module, 'ingest')
+    original = ingest.cached_boosts
+    multipliers = []
+
+    def spy(conn, user_ids):
+        result = original(conn, user_ids)
+        multipliers.append(result[0][0])
+        return result
+
+    ingest.cached_boosts = spy
+    try:
+        # Первая синхронизация подписывается на оповещения и наполняет кэш, вторая читает его
+        for n in range(2):
+            body = {'user_id': user_id, 'steps_count': 100, 'sync_id': f'boost-cache-{uuid.uuid4().hex[:8]}-{n}'}
+            response = module.handler(build_event({'method': 'POST', 'path': '/'}, body), None)
+            if response['statusCode'] != 200:
+                return [f"синхронизация вернула статус {response['statusCode']}"]
+    finally:
+        ingest.cached_boosts = original
+    return [] if multipliers[-1] is not None else ['синхронизация с sync_id не взяла boost из кэша']
+
+
+def check_history_pages(handlers: dict, cases_by_function: dict) -> list:
+    """
+    Страницы истории по next_cursor: синхронизации пишут только сегодняшний день,
+    поэтому дни прошлых дат вставляются напрямую и обходятся страницами по два.
+    """
+    module = handlers.get('steps-tracker')
+    if module is None:
+        return []
+    user_id = str(uuid.uuid4())
+    days = [f'2024-03-0{day}' for day in range(1, 6)]
+    db = local_module(module, 'db')
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (id, phone_number, referral_code)
+                VALUES (%s, '+000' || substr(md5(%s), 1, 10), upper(substr(md5(%s), 1, 8)))
+            """, (user_id, user_id, user_id))
+            cur.execute("""
+                INSERT INTO daily_steps (user_id, date, steps_count, distance_km, calories_burned,
+                                         active_minutes, spitak_earned, boost_multiplier)
+                SELECT %s, d::date, 1000, 0.7, 50, 10, 1, 1 FROM unnest(%s::date[]) AS d
+            """, (user_id, days))
+        conn.commit()
+    finally:
+        db.release_db_connection(conn)
+
+    def get(params):
+        query = '&'.join(f'{key}={value}' for key, value in {'user_id': user_id, **params}.items())
+        response = module.handler(build_event({'method': 'GET', 'path': f'/?{query}'}), None)
+        return response['statusCode'], decode_body(response)
+
+    seen = []
+    cursor = None
+    for _ in range(len(days)):
+        status, body = get({'limit': 2, **({'cursor': cursor} if cursor else {})})
+        if status != 200:
+            return [f'страница истории вернула статус {status}']
+        seen += [row['date'] for row in body['history']]
+        cursor = body['next_cursor']
+        if cursor is None:
+            break
+    errors = [] if seen == days[::-1] else [f'страницы истории: {seen}']
+    status, body = get({'group': 'month', 'limit': 1})
+    if status != 200 or body['periods'][0]['active_days'] != len(days) or body['next_cursor'] is not None:
+        errors.append(f'история по месяцам: {status} {body}')
+    return errors
+
+
+def check_samples_rollup(handlers: dict, cases_by_function: dict) -> list:
+    """
+    Свёртка отсчётов: часы из одних нулей попадают в step_hourly, а день
+    из одних нулей не заводит пустую строку daily_steps.
+    """
+    module = handlers.get('steps-tracker')
+    if module is None:
+        return []
+    user_id = str(uuid.uuid4())
+    yesterday = date.today() - timedelta(days=1)
+    db = local_module(module, 'db')
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            cur.execute("""
+                INSERT INTO users (id, phone_number, referral_code)
+                VALUES (%s, '+000' || substr(md5(%s), 1, 10), upper(substr(md5(%s), 1, 8)))
+            """, (user_id, user_id, user_id))
+        conn.commit()
+        body = {'user_id': user_id, 'steps_count': 10,
+                'samples': [{'at': f'{yesterday}T08:0{minute}', 'steps': 0} for minute in range(3)]}
+        response = module.handler(build_event({'method': 'POST', 'path': '/'}, body), None)
+        if response['statusCode'] != 200:
+            return [f"синхронизация с отсчётами вернула статус {response['statusCode']}"]
+        local_module(module, 'samples').rollup_samples(conn, lag_seconds=0)
+        with conn.cursor() as cur:
+            cur.execute("SELECT COUNT(*) AS days FROM daily_steps WHERE user_id = %s AND date = %s",
+                        (user_id, yesterday))
+            days = cur.fetchone()['days']
+        conn.commit()
+    finally:
+        db.release_db_connection(conn)
+
+    response = module.handler(build_event({'method': 'GET', 'path': f'/?user_id={user_id}&view=hourly&date={yesterday}'}), None)
+    hours = decode_body(response).get('hours')
+    errors = [] if days == 0 else ['свёртка завела строку daily_steps для дня без шагов']
+    if hours != [{'hour': 8, 'steps_count': 0, 'sample_count': 3}]:
+        errors.append(f'почасовые суммы: {hours}')
+    return errors
+
+
+def check_profile_etag_unknown_user(handlers: dict, cases_by_function: dict) -> list:
+    """
+    ETag профиля без строки в profile_versions — версия 0 и сегодняшняя дата;
+    для несуществующего пользователя такой If-None-Match должен дать 404, а не 304.
+    """
+    module = handlers.get('users')
+    if module is None:
+        return []
+    etag = local_module(module, 'profile_cache').profile_etag(0, date.today())
+    case = {'method': 'GET', 'path': f'/?user_id={uuid.uuid4()}', 'headers': {'If-None-Match': etag}}
+    status = module.handler(build_event(case), None)['statusCode']
+    return [] if status == 404 else [f'профиль несуществующего пользователя с ETag {etag}: статус {status}']
+
+
+def check_prepared_statements(handlers: dict, cases_by_function: dict) -> list:
+    """
+    Перевод запроса в PREPARE: строки и комментарии не трогаются, параметр без
+    ::тип отклоняется, запрос с параметром внутри строки выполняется без подготовки,
+    а тип параметра берётся из приведения, а не из вывода по выражению.
+    """
+    module = handlers.get('users')
+    if module is None:
+        return []
+    db = local_module(module, 'db')
+    errors = []
+    compiled = db._compile_statement(
+        "SELECT %(a)s::int + %(a)s::int, %(b)s::text, 7 %% 2, 'x%%s' -- 100%%\n /* $1 */ FROM t")
+    expected = ("SELECT $1::int + $1::int, $2::text, 7 % 2, 'x%s' -- 100%\n /* $1 */ FROM t", ['a', 'b'])
+    if compiled != expected:
+        errors.append(f'перевод параметров: {compiled}')
+    if db._compile_statement("SELECT %(a)s::text -- %(a)s") is not None:
+        errors.append('запрос с параметром в комментарии подготовлен')
+    try:
+        db._compile_statement('SELECT %(a)s * 2')
+        errors.append('параметр без типа принят')
+    except TypeError:
+        pass
+
+    conn = db.get_db_connection()
+    try:
+        with conn.cursor() as cur:
+            for name, sql in (('harness_cast', "SELECT %(bonus)s::numeric * COUNT(*) AS value, '50%%' AS label "
+                                               "FROM (VALUES (1), (2)) AS t(n)"),
+                              ('harness_literal', "SELECT %(bonus)s::numeric * 2 AS value, '%(bonus)s' AS label")):
+                for _ in range(2):
+                    db.execute_prepared(cur, name, sql, {'bonus': 2.5})
+                    row = cur.fetchone()
+                    if float(row['value']) != 5.0:
+                        errors.append(f'{name}: {dict(row)}')
+            if 'harness_literal' in getattr(conn, 'prepared', {}):
+                errors.append('запрос с параметром в строке подготовлен на сервере')
+        conn.commit()
+    finally:
+        db.release_db_connection(conn)
+    return errors
+
+
+CHECKS = {
+    'steps-tracker: boost из кэша при sync_id': check_boost_cache,
+    'steps-tracker: страницы истории по next_cursor': check_history_pages,
+    'steps-tracker: свёртка отсчётов без пустых дней': check_samples_rollup,
+    'users: ETag несуществующего профиля': check_profile_etag_unknown_user,
+    'db: подготовленные запросы с явными типами': check_prepared_statements,
+}
+
+
+def run_checks(handlers: dict, cases_by_function: dict) -> int:
+    """Проверки внутреннего поведения, которое не видно по ответам tests.json"""
+    failures = 0
+    for name, check in CHECKS.items():
+        errors = check(handlers, cases_by_function)
+        print(f"{'OK  ' if not errors else 'FAIL'} {name}")
+        for error in errors:
+            print(f'       {error}')
+        failures += bool(errors)
+    return failures
+
+
+def percentile(samples: list, p: float) -> float:
+    """Перцентиль по ближайшему рангу"""
+    if not samples:
+        return 0.0
+    rank = max(1, int(round(p / 100 * len(samples) + 0.5)))
+    return samples[min(rank, len(samples)) - 1]
+
+
+def bench_case(module, case: dict, requests: int, concurrency: int, warmup: int) -> dict:
+    run_id = uuid.uuid4().hex[:4]
+    expected_status = case.get('expectedStatus', 200)
+    for n in range(warmup):
+        invoke(module, build_event(case, unique_body(case.get('body'), n, 'w' + run_id[:3])))
+
+    latencies, queries, errors = [], [], []
+    lock = threading.Lock()
+    counter = iter(range(requests))
+
+    def worker():
+        while True:
+            with lock:
+                n = next(counter, None)
+            if n is None:
+                return
+            event = build_event(case, unique_body(case.get('body'), n, run_id))
+            try:
+                response, elapsed, count = invoke(module, event)
+                status = response['statusCode']
+            except Exception as e:
+                elapsed, count, status = 0.0, _query_counter.value, repr(e)
+            with lock:
+                latencies.append(elapsed)
+                queries.append(count)
+                if status != expected_status:
+                    errors.append(status)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=worker) for _ in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.perf_counter() - started
+
+    latencies.sort()
+    return {
+        'requests': requests,
+        'concurrency': concurrency,
+        'p50_ms': round(percentile(latencies, 50) * 1000, 3),
+        'p95_ms': round(percentile(latencies, 95) * 1000, 3),
+        'p99_ms': round(percentile(latencies, 99) * 1000, 3),
+        'throughput_rps': round(requests / wall, 1) if wall else None,
+        'queries_per_request': round(sum(queries) / len(queries), 2) if queries else 0,
+        'errors': len(errors),
+        'error_samples': [str(e) for e in errors[:5]],
+    }
+
+
+def git_revision() -> dict:
+    def git(*args):
+        try:
+            return subprocess.run(['git', *args], cwd=REPO_DIR, capture_output=True, text=True).stdout.strip()
+        except OSError:
+            return ''
+    return {'commit': git('rev-parse', '--short', 'HEAD') or 'unknown', 'dirty': bool(git('status', '--porcelain', '--', 'backend', 'db_migrations'))}
+
+
+def run_bench(handlers: dict, cases_by_function: dict, args) -> dict:
+    revision = git_revision()
+    report = {**revision, 'created_at': time.strftime('%Y-%m-%dT%H:%M:%S'), 'endpoints': {}}
+    for name, cases in cases_by_function.items():
+        for case in cases:
+            key = f"{name} {case.get('method', 'GET')} {case.get('path', '/')}"
+            result = bench_case(handlers[name], case, args.requests, args.concurrency, args.warmup)
+            report['endpoints'][key] = result
+            print(f"{key}: p50 {result['p50_ms']} мс, p95 {result['p95_ms']} мс, p99 {result['p99_ms']} мс, "
+                  f"{result['throughput_rps']} rps, запросов к БД {result['queries_per_request']}, ошибок {result['errors']}")
+
+    os.makedirs(RESULTS_DIR, exist_ok=True)
+    suffix = '-dirty' if revision['dirty'] else ''
+    path = os.path.join(RESULTS_DIR, f"{revision['commit']}{suffix}.json")
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(report, f, ensure_ascii=False, indent=2)
+    print(f'Результаты: {os.path.relpath(path, REPO_DIR)}')
+    return report
+
+
+def compare(old_path: str, new_path: str, threshold: float) -> int:
+    with open(old_path, encoding='utf-8') as f:
+        old = json.load(f)
+    with open(new_path, encoding='utf-8') as f:
+        new = json.load(f)
+    print(f"{old.get('commit')} -> {new.get('commit')}")
+    regressions = 0
+    for key, result in new['endpoints'].items():
+        before = old['endpoints'].get(key)
+        if not before:
+            print(f'{key}: новый эндпоинт')
+            continue
+        line = []
+        for metric in ('p50_ms', 'p95_ms', 'p99_ms', 'queries_per_request'):
+            if before[metric]:
+                change = (result[metric] - before[metric]) / before[metric] * 100
+                line.append(f'{metric} {before[metric]} -> {result[metric]} ({change:+.0f}%)')
+                if metric in ('p95_ms', 'queries_per_request') and change > threshold:
+                    regressions += 1
+        print(f"{key}: {', '.join(line)}")
+    if regressions:
+        print(f'Регрессий выше {threshold:.0f}%: {regressions}')
+        return 3
+    return 0
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Локальные тесты и бенчмарки облачных функций')
+    sub = parser.add_subparsers(dest='command', required=True)
+    for command in ('test', 'bench'):
+        p = sub.add_parser(command)
+        p.add_argument('--function', action='append', help='только указанные функции')
+        p.add_argument('--keep-db', action='store_true', help='не удалять временную базу')
+        if command == 'bench':
+            p.add_argument('--requests', type=int, default=200, help='запросов на эндпоинт')
+            p.add_argument('--concurrency', type=int, default=8)
+            p.add_argument('--warmup', type=int, default=10)
+    p = sub.add_parser('compare')
+    p.add_argument('files', nargs='*', help='два файла результатов; по умолчанию два последних')
+    p.add_argument('--threshold', type=float, default=20.0, help='допустимый рост p95 и запросов, %%')
+    args = parser.parse_args()
+
+    if args.command == 'compare':
+        files = args.files or sorted(glob.glob(os.path.join(RESULTS_DIR, '*.json')), key=os.path.getmtime)[-2:]
+        if len(files) != 2:
+            sys.exit('Нужно два файла результатов в bench_results/')
+        sys.exit(compare(files[0], files[1], args.threshold))
+
+    names = args.function or functions()
+    cases_by_function = {name: load_cases(name) for name in names}
+    if args.command == 'bench':
+        os.environ.setdefault('DB_POOL_MAX_SIZE', str(args.concurrency))
+
+    with LocalDatabase(os.environ.get('LOCAL_PG_DSN', ''), keep=args.keep_db) as database:
+        os.environ['DATABASE_URL'] = database.dsn
+        seed_fixtures(database.dsn, cases_by_function)
+        handlers = load_handlers(names)
+        if args.command == 'test':
+            failures = run_tests(handlers, cases_by_function) + run_checks(handlers, cases_by_function)
+            print(f'Провалено: {failures}' if failures else 'Все тесты прошли')
+            exit_code = 1 if failures else 0
+        else:
+            run_bench(handlers, cases_by_function, args)
+            exit_code = 0
+    sys.exit(exit_code)
+
+
+if __name__ == '__main__':
+    main()
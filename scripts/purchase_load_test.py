@@ -0,0 +1,164 @@
+"""
+Нагрузочный тест покупки ваучеров против локального PostgreSQL.
+Создаёт ваучер с ограниченным остатком и пользователей с балансом, запускает
+параллельных покупателей через обработчик vouchers и проверяет, что ваучер
+не перепродан, балансы не ушли в минус, а списания сходятся с покупками.
+
+    DATABASE_URL=postgresql://localhost/spitak python scripts/purchase_load_test.py \
+        --buyers 64 --stock 100 --users 200 --shards 0
+"""
+import argparse
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from decimal import Decimal
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Проверка отсутствия перепродажи ваучеров')
+    parser.add_argument('--buyers', type=int, default=64, help='число параллельных покупателей')
+    parser.add_argument('--users', type=int, default=200, help='число тестовых пользователей')
+    parser.add_argument('--stock', type=int, default=100, help='остаток ваучера')
+    parser.add_argument('--price', type=Decimal, default=Decimal('12.00'))
+    parser.add_argument('--balance', type=Decimal, default=Decimal('30.00'), help='стартовый баланс пользователя')
+    parser.add_argument('--attempts', type=int, default=5, help='покупок на одного покупателя')
+    parser.add_argument('--shards', type=int, default=0, help='число шардов остатка (0 — без шардирования)')
+    parser.add_argument('--keep', action='store_true', help='не удалять тестовые данные')
+    args = parser.parse_args()
+
+    if not os.environ.get('DATABASE_URL'):
+        sys.exit('Нужен DATABASE_URL локальной базы с применёнными db_migrations')
+    os.environ['DB_POOL_MAX_SIZE'] = str(args.buyers)
+
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    from function_loader import load_function, local_module
+
+    vouchers = load_function('vouchers')
+    db = local_module(vouchers, 'db')
+    purchase = local_module(vouchers, 'purchase')
+
+    run_id = uuid.uuid4().hex[:8]
+    conn = db.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        INSERT INTO vouchers (brand_name, title, discount_value, category, price_spitak, total_quantity, remaining_quantity)
+        VALUES (%s, 'Нагрузочный тест', 'TEST', 'Тест', %s, %s, %s)
+        RETURNING id
+    """, (f'LOADTEST-{run_id}', args.price, args.stock, args.stock))
+    voucher_id = cur.fetchone()['id']
+    cur.execute("""
+        INSERT INTO users (phone_number)
+        SELECT '+999' || %s || lpad(n::text, 6, '0') FROM generate_series(1, %s) AS n
+        RETURNING id
+    """, (run_id[:4], args.users))
+    user_ids = [r['id'] for r in cur.fetchall()]
+    cur.execute("""
+        INSERT INTO transactions (user_id, type, amount, status, description, delta_spitak)
+        SELECT id, 'opening_balance', %s, 'completed', 'Нагрузочный тест', %s FROM unnest(%s::uuid[]) AS id
+    """, (args.balance, args.balance, user_ids))
+    conn.commit()
+    cur.close()
+    db.release_db_connection(conn)
+
+    if args.shards:
+        conn = db.get_db_connection()
+        purchase.reshard_stock(conn, voucher_id, args.shards)
+        db.release_db_connection(conn)
+
+    statuses = {}
+    latencies = []
+    lock = threading.Lock()
+    start = threading.Barrier(args.buyers)
+
+    def buyer(worker: int):
+        start.wait()
+        for attempt in range(args.attempts):
+            user_id = user_ids[(worker * args.attempts + attempt) % len(user_ids)]
+            started = time.perf_counter()
+            response = vouchers.handler({
+                'httpMethod': 'POST',
+                'body': json.dumps({'user_id': user_id, 'voucher_id': voucher_id}),
+            }, None)
+            elapsed = time.perf_counter() - started
+            if response['statusCode'] == 500:
+                print(response['body'], file=sys.stderr)
+            with lock:
+                statuses[response['statusCode']] = statuses.get(response['statusCode'], 0) + 1
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=buyer, args=(i,)) for i in range(args.buyers)]
+    began = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    duration = time.perf_counter() - began
+
+    conn = db.get_db_connection()
+    cur = conn.cursor()
+    cur.execute("""
+        SELECT
+            (SELECT COUNT(*) FROM voucher_purchases WHERE voucher_id = %(v)s) AS sold,
+            (SELECT CASE WHEN stock_shards > 0
+                         THEN (SELECT SUM(remaining_quantity) FROM voucher_stock_shards WHERE voucher_id = %(v)s)
+                         ELSE remaining_quantity END
+             FROM vouchers WHERE id = %(v)s) AS remaining,
+            (SELECT COUNT(*) FROM (
+                SELECT user_id FROM transactions WHERE user_id = ANY(%(u)s::uuid[])
+                GROUP BY user_id HAVING SUM(delta_spitak) < 0
+             ) n) AS negative_balances,
+            (SELECT COALESCE(-SUM(delta_spitak), 0) FROM transactions
+             WHERE type = 'purchase' AND user_id = ANY(%(u)s::uuid[])) AS debited,
+            (SELECT COUNT(*) * %(price)s FROM voucher_purchases WHERE voucher_id = %(v)s) AS purchase_total
+    """, {'v': voucher_id, 'u': user_ids, 'price': args.price})
+    totals = cur.fetchone()
+
+    if not args.keep:
+        cur.execute("DELETE FROM transactions WHERE user_id = ANY(%s::uuid[])", (user_ids,))
+        cur.execute("DELETE FROM voucher_purchases WHERE voucher_id = %s", (voucher_id,))
+        cur.execute("DELETE FROM voucher_stock_shards WHERE voucher_id = %s", (voucher_id,))
+        cur.execute("DELETE FROM vouchers WHERE id = %s", (voucher_id,))
+        cur.execute("DELETE FROM users WHERE id = ANY(%s::uuid[])", (user_ids,))
+        conn.commit()
+    cur.close()
+    db.release_db_connection(conn)
+
+    latencies.sort()
+    report = {
+        'buyers': args.buyers,
+        'shards': args.shards,
+        'requests': len(latencies),
+        'statuses': statuses,
+        'duration_s': round(duration, 3),
+        'throughput_rps': round(len(latencies) / duration, 1),
+        'p50_ms': round(latencies[len(latencies) // 2] * 1000, 2),
+        'p99_ms': round(latencies[int(len(latencies) * 0.99) - 1] * 1000, 2),
+        'stock': args.stock,
+        'sold': totals['sold'],
+        'remaining': int(totals['remaining']),
+        'negative_balances': totals['negative_balances'],
+        'pool': db.pool_stats(),
+    }
+    print(json.dumps(report, indent=2, ensure_ascii=False))
+
+    errors = []
+    if totals['sold'] > args.stock:
+        errors.append('перепродажа: продано больше остатка')
+    if totals['sold'] + int(totals['remaining']) != args.stock:
+        errors.append('остаток не сходится с числом покупок')
+    if totals['negative_balances']:
+        errors.append('есть отрицательные балансы')
+    if totals['debited'] != totals['purchase_total']:
+        errors.append('списания не совпадают с суммой покупок')
+    if statuses.get(500):
+        errors.append('обработчик вернул 500')
+    if errors:
+        sys.exit('ПРОВАЛ: ' + '; '.join(errors))
+    print('OK: перепродаж нет')
+
+
+if __name__ == '__main__':
+    main()
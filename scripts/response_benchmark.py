@@ -0,0 +1,135 @@
+"""
+Микробенчмарк сериализации ответов: старый путь (ручное преобразование полей
+каждой строки + json.dumps) против общего responses.json_response со стандартным
+json и с orjson (если установлен), а также стоимость и выигрыш gzip.
+БД не нужна: строки генерируются в том же виде, в каком их отдаёт psycopg2.
+
+    python scripts/response_benchmark.py --rows 500 --repeat 200
+"""
+import argparse
+import copy
+import importlib.util
+import json
+import os
+import sys
+import time
+from datetime import datetime, timedelta
+from decimal import Decimal
+
+RESPONSES_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                              'backend', 'vouchers', 'responses.py')
+
+
+def load_responses(name: str, block_orjson: bool):
+    """Отдельный экземпляр responses.py; block_orjson принудительно включает стандартный json"""
+    saved = sys.modules.get('orjson')
+    if block_orjson:
+        sys.modules['orjson'] = None
+    sys.path.insert(0, os.path.dirname(RESPONSES_PATH))
+    try:
+        spec = importlib.util.spec_from_file_location(name, RESPONSES_PATH)
+        module = importlib.util.module_from_spec(spec)
+        spec.loader.exec_module(module)
+    finally:
+        sys.path.remove(os.path.dirname(RESPONSES_PATH))
+        if block_orjson:
+            if saved is None:
+                sys.modules.pop('orjson', None)
+            else:
+                sys.modules['orjson'] = saved
+    return module
+
+
+def make_vouchers(count: int) -> list:
+    now = datetime(2026, 1, 15, 12, 30, 45, 123456)
+    return [{
+        'id': f'00000000-0000-0000-0000-{i:012d}',
+        'brand_name': f'Бренд {i}',
+        'title': f'Скидка {i % 50}% на всё',
+        'description': 'Подробное описание предложения партнёра ' * 3,
+        'discount_value': f'{i % 50}%',
+        'category': 'Спорт',
+        'price_spitak': Decimal(f'{i % 200}.50'),
+        'image_url': f'https://cdn.example.com/vouchers/{i}.png',
+        'emoji': '🏃',
+        'terms': 'Не суммируется с другими акциями',
+        'valid_until': now + timedelta(days=i % 90),
+        'total_quantity': 1000,
+        'remaining_quantity': 1000 - i % 1000,
+        'is_active': True,
+        'created_at': now,
+        'updated_at': now,
+    } for i in range(count)]
+
+
+def legacy_response(vouchers: list) -> dict:
+    """Путь до общего модуля ответов: преобразование в цикле и json.dumps"""
+    for v in vouchers:
+        v['price_spitak'] = float(v['price_spitak'])
+        v['valid_until'] = v['valid_until'].isoformat() if v['valid_until'] else None
+        v['created_at'] = v['created_at'].isoformat() if v['created_at'] else None
+        v['updated_at'] = v['updated_at'].isoformat() if v['updated_at'] else None
+    return {
+        'statusCode': 200,
+        'headers': {'Content-Type': 'application/json', 'Access-Control-Allow-Origin': '*'},
+        'body': json.dumps({'vouchers': vouchers}),
+        'isBase64Encoded': False
+    }
+
+
+def bench(label: str, fn, source: list, repeat: int, copy_rows: bool) -> dict:
+    samples = []
+    size = 0
+    for _ in range(repeat):
+        rows = copy.deepcopy(source) if copy_rows else source
+        started = time.perf_counter()
+        response = fn(rows)
+        samples.append(time.perf_counter() - started)
+        size = len(response['body'])
+    samples.sort()
+    return {
+        'variant': label,
+        'median_ms': round(samples[len(samples) // 2] * 1000, 3),
+        'min_ms': round(samples[0] * 1000, 3),
+        'body_bytes': size,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Микробенчмарк сериализации ответов')
+    parser.add_argument('--rows', type=int, default=500)
+    parser.add_argument('--repeat', type=int, default=200)
+    args = parser.parse_args()
+
+    source = make_vouchers(args.rows)
+    gzip_event = {'headers': {'Accept-Encoding': 'gzip, deflate'}}
+    stdlib = load_responses('responses_stdlib', block_orjson=True)
+    fast = load_responses('responses_fast', block_orjson=False)
+
+    # Старый путь мутирует строки, поэтому каждой итерации нужна своя копия;
+    # копирование не входит в замер
+    results = [
+        bench('legacy: цикл + json.dumps', legacy_response, source, args.repeat, copy_rows=True),
+        bench('responses: json', lambda rows: stdlib.json_response(200, {'vouchers': rows}),
+              source, args.repeat, copy_rows=False),
+        bench('responses: json + gzip', lambda rows: stdlib.json_response(200, {'vouchers': rows}, gzip_event),
+              source, args.repeat, copy_rows=False),
+    ]
+    if fast.orjson is not None:
+        results += [
+            bench('responses: orjson', lambda rows: fast.json_response(200, {'vouchers': rows}),
+                  source, args.repeat, copy_rows=False),
+            bench('responses: orjson + gzip', lambda rows: fast.json_response(200, {'vouchers': rows}, gzip_event),
+                  source, args.repeat, copy_rows=False),
+        ]
+    else:
+        print('orjson не установлен: быстрый вариант пропущен', file=sys.stderr)
+
+    baseline = results[0]['median_ms']
+    for r in results:
+        r['speedup'] = round(baseline / r['median_ms'], 2) if r['median_ms'] else None
+    print(json.dumps({'rows': args.rows, 'repeat': args.repeat, 'results': results}, ensure_ascii=False, indent=2))
+
+
+if __name__ == '__main__':
+    main()
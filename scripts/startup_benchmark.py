@@ -0,0 +1,131 @@
+"""
+Бенчмарк холодного старта облачных функций.
+Каждый прогон — отдельный процесс Python, как новый контейнер: время импорта
+index.py, задержка первого запроса (с подключением к БД и подготовкой запросов)
+и второго, тёплого. Запрос — первый тест из tests.json функции. По выводу
+python -X importtime показываются самые дорогие импорты внутри index
+(накопленное время, вложенные модули входят в родительские).
+
+    LOCAL_PG_DSN="host=localhost user=postgres" python scripts/startup_benchmark.py --runs 5
+"""
+import argparse
+import json
+import os
+import re
+import statistics
+import subprocess
+import sys
+import time
+
+SCRIPTS_DIR = os.path.dirname(os.path.abspath(__file__))
+BACKEND_DIR = os.path.join(os.path.dirname(SCRIPTS_DIR), 'backend')
+IMPORTTIME_RE = re.compile(r'^import time:\s+(\d+) \|\s+(\d+) \|( *)(\S+)$')
+
+
+def child(name: str):
+    """Один холодный старт: замеры в stdout одной JSON-строкой"""
+    # Обычный import, а не function_loader: так index попадает в вывод -X importtime
+    sys.path.insert(0, os.path.join(BACKEND_DIR, name))
+    started = time.perf_counter()
+    import index as module
+    import_ms = (time.perf_counter() - started) * 1000
+
+    sys.path.insert(0, SCRIPTS_DIR)
+    from local_harness import build_event, load_cases, unique_body
+    case = load_cases(name)[0]
+    timings = []
+    for n in range(2):
+        event = build_event(case, unique_body(case.get('body'), n, f'{os.getpid() % 10000:04d}'))
+        started = time.perf_counter()
+        response = module.handler(event, None)
+        timings.append(((time.perf_counter() - started) * 1000, response['statusCode']))
+
+    print(json.dumps({
+        'import_ms': import_ms,
+        'first_request_ms': timings[0][0],
+        'warm_request_ms': timings[1][0],
+        'status': timings[0][1],
+        'case': case.get('name'),
+    }))
+
+
+def parse_importtime(stderr: str) -> dict:
+    """Накопленное время (мс) модулей внутри index: имя -> время"""
+    entries = []
+    for line in stderr.splitlines():
+        match = IMPORTTIME_RE.match(line)
+        if match:
+            entries.append((int(match.group(2)) / 1000, len(match.group(3)), match.group(4)))
+
+    # Модуль печатается после своих зависимостей: поддерево index — строки перед ним с большим отступом
+    result = {}
+    for position, (cumulative, depth, module) in enumerate(entries):
+        if module != 'index':
+            continue
+        for child_cumulative, child_depth, child_module in reversed(entries[:position]):
+            if child_depth <= depth:
+                break
+            result[child_module] = child_cumulative
+    return result
+
+
+def measure(name: str, runs: int, env: dict) -> dict:
+    samples, imports = [], {}
+    for _ in range(runs):
+        proc = subprocess.run(
+            [sys.executable, '-X', 'importtime', os.path.abspath(__file__), '--child', name],
+            capture_output=True, text=True, env=env,
+        )
+        if proc.returncode != 0:
+            raise RuntimeError(f'{name}: {proc.stderr.strip()[-2000:]}')
+        samples.append(json.loads(proc.stdout.strip().splitlines()[-1]))
+        for module, cumulative in parse_importtime(proc.stderr).items():
+            imports.setdefault(module, []).append(cumulative)
+
+    def median(key):
+        return round(statistics.median(s[key] for s in samples), 2)
+
+    top = sorted(((round(statistics.median(v), 2), k) for k, v in imports.items()), reverse=True)[:8]
+    return {
+        'case': samples[0]['case'],
+        'status': samples[0]['status'],
+        'import_ms': median('import_ms'),
+        'first_request_ms': median('first_request_ms'),
+        'warm_request_ms': median('warm_request_ms'),
+        'top_imports_ms': {module: ms for ms, module in top},
+    }
+
+
+def main():
+    if len(sys.argv) == 3 and sys.argv[1] == '--child':
+        child(sys.argv[2])
+        return
+
+    sys.path.insert(0, SCRIPTS_DIR)
+    from local_harness import LocalDatabase, functions, load_cases, seed_fixtures
+
+    parser = argparse.ArgumentParser(description='Время импорта и первого запроса облачных функций')
+    parser.add_argument('--function', action='append', help='только указанные функции')
+    parser.add_argument('--runs', type=int, default=5, help='холодных стартов на функцию')
+    parser.add_argument('--output', help='сохранить отчёт в JSON')
+    args = parser.parse_args()
+
+    names = args.function or functions()
+    report = {}
+    with LocalDatabase(os.environ.get('LOCAL_PG_DSN', '')) as database:
+        seed_fixtures(database.dsn, {name: load_cases(name) for name in names})
+        env = {**os.environ, 'DATABASE_URL': database.dsn}
+        for name in names:
+            result = measure(name, args.runs, env)
+            report[name] = result
+            print(f"{name}: импорт {result['import_ms']} мс, первый запрос {result['first_request_ms']} мс, "
+                  f"тёплый {result['warm_request_ms']} мс ({result['case']}, статус {result['status']})")
+            print('    ' + ', '.join(f'{module} {ms}' for module, ms in result['top_imports_ms'].items()))
+
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+
+
+if __name__ == '__main__':
+    main()